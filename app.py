@@ -1,18 +1,34 @@
 # app.py
 import os
 import logging
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, g, has_request_context, Response, make_response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 import qrcode
 import io
 import base64
 import socket
-from datetime import datetime
+from datetime import datetime, timezone
 import hashlib
+import hmac
 import secrets
 from functools import wraps
 import traceback
 import time
 import ssl
+import threading
+import json
+import re
+import atexit
+import tempfile
+from collections import OrderedDict, deque
+import contextvars
+import csv
+import zlib
+import gzip
+import sqlite3
+import bisect
+import heapq
+from concurrent.futures import ThreadPoolExecutor, wait as _wait_futures
 
 # ------------------------------------------------------------------
 # HTTP client: try requests, fallback to urllib-based wrappers
@@ -27,6 +43,9 @@ except Exception:
     import urllib.error as _urllib_error
     import json as _json
 
+    # building an SSL context loads the CA bundle; do it once per process
+    _SSL_CONTEXT = ssl.create_default_context()
+
     class _SimpleResponse:
         def __init__(self, status_code, text, headers=None):
             self.status_code = status_code
@@ -61,9 +80,8 @@ except Exception:
                     req.add_header(k, v)
                 except Exception:
                     pass
-        ctx = ssl.create_default_context()
         try:
-            with _urllib_request.urlopen(req, timeout=timeout, context=ctx) as resp:
+            with _urllib_request.urlopen(req, timeout=timeout, context=_SSL_CONTEXT) as resp:
                 content = resp.read().decode("utf-8")
                 return _SimpleResponse(resp.getcode(), content, dict(resp.getheaders()))
         except _urllib_error.HTTPError as e:
@@ -87,6 +105,98 @@ except Exception:
     def requests_delete(url, headers=None, params=None, timeout=10):
         return _urllib_request_func("DELETE", url, headers=headers, params=params, timeout=timeout)
 
+# ------------------------------------------------------------------
+# Optional speedups: orjson for JSON encoding, brotli for compression.
+# Both are optional; stdlib json / gzip are used when they are missing.
+# ------------------------------------------------------------------
+try:
+    import orjson  # type: ignore
+    _HAS_ORJSON = True
+except Exception:
+    _HAS_ORJSON = False
+
+try:
+    import brotli  # type: ignore
+    _HAS_BROTLI = True
+except Exception:
+    _HAS_BROTLI = False
+
+# ------------------------------------------------------------------
+# Connection pool: persistent keep-alive sessions shared by safe_request
+# - requests path: one HTTPAdapter (urllib3 pool) shared by per-thread Sessions,
+#   so connections are reused across threads without sharing cookie state
+# - urllib path: no keep-alive, but the SSL context is built only once
+# ------------------------------------------------------------------
+HTTP_POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 16))
+
+class _HttpPool:
+    def __init__(self, pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._errors = 0
+        self._adapter = None
+        if _HAS_REQUESTS:
+            self._adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=0)
+
+    def _session(self):
+        sess = getattr(self._local, "session", None)
+        if sess is None:
+            sess = requests.Session()
+            sess.mount("https://", self._adapter)
+            sess.mount("http://", self._adapter)
+            self._local.session = sess
+        return sess
+
+    def send(self, method, url, headers=None, params=None, json_data=None, timeout=10):
+        with self._lock:
+            self._requests += 1
+        try:
+            if _HAS_REQUESTS:
+                return self._session().request(method.upper(), url, headers=headers, params=params, json=json_data, timeout=timeout)
+            return _urllib_request_func(method.upper(), url, headers=headers, params=params, json_data=json_data, timeout=timeout)
+        except Exception:
+            with self._lock:
+                self._errors += 1
+            raise
+
+    def stats(self):
+        opened = 0
+        idle = 0
+        if self._adapter is not None:
+            try:
+                pools = self._adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    p = pools.get(key)
+                    if p is None:
+                        continue
+                    opened += getattr(p, "num_connections", 0)
+                    try:
+                        idle += sum(1 for c in list(p.pool.queue) if c is not None)
+                    except Exception:
+                        pass
+            except Exception:
+                pass
+        else:
+            # urllib opens a fresh connection per request
+            opened = self._requests
+        reqs = self._requests
+        return {
+            "backend": "requests" if _HAS_REQUESTS else "urllib",
+            "pool_connections": self.pool_connections,
+            "pool_maxsize": self.pool_maxsize,
+            "requests": reqs,
+            "errors": self._errors,
+            "connections_opened": opened,
+            "open_connections": idle,
+            "reuse_rate": round(1 - (opened / reqs), 4) if reqs else 0.0,
+        }
+
+http_pool = _HttpPool()
+
 # ------------------------------------------------------------------
 # Logging
 # ------------------------------------------------------------------
@@ -104,6 +214,47 @@ logging.getLogger("werkzeug").setLevel(logging.ERROR)
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", secrets.token_hex(32))
 
+# ------------------------------------------------------------------
+# JSON encoding: orjson when installed (JSON_ENGINE=stdlib forces the
+# standard library). Used by jsonify and the streaming writers. Both engines
+# write the same bytes: compact, keys sorted (as Flask's default provider
+# does) and non-ASCII text as UTF-8 rather than \u escapes (orjson cannot
+# escape it), so responses and ETags do not depend on which one is installed.
+# ------------------------------------------------------------------
+JSON_ENGINE = "orjson" if _HAS_ORJSON and os.environ.get("JSON_ENGINE", "orjson") != "stdlib" else "stdlib"
+
+class _FastJSONProvider(DefaultJSONProvider):
+    ensure_ascii = False
+    sort_keys = True
+
+    def _orjson_option(self):
+        # datetimes go through self.default, as with the standard library
+        return orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | (orjson.OPT_SORT_KEYS if self.sort_keys else 0)
+
+    def dumps(self, obj, **kwargs):
+        if JSON_ENGINE == "orjson" and not kwargs:
+            try:
+                return orjson.dumps(obj, default=self.default, option=self._orjson_option()).decode("utf-8")
+            except TypeError:
+                pass
+        kwargs.setdefault("default", self.default)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        kwargs.setdefault("separators", (",", ":"))
+        return json.dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if JSON_ENGINE == "orjson":
+            try:
+                body = orjson.dumps(obj, default=self.default, option=self._orjson_option() | orjson.OPT_APPEND_NEWLINE)
+                return self._app.response_class(body, mimetype=self.mimetype)
+            except TypeError:
+                pass
+        return self._app.response_class(self.dumps(obj) + "\n", mimetype=self.mimetype)
+
+app.json = _FastJSONProvider(app)
+
 # ------------------------------------------------------------------
 # Supabase config (ENV first, fallback to provided)
 # ------------------------------------------------------------------
@@ -147,160 +298,1106 @@ def hash_password(pw):
         return None
     return hashlib.sha256(pw.encode()).hexdigest()
 
+class _TTLCache:
+    """Thread-safe LRU cache with a per-entry TTL (seconds) and a size bound."""
+    def __init__(self, maxsize=128, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
+
+# ------------------------------------------------------------------
+# Metrics registry (Prometheus text format, served at /metrics).
+# Every thread records into its own shard (a plain dict reached through a
+# thread-local), so recording takes no lock and never contends; /metrics
+# merges the shards when scraped. Shards of threads that have exited are
+# folded into a retired shard so counters stay monotonic.
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>"; without a token
+# it answers 401 unless METRICS_PUBLIC=1 opts into an open endpoint.
+# ------------------------------------------------------------------
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+METRICS_PUBLIC = os.environ.get("METRICS_PUBLIC", "0") == "1"
+if METRICS_ENABLED and not METRICS_TOKEN and not METRICS_PUBLIC:
+    logger.warning("METRICS_TOKEN not set: /metrics is disabled (set METRICS_TOKEN, or METRICS_PUBLIC=1 to serve it unauthenticated)")
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        """Counter (or gauge when value is negative). labels is a tuple of (key, value) pairs."""
+        if not METRICS_ENABLED:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, seconds):
+        if not METRICS_ENABLED:
+            return
+        shard = self._shard()
+        key = (name, labels)
+        hist = shard.get(key)
+        if hist is None:
+            hist = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        hist[bisect.bisect_left(self.buckets, seconds)] += 1
+        hist[-1] += seconds
+
+    def add_collector(self, fn):
+        """fn() -> iterable of (name, labels, value) gauges sampled at scrape time."""
+        self._collectors.append(fn)
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, value in shard.items():
+            if isinstance(value, list):
+                cur = into.get(key)
+                if cur is None:
+                    into[key] = list(value)
+                else:
+                    for i, v in enumerate(value):
+                        cur[i] += v
+            else:
+                into[key] = into.get(key, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._retired, shard)
+            self._shards = alive
+            merged = {}
+            self._merge(merged, self._retired)
+            shards = [shard for _, shard in alive]
+        for shard in shards:
+            self._merge(merged, shard.copy())
+        return merged
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs) + "}"
+
+    def render(self):
+        merged = self.snapshot()
+        by_name = {}
+        for (name, labels), value in merged.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for fn in self._collectors:
+            try:
+                for name, labels, value in fn():
+                    by_name.setdefault(name, []).append((labels, value))
+            except Exception as e:
+                logger.debug(f"metrics collector failed: {e}")
+        out = []
+        for name in sorted(by_name):
+            kind, text = self._help.get(name, ("untyped", ""))
+            if text:
+                out.append(f"# HELP {name} {text}")
+            out.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind == "histogram":
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, value):
+                        cumulative += count
+                        out.append(f"{name}_bucket{self._labels(labels, (('le', repr(bound)),))} {cumulative}")
+                    cumulative += value[len(self.buckets)]
+                    out.append(f"{name}_bucket{self._labels(labels, (('le', '+Inf'),))} {cumulative}")
+                    out.append(f"{name}_sum{self._labels(labels)} {value[-1]:.6f}")
+                    out.append(f"{name}_count{self._labels(labels)} {cumulative}")
+                else:
+                    out.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(out) + "\n"
+
+metrics = _Metrics()
+metrics.describe("http_request_duration_seconds", "histogram", "Flask request latency by route.")
+metrics.describe("http_requests_total", "counter", "Flask requests by route, method and status.")
+metrics.describe("http_requests_in_flight", "gauge", "Requests currently being handled.")
+metrics.describe("supabase_request_duration_seconds", "histogram", "Supabase call latency (all attempts) by table and method.")
+metrics.describe("supabase_requests_total", "counter", "Supabase calls by table, method and final status.")
+metrics.describe("supabase_retries_total", "counter", "Supabase retry attempts by table and method.")
+metrics.describe("swallowed_exceptions_total", "counter", "Exceptions turned into 200 responses, by handler and exception type.")
+
+def _supabase_table(url):
+    path = url.split("/rest/v1/", 1)[-1].split("?", 1)[0].strip("/")
+    return path or "root"
+
+# ------------------------------------------------------------------
+# Request tracing: every Supabase call made while serving a request is
+# recorded on it (table, method, status, attempts, offset, duration).
+# The response carries a Server-Timing header; a request slower than
+# TRACE_SLOW_MS or making more than TRACE_SLOW_CALLS calls is logged as one
+# JSON line; TRACE_SAMPLE_PERCENT of all requests (and every slow one) are
+# kept in a ring buffer of TRACE_BUFFER_SIZE read by /api/admin/traces.
+# ------------------------------------------------------------------
+TRACE_ENABLED = os.environ.get("TRACE_ENABLED", "1") != "0"
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", 1000.0))
+TRACE_SLOW_CALLS = int(os.environ.get("TRACE_SLOW_CALLS", 25))
+TRACE_SAMPLE_PERCENT = float(os.environ.get("TRACE_SAMPLE_PERCENT", 0.0))
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 200))
+TRACE_MAX_SPANS = int(os.environ.get("TRACE_MAX_SPANS", 200))
+
+class _RequestTracer:
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self._buffer = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.slow = 0
+        self.sampled = 0
+
+    def start(self):
+        if not TRACE_ENABLED:
+            return
+        g.trace_started = time.perf_counter()
+        g.trace_spans = []
+        g.trace_calls = 0
+
+    def record(self, table, method, status, attempts, started, elapsed):
+        """Called by safe_request; a no-op outside a traced request."""
+        if not TRACE_ENABLED or not has_request_context():
+            return
+        spans = g.get("trace_spans")
+        if spans is None:
+            return
+        # fan_out workers share g with the request thread; a racy count only skews the summary
+        g.trace_calls = g.get("trace_calls", 0) + 1
+        if len(spans) < TRACE_MAX_SPANS:
+            spans.append({"table": table, "method": method, "status": status, "attempts": attempts, "start_ms": round((started - g.trace_started) * 1000, 2), "duration_ms": round(elapsed * 1000, 2)})
+
+    def server_timing(self):
+        """Server-Timing value: total Supabase time plus the three slowest table/method groups."""
+        spans = list(g.get("trace_spans") or ())
+        groups = {}
+        for s in spans:
+            key = f"db-{s['table'].replace('/', '-')}-{s['method'].lower()}"
+            dur, n = groups.get(key, (0.0, 0))
+            groups[key] = (dur + s["duration_ms"], n + 1)
+        total = sum(s["duration_ms"] for s in spans)
+        app_ms = (time.perf_counter() - g.trace_started) * 1000
+        parts = [f'app;dur={app_ms:.1f}', f'db;dur={total:.1f};desc="{g.get("trace_calls", 0)} calls"']
+        for key, (dur, n) in sorted(groups.items(), key=lambda kv: -kv[1][0])[:3]:
+            parts.append(f'{key};dur={dur:.1f};desc="{n}x"')
+        return ", ".join(parts)
+
+    def finish(self, status):
+        started = g.pop("trace_started", None)
+        spans = g.pop("trace_spans", None)
+        if started is None or spans is None:
+            return
+        duration_ms = (time.perf_counter() - started) * 1000
+        calls = g.pop("trace_calls", len(spans))
+        slow = duration_ms >= TRACE_SLOW_MS or calls > TRACE_SLOW_CALLS
+        sampled = TRACE_SAMPLE_PERCENT > 0 and secrets.randbelow(10000) < TRACE_SAMPLE_PERCENT * 100
+        if not slow and not sampled:
+            return
+        spans.sort(key=lambda s: s["start_ms"])
+        with self._lock:
+            self._seq += 1
+            trace_id = self._seq
+        trace = {"id": trace_id, "reason": "slow" if slow else "sampled", "method": request.method, "path": request.path, "route": request.url_rule.rule if request.url_rule is not None else None, "status": status, "duration_ms": round(duration_ms, 2), "supabase_ms": round(sum(s["duration_ms"] for s in spans), 2), "calls": calls, "retries": sum(max(s["attempts"] - 1, 0) for s in spans), "at": now_iso(), "spans": spans}
+        if slow:
+            self.slow += 1
+            logger.warning("slow request " + json.dumps(trace, default=str))
+        else:
+            self.sampled += 1
+        self._buffer.append(trace)
+
+    def recent(self, limit=50, slow_only=False):
+        with self._lock:
+            traces = list(self._buffer)
+        if slow_only:
+            traces = [t for t in traces if t["reason"] == "slow"]
+        return traces[::-1][:limit]
+
+    def stats(self):
+        return {"enabled": TRACE_ENABLED, "slow_ms": TRACE_SLOW_MS, "slow_calls": TRACE_SLOW_CALLS, "sample_percent": TRACE_SAMPLE_PERCENT, "buffered": len(self._buffer), "slow": self.slow, "sampled": self.sampled}
+
+request_tracer = _RequestTracer()
+
+# ------------------------------------------------------------------
+# Request deadline: every Supabase call made while serving one HTTP request
+# shares a single time budget (SUPABASE_REQUEST_BUDGET seconds), so retries
+# can never pin the worker for longer than that. A fan_out call also carries
+# its own deadline (in a context variable, so it does not leak into the
+# caller), which bounds the work it keeps doing after fan_out gave up on it.
+# ------------------------------------------------------------------
+SUPABASE_REQUEST_BUDGET = float(os.environ.get("SUPABASE_REQUEST_BUDGET", 8.0))
+
+_call_deadline = contextvars.ContextVar("call_deadline", default=None)
+
+def start_request_deadline(budget=None):
+    g.supabase_deadline = time.monotonic() + (SUPABASE_REQUEST_BUDGET if budget is None else budget)
+
+def remaining_budget():
+    """Seconds left for Supabase calls in this request (or fan_out call), or None
+    when neither sets a deadline."""
+    deadline = _call_deadline.get()
+    if has_request_context():
+        request_deadline = g.get("supabase_deadline")
+        if request_deadline is not None and (deadline is None or request_deadline < deadline):
+            deadline = request_deadline
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+class _FailedResponse:
+    """Response-like object for calls that never reached (or never got an answer from) Supabase."""
+    def __init__(self, status_code=500, text=""):
+        self.status_code = status_code
+        self.text = text
+        self.headers = {}
+
+    def json(self):
+        return None
+
+# ------------------------------------------------------------------
+# Circuit breaker: after CB_FAILURE_THRESHOLD consecutive failures to reach
+# Supabase, calls fail fast with 503 instead of waiting on timeouts.
+# It is one breaker for all tables on purpose: it models reachability of the
+# Supabase endpoint (it also drives the offline journal), so only network
+# errors and gateway answers (502/503/504) count as failures. Any other
+# answer, a 500 from one broken table included, proves Supabase reachable and
+# cannot trip sales or products. While open, a daemon thread probes Supabase
+# every CB_PROBE_INTERVAL seconds; a healthy probe moves the breaker to
+# half-open, where one real call is let through as a trial (another after
+# CB_TRIAL_TIMEOUT if it never reports back): its success closes the
+# breaker, its failure opens it again.
+# ------------------------------------------------------------------
+CB_FAILURE_THRESHOLD = int(os.environ.get("CB_FAILURE_THRESHOLD", 5))
+CB_PROBE_INTERVAL = float(os.environ.get("CB_PROBE_INTERVAL", 5.0))
+CB_PROBE_TIMEOUT = float(os.environ.get("CB_PROBE_TIMEOUT", 3.0))
+CB_TRIAL_TIMEOUT = float(os.environ.get("CB_TRIAL_TIMEOUT", 15.0))
+
+_UNREACHABLE_STATUSES = (502, 503, 504)
+
+class _CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=CB_FAILURE_THRESHOLD, probe_interval=CB_PROBE_INTERVAL, trial_timeout=CB_TRIAL_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.trial_timeout = trial_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.last_failure = None
+        self.times_opened = 0
+        self.rejected = 0
+        self.trials = 0
+        self._trial_started = None
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.HALF_OPEN:
+            with self._lock:
+                now = time.monotonic()
+                if self.state == self.HALF_OPEN and (self._trial_started is None or now - self._trial_started > self.trial_timeout):
+                    self._trial_started = now
+                    self.trials += 1
+                    return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        if self.consecutive_failures or self.state != self.CLOSED:
+            with self._lock:
+                self.consecutive_failures = 0
+                if self.state != self.CLOSED:
+                    logger.info("circuit breaker closed: Supabase reachable again")
+                self.state = self.CLOSED
+                self.opened_at = None
+                self._trial_started = None
+
+    def record_failure(self, reason=None):
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_failure = str(reason) if reason is not None else None
+            if self.state == self.HALF_OPEN:
+                # the trial call failed
+                self.state = self.OPEN
+                self._trial_started = None
+                logger.warning(f"circuit breaker re-opened: trial call failed ({self.last_failure})")
+            elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = now_iso()
+                self.times_opened += 1
+                logger.warning(f"circuit breaker opened after {self.consecutive_failures} failures ({self.last_failure})")
+            else:
+                return
+            if self._prober is None or not self._prober.is_alive():
+                self._prober = threading.Thread(target=self._probe_loop, name="cb-prober", daemon=True)
+                self._prober.start()
+
+    def probe(self):
+        """One health probe that bypasses the breaker; returns True if Supabase answered.
+        An open breaker goes half-open on a healthy answer; the next real call decides."""
+        try:
+            resp = http_pool.send("get", f"{SUPABASE_URL}/rest/v1/users", headers=SUPABASE_HEADERS, params={"select": "id", "limit": 1}, timeout=CB_PROBE_TIMEOUT)
+            ok = getattr(resp, "status_code", 500) not in _UNREACHABLE_STATUSES
+        except Exception as e:
+            ok = False
+            self.last_failure = str(e)
+        if ok:
+            with self._lock:
+                if self.state == self.OPEN:
+                    self.state = self.HALF_OPEN
+                    self._trial_started = None
+                    logger.info("circuit breaker half-open: letting one call through")
+                if self.state != self.CLOSED:
+                    return ok
+            self.record_success()
+        return ok
+
+    def _probe_loop(self):
+        while self.state == self.OPEN:
+            time.sleep(self.probe_interval)
+            if self.state == self.OPEN:
+                self.probe()
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "opened_at": self.opened_at,
+            "times_opened": self.times_opened,
+            "rejected_calls": self.rejected,
+            "trial_calls": self.trials,
+            "last_failure": self.last_failure,
+        }
+
+circuit_breaker = _CircuitBreaker()
+
 # ------------------------------------------------------------------
 # Safe request wrapper (retries/backoff) that never raises to caller
+# - fails fast while the circuit breaker is open
+# - clamps every attempt's timeout to the request's remaining budget and
+#   skips retries that would not fit in it
 # ------------------------------------------------------------------
 def safe_request(method, url, headers=None, params=None, json_data=None, timeout=10, retries=2, backoff=1.2):
+    if method not in ("get", "post", "patch", "delete"):
+        return None
+    started = time.perf_counter()
+    resp, attempts = _request_with_retries(method, url, headers, params, json_data, timeout, retries, backoff)
+    record_storage_call(_supabase_table(url), method.upper(), getattr(resp, "status_code", None), attempts, started)
+    return resp
+
+def record_storage_call(table, verb, status, attempts, started):
+    """Metrics and request trace for one storage call (started: time.perf_counter())."""
+    try:
+        elapsed = time.perf_counter() - started
+        labels = (("table", table), ("method", verb))
+        metrics.observe("supabase_request_duration_seconds", labels, elapsed)
+        metrics.inc("supabase_requests_total", labels + (("status", status or "none"),))
+        if attempts > 1:
+            metrics.inc("supabase_retries_total", labels, attempts - 1)
+        request_tracer.record(table, verb, status, attempts, started, elapsed)
+    except Exception:
+        pass
+
+def _request_with_retries(method, url, headers, params, json_data, timeout, retries, backoff):
+    """The retry loop behind safe_request; returns (response, attempts made)."""
+    if not circuit_breaker.allow():
+        return _FailedResponse(503, "circuit open"), 0
     last_resp = None
     last_exc = None
+    attempt = 0
     for attempt in range(1, retries + 1):
+        remaining = remaining_budget()
+        if remaining is not None and remaining <= 0:
+            attempt -= 1
+            break
         try:
-            if _HAS_REQUESTS:
-                if method == "get":
-                    resp = requests.get(url, headers=headers, params=params, timeout=timeout)
-                elif method == "post":
-                    resp = requests.post(url, headers=headers, json=json_data, timeout=timeout)
-                elif method == "patch":
-                    resp = requests.patch(url, headers=headers, params=params, json=json_data, timeout=timeout)
-                elif method == "delete":
-                    resp = requests.delete(url, headers=headers, params=params, timeout=timeout)
-                else:
-                    return None
-            else:
-                if method == "get":
-                    resp = requests_get(url, headers=headers, params=params, timeout=timeout)
-                elif method == "post":
-                    resp = requests_post(url, headers=headers, json=json_data, timeout=timeout)
-                elif method == "patch":
-                    resp = requests_patch(url, headers=headers, params=params, json=json_data, timeout=timeout)
-                elif method == "delete":
-                    resp = requests_delete(url, headers=headers, params=params, timeout=timeout)
-                else:
-                    return None
-
+            attempt_timeout = timeout if remaining is None else min(timeout, remaining)
+            resp = http_pool.send(method, url, headers=headers, params=params, json_data=json_data, timeout=attempt_timeout)
             last_resp = resp
             status = getattr(resp, "status_code", None)
             if status is None:
-                return resp
-            if status < 400:
-                return resp
-            # if client error (4xx) do not retry
-            if 400 <= status < 500:
-                return resp
+                return resp, attempt
+            if status < 500:
+                # success or client error (4xx): do not retry
+                circuit_breaker.record_success()
+                return resp, attempt
             # else server error: retry
             last_exc = Exception(f"HTTP {status}")
         except Exception as e:
             last_exc = e
+            status = None
             # continue to retry
-        # backoff wait
+        if status is not None and status not in _UNREACHABLE_STATUSES:
+            # Supabase answered; the error is this call's, not an outage
+            circuit_breaker.record_success()
+        else:
+            circuit_breaker.record_failure(last_exc)
+        if attempt == retries or not circuit_breaker.allow():
+            break
+        # backoff wait, only if a retry still fits in the budget
+        wait = backoff * attempt
+        remaining = remaining_budget()
+        if remaining is not None and remaining <= wait:
+            break
         try:
-            time.sleep(backoff * attempt)
+            time.sleep(wait)
         except Exception:
             pass
     # final: return last_resp if exists, else a constructed response-like object
     if last_resp is not None:
-        return last_resp
-    class _Fake:
-        status_code = 500
-        text = ""
-        def json(self):
-            return None
-    return _Fake()
+        return last_resp, attempt
+    if remaining_budget() is not None and remaining_budget() <= 0:
+        return _FailedResponse(504, "request budget exhausted"), attempt
+    return _FailedResponse(500, str(last_exc) if last_exc else ""), attempt
 
 # ------------------------------------------------------------------
-# Supabase helpers: guaranteed to return safe results (never raise)
-# - get returns (list_or_none, status_int)
-# - post/patch/delete return (result_or_none, status_int)
+# Storage backends. All data access goes through supabase_get / post /
+# patch / delete / post_many and adjust_stock, which delegate to `storage`:
+# - _PostgrestBackend (default): the Supabase REST API over http_pool
+# - _SQLiteBackend: an embedded SQLite database for single-store installs
+# Both implement query / insert / insert_many / patch / delete / increment /
+# rpc / ping / stats and take the same PostgREST-style params, so callers
+# are backend-agnostic. STORAGE_BACKEND=postgrest|sqlite selects one.
+# Results are never raised: query returns (list, status), writes return
+# (result_or_none, status).
 # ------------------------------------------------------------------
-def supabase_get(table, params=None, headers=None, timeout=10):
-    try:
-        if headers is None:
-            headers = SUPABASE_HEADERS
-        url = f"{SUPABASE_URL}/rest/v1/{table}"
-        resp = safe_request("get", url, headers=headers, params=params, timeout=timeout)
-        status = getattr(resp, "status_code", None)
-        if status is None:
-            data = getattr(resp, "json", lambda: None)()
-            return data if data is not None else [], 200
-        if status >= 400:
-            logger.debug(f"supabase_get {table} returned {status}; returning empty list")
-            return [], status
-        try:
-            return resp.json(), status
-        except Exception:
-            return [], status
-    except Exception as e:
-        logger.debug(f"supabase_get exception for {table}: {e}")
-        return [], 500
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgrest").strip().lower()
 
-def supabase_post(table, data, headers=None, timeout=10):
-    try:
-        if headers is None:
-            headers = SUPABASE_HEADERS
-        url = f"{SUPABASE_URL}/rest/v1/{table}"
-        resp = safe_request("post", url, headers=headers, json_data=data, timeout=timeout)
-        status = getattr(resp, "status_code", None)
-        if status is None:
+class _PostgrestBackend:
+    name = "postgrest"
+
+    def query(self, table, params=None, headers=None, timeout=10):
+        try:
+            if headers is None:
+                headers = SUPABASE_HEADERS
+            url = f"{SUPABASE_URL}/rest/v1/{table}"
+            resp = safe_request("get", url, headers=headers, params=params, timeout=timeout)
+            status = getattr(resp, "status_code", None)
+            if status is None:
+                data = getattr(resp, "json", lambda: None)()
+                return data if data is not None else [], 200
+            if status >= 400:
+                logger.debug(f"supabase_get {table} returned {status}; returning empty list")
+                return [], status
             try:
-                return resp.json(), 200
+                return resp.json(), status
             except Exception:
-                return {}, 200
-        if status >= 400:
-            logger.debug(f"supabase_post {table} returned {status}; returning None")
-            return None, status
-        try:
-            return resp.json(), status
-        except Exception:
-            return {}, status
-    except Exception as e:
-        logger.debug(f"supabase_post exception for {table}: {e}")
-        return None, 500
+                return [], status
+        except Exception as e:
+            logger.debug(f"supabase_get exception for {table}: {e}")
+            return [], 500
 
-def supabase_patch(table, filters, data, headers=None, timeout=10):
-    try:
-        if headers is None:
-            headers = SUPABASE_HEADERS
-        url = f"{SUPABASE_URL}/rest/v1/{table}"
-        resp = safe_request("patch", url, headers=headers, params=filters, json_data=data, timeout=timeout)
-        status = getattr(resp, "status_code", None)
-        if status is None:
+    def insert(self, table, data, headers=None, timeout=10, params=None, prefer=None):
+        try:
+            if headers is None:
+                headers = SUPABASE_HEADERS
+            if prefer:
+                headers = dict(headers, Prefer=prefer)
+            url = f"{SUPABASE_URL}/rest/v1/{table}"
+            resp = safe_request("post", url, headers=headers, params=params, json_data=data, timeout=timeout)
+            status = getattr(resp, "status_code", None)
+            if status is None:
+                try:
+                    return resp.json(), 200
+                except Exception:
+                    return {}, 200
+            if status >= 400:
+                logger.debug(f"supabase_post {table} returned {status}; returning None")
+                return None, status
             try:
-                return resp.json(), 200
+                return resp.json(), status
             except Exception:
-                return {}, 200
-        if status >= 400:
-            logger.debug(f"supabase_patch {table} returned {status}; returning None")
-            return None, status
+                return {}, status
+        except Exception as e:
+            logger.debug(f"supabase_post exception for {table}: {e}")
+            return None, 500
+
+    def patch(self, table, filters, data, headers=None, timeout=10, prefer=None):
         try:
-            return resp.json(), status
-        except Exception:
-            return {}, status
-    except Exception as e:
-        logger.debug(f"supabase_patch exception for {table}: {e}")
-        return None, 500
+            if headers is None:
+                headers = SUPABASE_HEADERS
+            if prefer:
+                headers = dict(headers, Prefer=prefer)
+            url = f"{SUPABASE_URL}/rest/v1/{table}"
+            resp = safe_request("patch", url, headers=headers, params=filters, json_data=data, timeout=timeout)
+            status = getattr(resp, "status_code", None)
+            if status is None:
+                try:
+                    return resp.json(), 200
+                except Exception:
+                    return {}, 200
+            if status >= 400:
+                logger.debug(f"supabase_patch {table} returned {status}; returning None")
+                return None, status
+            try:
+                return resp.json(), status
+            except Exception:
+                return {}, status
+        except Exception as e:
+            logger.debug(f"supabase_patch exception for {table}: {e}")
+            return None, 500
 
-def supabase_delete(table, filters, headers=None, timeout=10):
-    try:
-        if headers is None:
-            headers = SUPABASE_HEADERS
-        url = f"{SUPABASE_URL}/rest/v1/{table}"
-        resp = safe_request("delete", url, headers=headers, params=filters, timeout=timeout)
-        status = getattr(resp, "status_code", None)
-        if status is None:
+    def delete(self, table, filters, headers=None, timeout=10):
+        try:
+            if headers is None:
+                headers = SUPABASE_HEADERS
+            url = f"{SUPABASE_URL}/rest/v1/{table}"
+            resp = safe_request("delete", url, headers=headers, params=filters, timeout=timeout)
+            status = getattr(resp, "status_code", None)
+            if status is None:
+                try:
+                    return resp.json(), 200
+                except Exception:
+                    return {}, 200
+            if status >= 400:
+                logger.debug(f"supabase_delete {table} returned {status}; returning None")
+                return None, status
             try:
-                return resp.json(), 200
+                return resp.json(), status
             except Exception:
-                return {}, 200
+                return {}, status
+        except Exception as e:
+            logger.debug(f"supabase_delete exception for {table}: {e}")
+            return None, 500
+
+    def insert_many(self, table, rows, prefer=None, params=None):
+        """Insert a list of rows as JSON array POSTs.
+        PostgREST requires every object in one array to carry the same keys, so rows
+        are grouped by key set (normally a single group). Returns (created_rows, status)."""
+        if not rows:
+            return [], 200
+        groups = {}
+        for r in rows:
+            groups.setdefault(tuple(sorted(r.keys())), []).append(r)
+        created = []
+        status = 200
+        for group in groups.values():
+            res, st = self.insert(table, group, params=params, prefer=prefer)
+            if st >= 400:
+                status = st
+            if isinstance(res, list):
+                created.extend(res)
+        return created, status
+
+    def rpc(self, fn, payload, headers=None, timeout=10):
+        return self.insert(f"rpc/{fn}", payload, headers=headers, timeout=timeout)
+
+    def increment(self, table, key, column, deltas):
+        """Atomically add {key_value: delta} to column (floored at 0); (updated_rows, status).
+        Only products.quantity is supported, through the adjust_stock RPC (db/adjust_stock.sql);
+        404 means the RPC is not installed."""
+        if (table, key, column) != ("products", "barcode", "quantity"):
+            return None, 404
+        return self.rpc("adjust_stock", {"deltas": [{"barcode": b, "delta": d} for b, d in deltas.items()]})
+
+    def ping(self):
+        return circuit_breaker.probe()
+
+    def stats(self):
+        return {"backend": self.name, "url": SUPABASE_URL}
+
+# ------------------------------------------------------------------
+# Embedded SQLite backend (STORAGE_BACKEND=sqlite, file SQLITE_PATH) for a
+# single shop: no WAN round trip per scan. One connection per thread in WAL
+# mode (readers never block the writer), statements are parameterised with
+# stable SQL text so sqlite3's statement cache reuses the prepared plans,
+# and writes run in BEGIN IMMEDIATE transactions. It interprets the
+# PostgREST params the app sends: column filters (eq, neq, gt, gte, lt, lte,
+# like, ilike, is, in, not.*), or=()/and=() groups, select, order (with
+# nullsfirst/nullslast), limit/offset, Range headers, on_conflict with
+# merge-/ignore-duplicates and Prefer return=representation. Columns that
+# a write introduces are added on the fly.
+# ------------------------------------------------------------------
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "tekel_pos.db")
+
+_SQLITE_SCHEMA = {
+    "users": (("username", "TEXT"), ("password", "TEXT"), ("full_name", "TEXT"), ("role", "TEXT"), ("created_at", "TEXT"), ("last_login", "TEXT")),
+    "products": (("barcode", "TEXT"), ("name", "TEXT"), ("price", "REAL"), ("quantity", "INTEGER"), ("kdv", "REAL"), ("otv", "REAL"), ("min_stock_level", "INTEGER"), ("created_at", "TEXT"), ("updated_at", "TEXT")),
+    "sales": (("total_amount", "REAL"), ("payment_method", "TEXT"), ("cash_amount", "REAL"), ("credit_card_amount", "REAL"), ("change_amount", "REAL"), ("user_id", "INTEGER"), ("sale_date", "TEXT")),
+    "sale_items": (("sale_id", "INTEGER"), ("barcode", "TEXT"), ("product_name", "TEXT"), ("quantity", "INTEGER"), ("price", "REAL")),
+    "stock_movements": (("barcode", "TEXT"), ("product_name", "TEXT"), ("movement_type", "TEXT"), ("quantity", "INTEGER"), ("user_id", "INTEGER"), ("movement_date", "TEXT")),
+    "cash_register": (("is_open", "BOOLEAN"), ("current_amount", "REAL"), ("opening_balance", "REAL"), ("opening_time", "TEXT"), ("closing_time", "TEXT"), ("last_updated", "TEXT")),
+    "cash_transactions": (("transaction_type", "TEXT"), ("amount", "REAL"), ("user_id", "INTEGER"), ("transaction_date", "TEXT"), ("description", "TEXT")),
+    "audit_logs": (("user_id", "INTEGER"), ("action", "TEXT"), ("description", "TEXT"), ("created_at", "TEXT")),
+}
+_SQLITE_INDEXES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_products_barcode ON products (barcode)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_sale_date ON sales (sale_date)",
+    "CREATE INDEX IF NOT EXISTS idx_sale_items_sale_id ON sale_items (sale_id)",
+    "CREATE INDEX IF NOT EXISTS idx_sale_items_barcode ON sale_items (barcode)",
+    "CREATE INDEX IF NOT EXISTS idx_stock_movements_barcode ON stock_movements (barcode)",
+    "CREATE INDEX IF NOT EXISTS idx_stock_movements_date ON stock_movements (movement_date)",
+    "CREATE INDEX IF NOT EXISTS idx_cash_transactions_date ON cash_transactions (transaction_date)",
+)
+_SQL_IDENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_SQL_OPS = {"eq": "=", "neq": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+_PG_RESERVED = ("select", "order", "limit", "offset", "on_conflict", "columns")
+
+class _StorageError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _pg_split(text):
+    """Split a PostgREST list on top-level commas, honouring "quoted" values and parentheses."""
+    out, cur, depth, quoted, escaped = [], [], 0, False, False
+    for ch in text:
+        if escaped:
+            cur.append(ch)
+            escaped = False
+        elif quoted and ch == "\\":
+            escaped = True
+        elif ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+            cur.append(ch)
+        elif not quoted and ch == ")":
+            depth -= 1
+            cur.append(ch)
+        elif not quoted and depth == 0 and ch == ",":
+            out.append("".join(cur))
+            cur = []
+        else:
+            cur.append(ch)
+    if cur or out:
+        out.append("".join(cur))
+    return out
+
+class _SQLiteBackend:
+    name = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._columns = {}
+        self._ready = False
+        self.calls = 0
+        self.errors = 0
+
+    # -- connection and schema ------------------------------------------
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0, isolation_level=None, check_same_thread=False, cached_statements=512)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+            if not self._ready:
+                self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self._lock:
+            if self._ready:
+                return
+            for table, cols in _SQLITE_SCHEMA.items():
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT, " + ", ".join(f"{c} {t}" for c, t in cols) + ")")
+                existing = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+                for c, t in cols:
+                    if c not in existing:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN {c} {t}")
+            for stmt in _SQLITE_INDEXES:
+                conn.execute(stmt)
+            self._load_columns(conn)
+            self._ready = True
+
+    def _load_columns(self, conn):
+        columns = {}
+        for (table,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall():
+            columns[table] = {r[1]: (r[2] or "").upper() for r in conn.execute(f"PRAGMA table_info({table})")}
+        self._columns = columns
+
+    def _table(self, table):
+        if not _SQL_IDENT.match(table or "") or table not in self._columns:
+            raise _StorageError(404, f"relation {table} does not exist")
+        return table
+
+    def _column(self, table, col):
+        if col not in self._columns.get(table, ()):
+            raise _StorageError(400, f"column {table}.{col} does not exist")
+        return col
+
+    @staticmethod
+    def _sql_type(value):
+        if isinstance(value, bool):
+            return "BOOLEAN"
+        if isinstance(value, int):
+            return "INTEGER"
+        if isinstance(value, float):
+            return "REAL"
+        return "TEXT"
+
+    def _ensure_columns(self, conn, table, rows):
+        """Add columns that the rows being written introduce to one of the
+        _SQLITE_SCHEMA tables; any other table is a 404, as on reads."""
+        if table not in _SQLITE_SCHEMA:
+            raise _StorageError(404, f"relation {table} does not exist")
+        known = self._columns.get(table)
+        missing = {}
+        for row in rows:
+            for col, value in row.items():
+                if (known is None or col not in known) and col not in missing:
+                    if not _SQL_IDENT.match(col):
+                        raise _StorageError(400, f"invalid column name {col!r}")
+                    missing[col] = self._sql_type(value)
+        if not missing and known is not None:
+            return
+        with self._lock:
+            if table not in self._columns:
+                conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY AUTOINCREMENT)")
+            existing = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+            for col, sql_type in missing.items():
+                if col not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {sql_type}")
+            self._load_columns(conn)
+
+    # -- PostgREST params -> SQL ----------------------------------------
+    def _value(self, table, col, raw):
+        if self._columns[table].get(col) == "BOOLEAN" and raw in ("true", "false"):
+            return 1 if raw == "true" else 0
+        return raw
+
+    def _condition(self, table, col, expr):
+        col = self._column(table, col)
+        negate = expr.startswith("not.")
+        if negate:
+            expr = expr[4:]
+        op, _, arg = expr.partition(".")
+        if op in _SQL_OPS:
+            sql, args = f"{col} {_SQL_OPS[op]} ?", [self._value(table, col, arg)]
+        elif op == "like":
+            sql, args = f"{col} GLOB ?", [arg.replace("%", "*")]
+        elif op == "ilike":
+            sql, args = f"LOWER({col}) LIKE LOWER(?)", [arg.replace("*", "%")]
+        elif op == "is":
+            if arg == "null":
+                sql, args = f"{col} IS NULL", []
+            elif arg in ("true", "false"):
+                sql, args = f"{col} = ?", [1 if arg == "true" else 0]
+            else:
+                raise _StorageError(400, f"invalid is. value {arg!r}")
+        elif op == "in":
+            values = _pg_split(arg[1:-1]) if arg.startswith("(") and arg.endswith(")") else []
+            if not values:
+                sql, args = "0", []
+            else:
+                sql, args = f"{col} IN ({','.join('?' * len(values))})", [self._value(table, col, v) for v in values]
+        else:
+            raise _StorageError(400, f"unsupported operator {op!r}")
+        return (f"NOT ({sql})" if negate else sql), args
+
+    def _group(self, table, kind, inner):
+        parts, args = [], []
+        for item in _pg_split(inner):
+            if item.startswith(("and(", "or(")) and item.endswith(")"):
+                nested_kind, _, nested = item.partition("(")
+                sql, a = self._group(table, nested_kind, nested[:-1])
+            else:
+                col, _, expr = item.partition(".")
+                sql, a = self._condition(table, col, expr)
+            parts.append(sql)
+            args.extend(a)
+        if not parts:
+            return "1", []
+        return "(" + (" OR " if kind == "or" else " AND ").join(parts) + ")", args
+
+    def _where(self, table, params):
+        clauses, args = [], []
+        for key, value in (params.items() if isinstance(params, dict) else params or ()):
+            if key in _PG_RESERVED:
+                continue
+            value = str(value)
+            if key in ("or", "and"):
+                sql, a = self._group(table, key, value[1:-1])
+            else:
+                sql, a = self._condition(table, key, value)
+            clauses.append(sql)
+            args.extend(a)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", args
+
+    def _order(self, table, spec):
+        terms = []
+        for item in str(spec).split(","):
+            parts = item.strip().split(".")
+            col = self._column(table, parts[0])
+            desc = "desc" in parts[1:]
+            nulls_first = "nullsfirst" in parts[1:] or (desc and "nullslast" not in parts[1:])
+            terms.append(f"{col} {'DESC' if desc else 'ASC'} NULLS {'FIRST' if nulls_first else 'LAST'}")
+        return " ORDER BY " + ", ".join(terms)
+
+    def _rows(self, table, cursor):
+        # RETURNING yields values before column affinity is applied, so REAL
+        # columns are coerced here too
+        columns = self._columns.get(table, {})
+        booleans = [c for c, t in columns.items() if t == "BOOLEAN"]
+        reals = [c for c, t in columns.items() if t == "REAL"]
+        out = []
+        for row in cursor:
+            d = dict(row)
+            for c in booleans:
+                if d.get(c) is not None:
+                    d[c] = bool(d[c])
+            for c in reals:
+                if type(d.get(c)) is int:
+                    d[c] = float(d[c])
+            out.append(d)
+        return out
+
+    @staticmethod
+    def _adapt(value):
+        return json.dumps(value) if isinstance(value, (dict, list)) else value
+
+    @staticmethod
+    def _prefer(headers, prefer):
+        return " ".join(p for p in (prefer, (headers or {}).get("Prefer")) if p)
+
+    # -- call plumbing --------------------------------------------------
+    def _call(self, table, verb, fn, failed):
+        started = time.perf_counter()
+        self.calls += 1
+        try:
+            result, status = fn(self._conn())
+        except _StorageError as e:
+            logger.debug(f"sqlite {verb} {table}: {e}")
+            result, status = failed, e.status
+        except sqlite3.IntegrityError as e:
+            logger.debug(f"sqlite {verb} {table} conflict: {e}")
+            result, status = failed, 409
+        except sqlite3.OperationalError as e:
+            logger.debug(f"sqlite {verb} {table} failed: {e}")
+            result, status = failed, 503 if "locked" in str(e) else 400
+        except Exception as e:
+            logger.debug(f"sqlite {verb} {table} exception: {e}")
+            result, status = failed, 500
         if status >= 400:
-            logger.debug(f"supabase_delete {table} returned {status}; returning None")
-            return None, status
+            self.errors += 1
+        record_storage_call(table, verb, status, 1, started)
+        return result, status
+
+    def _write(self, conn, statements):
+        """Run statements(conn) inside one IMMEDIATE transaction."""
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            return resp.json(), status
-        except Exception:
-            return {}, status
-    except Exception as e:
-        logger.debug(f"supabase_delete exception for {table}: {e}")
-        return None, 500
+            result = statements(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    # -- backend interface ----------------------------------------------
+    def query(self, table, params=None, headers=None, timeout=10):
+        def run(conn):
+            t = self._table(table)
+            opts = params if isinstance(params, dict) else dict(params or ())
+            select = opts.get("select", "*") or "*"
+            cols = "*" if select == "*" else ", ".join(self._column(t, c.strip()) for c in select.split(","))
+            where, args = self._where(t, opts)
+            sql = f"SELECT {cols} FROM {t}{where}"
+            if opts.get("order"):
+                sql += self._order(t, opts["order"])
+            limit, offset = opts.get("limit"), opts.get("offset")
+            rng = (headers or {}).get("Range")
+            if rng:
+                first, _, last = rng.partition("-")
+                offset, limit = int(first), int(last) - int(first) + 1
+            if limit is not None or offset is not None:
+                sql += " LIMIT ? OFFSET ?"
+                args += [int(limit) if limit is not None else -1, int(offset or 0)]
+            return self._rows(t, conn.execute(sql, args)), 200
+        return self._call(table, "GET", run, [])
+
+    def insert(self, table, data, headers=None, timeout=10, params=None, prefer=None):
+        if table.startswith("rpc/"):
+            return self.rpc(table[4:], data)
+        rows = data if isinstance(data, list) else [data]
+        prefer = self._prefer(headers, prefer)
+        conflict = (params or {}).get("on_conflict")
+
+        def run(conn):
+            if not rows:
+                return [], 201
+            self._ensure_columns(conn, table, rows)
+            t = self._table(table)
+            if conflict:
+                self._column(t, conflict)
+
+            def statements(conn):
+                out = []
+                for row in rows:
+                    cols = [self._column(t, c) for c in row]
+                    sql = f"INSERT INTO {t} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+                    if conflict and "ignore-duplicates" in prefer:
+                        sql += f" ON CONFLICT ({conflict}) DO NOTHING"
+                    elif conflict:
+                        updates = [c for c in cols if c != conflict] or [conflict]
+                        sql += f" ON CONFLICT ({conflict}) DO UPDATE SET " + ", ".join(f"{c} = excluded.{c}" for c in updates)
+                    out.extend(self._rows(t, conn.execute(sql + " RETURNING *", [self._adapt(row[c]) for c in cols])))
+                return out
+            created = self._write(conn, statements)
+            return (created if "return=representation" in prefer else {}), 201
+        return self._call(table, "POST", run, None)
+
+    def insert_many(self, table, rows, prefer=None, params=None):
+        if not rows:
+            return [], 200
+        res, st = self.insert(table, list(rows), params=params, prefer=prefer)
+        return (res if isinstance(res, list) else []), st
+
+    def patch(self, table, filters, data, headers=None, timeout=10, prefer=None):
+        prefer = self._prefer(headers, prefer)
+
+        def run(conn):
+            if not data:
+                return [], 200
+            self._ensure_columns(conn, table, [data])
+            t = self._table(table)
+            cols = [self._column(t, c) for c in data]
+            where, args = self._where(t, filters)
+            sql = f"UPDATE {t} SET {', '.join(f'{c} = ?' for c in cols)}{where} RETURNING *"
+            updated = self._write(conn, lambda c: self._rows(t, c.execute(sql, [self._adapt(data[k]) for k in data] + args)))
+            if "return=representation" in prefer:
+                return updated, 200
+            return {}, 204
+        return self._call(table, "PATCH", run, None)
+
+    def delete(self, table, filters, headers=None, timeout=10):
+        prefer = self._prefer(headers, None)
+
+        def run(conn):
+            t = self._table(table)
+            where, args = self._where(t, filters)
+            deleted = self._write(conn, lambda c: self._rows(t, c.execute(f"DELETE FROM {t}{where} RETURNING *", args)))
+            if "return=representation" in prefer:
+                return deleted, 200
+            return {}, 204
+        return self._call(table, "DELETE", run, None)
+
+    def increment(self, table, key, column, deltas):
+        """Atomically add {key_value: delta} to column, floored at 0; (updated_rows, status)."""
+        def run(conn):
+            t = self._table(table)
+            k, c = self._column(t, key), self._column(t, column)
+            sql = f"UPDATE {t} SET {c} = MAX(COALESCE({c}, 0) + ?, 0) WHERE {k} = ? RETURNING *"
+
+            def statements(conn):
+                out = []
+                for value, delta in deltas.items():
+                    out.extend(self._rows(t, conn.execute(sql, (int(delta), str(value)))))
+                return out
+            return self._write(conn, statements), 200
+        return self._call(table, "RPC", run, None)
+
+    def rpc(self, fn, payload, headers=None, timeout=10):
+        if fn == "adjust_stock":
+            deltas = {}
+            for d in (payload or {}).get("deltas", []):
+                deltas[str(d.get("barcode"))] = deltas.get(str(d.get("barcode")), 0) + int(d.get("delta") or 0)
+            return self.increment("products", "barcode", "quantity", deltas)
+        return None, 404
+
+    def ping(self):
+        try:
+            self._conn().execute("SELECT 1").fetchone()
+            return True
+        except Exception as e:
+            logger.debug(f"sqlite ping failed: {e}")
+            return False
+
+    def stats(self):
+        return {"backend": self.name, "path": self.path, "calls": self.calls, "errors": self.errors}
+
+def _make_storage(name):
+    if name == "sqlite":
+        return _SQLiteBackend()
+    if name != "postgrest":
+        logger.warning(f"Unknown STORAGE_BACKEND {name!r}; using postgrest")
+    return _PostgrestBackend()
+
+storage = _make_storage(STORAGE_BACKEND)
+
+# ------------------------------------------------------------------
+# Supabase helpers: guaranteed to return safe results (never raise); they
+# run against the configured storage backend
+# - get returns (list_or_none, status_int)
+# - post/patch/delete return (result_or_none, status_int)
+# ------------------------------------------------------------------
+def supabase_get(table, params=None, headers=None, timeout=10):
+    return storage.query(table, params=params, headers=headers, timeout=timeout)
+
+def supabase_post(table, data, headers=None, timeout=10, params=None, prefer=None):
+    return storage.insert(table, data, headers=headers, timeout=timeout, params=params, prefer=prefer)
+
+def supabase_patch(table, filters, data, headers=None, timeout=10, prefer=None):
+    return storage.patch(table, filters, data, headers=headers, timeout=timeout, prefer=prefer)
+
+def supabase_delete(table, filters, headers=None, timeout=10):
+    return storage.delete(table, filters, headers=headers, timeout=timeout)
 
 # ------------------------------------------------------------------
 # Helper: build filters for PostgREST
@@ -310,12 +1407,1418 @@ def build_filters(d):
         return {}
     params = {}
     for k, v in d.items():
-        if isinstance(v, str) and any(v.startswith(pref) for pref in ("eq.", "lt.", "gt.", "lte.", "gte.", "like.", "ilike.", "neq.")):
+        if isinstance(v, str) and any(v.startswith(pref) for pref in ("eq.", "lt.", "gt.", "lte.", "gte.", "like.", "ilike.", "neq.", "in.", "is.")):
             params[k] = v
         else:
             params[k] = f"eq.{v}"
     return params
 
+def pg_in(values):
+    """Render a PostgREST in.(...) filter, quoting every value."""
+    quoted = []
+    for v in values:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"')
+        quoted.append(f'"{v}"')
+    return "in.(" + ",".join(quoted) + ")"
+
+# ------------------------------------------------------------------
+# Bulk helpers: one round trip per batch instead of one per row
+# ------------------------------------------------------------------
+BULK_IN_CHUNK = int(os.environ.get("BULK_IN_CHUNK", 200))
+
+def fetch_products_by_barcode(barcodes):
+    """({barcode: product_row}, status) for the given barcodes using barcode=in.(...) reads.
+    status is the first failing read's (>= 400) or 200; on a failure a barcode missing
+    from the result may still exist."""
+    found = {}
+    status = 200
+    unique = [b for b in dict.fromkeys(str(b) for b in barcodes if b not in (None, ""))]
+    for i in range(0, len(unique), BULK_IN_CHUNK):
+        chunk = unique[i:i + BULK_IN_CHUNK]
+        rows, st = supabase_get("products", params={"barcode": pg_in(chunk)})
+        if st >= 400 or not isinstance(rows, list):
+            if status < 400:
+                status = st if st >= 400 else 500
+            continue
+        for r in rows:
+            found[str(r.get("barcode"))] = r
+    return found, status
+
+def supabase_post_many(table, rows, prefer=None, params=None):
+    """Insert a list of rows in as few calls as the backend allows. Returns (created_rows, status)."""
+    if not rows:
+        return [], 200
+    return storage.insert_many(table, rows, prefer=prefer, params=params)
+
+# ------------------------------------------------------------------
+# Parallel fan-out for independent reads within one request.
+# Calls run on a bounded shared pool (FANOUT_WORKERS); each call runs in a
+# copy of the caller's contextvars, so flask.request, g and the request's
+# Supabase deadline are visible inside it. Nested fan-outs run inline to
+# avoid starving the pool. Every call has its own timeout (one value for
+# all, or one per call); its Supabase requests are clamped to it, so a call
+# fan_out stopped waiting for does not hold a pool thread much longer, and
+# calls still queued at their deadline are cancelled.
+# ------------------------------------------------------------------
+FANOUT_WORKERS = int(os.environ.get("FANOUT_WORKERS", 8))
+FANOUT_TIMEOUT = float(os.environ.get("FANOUT_TIMEOUT", 10.0))
+
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+_fanout_local = threading.local()
+
+def _fanout_call(fn, deadline, pooled=True):
+    _call_deadline.set(deadline)
+    if not pooled:
+        return fn()
+    _fanout_local.active = True
+    try:
+        return fn()
+    finally:
+        _fanout_local.active = False
+
+def fan_out(*calls, timeout=None, default=None):
+    """Run zero-argument callables concurrently and return their results in order.
+    timeout is seconds per call (default FANOUT_TIMEOUT), or a list with one value
+    per call; each is capped by the request's remaining budget. A call that raises
+    or does not finish within its timeout yields default instead."""
+    timeouts = list(timeout) if isinstance(timeout, (list, tuple)) else [timeout] * len(calls)
+    remaining = remaining_budget()
+    now = time.monotonic()
+    deadlines = []
+    for t in timeouts:
+        t = FANOUT_TIMEOUT if t is None else t
+        if remaining is not None:
+            t = min(t, remaining)
+        deadlines.append(now + max(t, 0))
+    if len(calls) <= 1 or getattr(_fanout_local, "active", False):
+        results = []
+        for fn, deadline in zip(calls, deadlines):
+            try:
+                results.append(contextvars.copy_context().run(_fanout_call, fn, deadline, False))
+            except Exception as e:
+                logger.debug(f"fan_out call failed: {e}")
+                results.append(default)
+        return results
+    futures = [_fanout_pool.submit(contextvars.copy_context().run, _fanout_call, fn, deadline) for fn, deadline in zip(calls, deadlines)]
+    results = []
+    for fut, deadline in zip(futures, deadlines):
+        _wait_futures([fut], timeout=max(deadline - time.monotonic(), 0))
+        if not fut.done():
+            # still queued: drop it; running: its requests stop at the deadline
+            fut.cancel()
+            logger.debug("fan_out call timed out")
+            results.append(default)
+            continue
+        try:
+            results.append(fut.result())
+        except Exception as e:
+            logger.debug(f"fan_out call failed: {e}")
+            results.append(default)
+    return results
+
+# ------------------------------------------------------------------
+# Paging: keyset cursors on (sort key, id) and Range-header page iteration.
+# Cursors are opaque urlsafe-base64 JSON of the last row's [sort key, id].
+# ------------------------------------------------------------------
+PAGE_SIZE = int(os.environ.get("PAGE_SIZE", 500))
+MAX_PAGE_LIMIT = int(os.environ.get("MAX_PAGE_LIMIT", 1000))
+
+def encode_cursor(row, key="sale_date"):
+    raw = json.dumps([row.get(key), row.get("id")], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Return (sort_value, id) or None if the cursor is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        value, row_id = json.loads(raw)
+        return value, int(row_id)
+    except Exception:
+        return None
+
+def keyset_filter(position, key="sale_date", descending=True):
+    """PostgREST or=(...) filter selecting rows strictly after position in (key, id) order."""
+    value, row_id = position
+    op = "lt" if descending else "gt"
+    value = str(value).replace('"', '\\"')
+    return f'({key}.{op}."{value}",and({key}.eq."{value}",id.{op}.{row_id}))'
+
+def parse_limit(raw, default=100, maximum=MAX_PAGE_LIMIT):
+    try:
+        limit = int(raw)
+    except Exception:
+        return default
+    return max(1, min(limit, maximum))
+
+def supabase_iter(table, params=None, page_size=PAGE_SIZE, key=None, descending=True, max_rows=None, state=None):
+    """Yield rows page by page using Range headers.
+    With key set, pages advance by keyset on (key, id) (each page is Range 0-n),
+    so late pages cost the same as the first; otherwise Range offsets are used.
+    Every page gets a fresh request budget, so long streams are not cut off.
+    A failing page ends the iteration; state (a dict), if given, then gets
+    "truncated": True."""
+    params = dict(params or {})
+    if state is not None:
+        state["truncated"] = False
+    position = None
+    offset = 0
+    sent = 0
+    if key:
+        direction = "desc" if descending else "asc"
+        params["order"] = f"{key}.{direction},id.{direction}"
+    while True:
+        size = page_size if max_rows is None else min(page_size, max_rows - sent)
+        if size <= 0:
+            return
+        page_params = dict(params)
+        if key and position is not None:
+            page_params["or"] = keyset_filter(position, key, descending)
+            start = 0
+        else:
+            start = offset
+        headers = dict(SUPABASE_HEADERS, **{"Range-Unit": "items", "Range": f"{start}-{start + size - 1}"})
+        if has_request_context():
+            start_request_deadline()
+        rows, st = supabase_get(table, params=page_params, headers=headers)
+        if st >= 400 or not isinstance(rows, list):
+            logger.debug(f"supabase_iter {table} stopped on HTTP {st}")
+            if state is not None:
+                state["truncated"] = True
+            return
+        for row in rows:
+            yield row
+        sent += len(rows)
+        if len(rows) < size:
+            return
+        offset += len(rows)
+        if key:
+            position = (rows[-1].get(key), rows[-1].get("id"))
+
+def stream_json_list(key, rows, extra=None):
+    """Stream {"status": "success", <key>: [rows...], **extra} without materialising rows.
+    extra is read after the last row, so the row iterator may still fill it in."""
+    def generate():
+        yield '{"status":"success","' + key + '":['
+        first = True
+        try:
+            for row in rows:
+                yield ("" if first else ",") + app.json.dumps(row)
+                first = False
+        except Exception as e:
+            logger.debug(f"stream_json_list {key} aborted: {e}")
+        tail = "]"
+        for k, v in (extra or {}).items():
+            tail += "," + app.json.dumps(k) + ":" + app.json.dumps(v)
+        yield tail + "}"
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+def _keyset_page(table, params, cursor, limit, key="sale_date"):
+    """(rows, next cursor or None on the last page, status) for one keyset page."""
+    params = dict(params, order=f"{key}.desc,id.desc", limit=limit)
+    position = decode_cursor(cursor)
+    if position is not None:
+        params["or"] = keyset_filter(position, key)
+    rows, st = supabase_get(table, params=params)
+    if not isinstance(rows, list):
+        rows = []
+        st = st if st >= 400 else 500
+    next_cursor = encode_cursor(rows[-1], key) if len(rows) == limit else None
+    return rows, next_cursor, st
+
+# ------------------------------------------------------------------
+# Stock mutations: relative deltas applied atomically server-side
+# Uses the adjust_stock RPC (db/adjust_stock.sql). If the function is not
+# deployed yet we fall back to a batched read-modify-write, which is NOT safe
+# against concurrent registers.
+# ------------------------------------------------------------------
+_adjust_stock_rpc_available = True
+
+def supabase_rpc(fn, payload, headers=None, timeout=10):
+    return storage.rpc(fn, payload, headers=headers, timeout=timeout)
+
+def adjust_stock(deltas):
+    """Apply {barcode: delta} to products.quantity in one call.
+    Returns (updated_rows, status); barcodes without a product row are absent from updated_rows.
+    While Supabase is unreachable the deltas go to the offline journal instead and
+    the rows carry the locally applied quantities (status 202)."""
+    merged = {}
+    for barcode, delta in deltas.items():
+        try:
+            delta = int(delta)
+        except Exception:
+            continue
+        if barcode in (None, "") or delta == 0:
+            continue
+        merged[str(barcode)] = merged.get(str(barcode), 0) + delta
+    if not merged:
+        return [], 200
+    if offline_journal.should_defer():
+        return offline_journal.defer_stock(merged)
+    rows, st = _apply_stock(merged)
+    if st >= 500 and offline_journal.enabled():
+        return offline_journal.defer_stock(merged)
+    return rows, st
+
+def _apply_stock(merged):
+    """adjust_stock against storage, without the offline journal."""
+    global _adjust_stock_rpc_available
+    if _adjust_stock_rpc_available:
+        rows, st = storage.increment("products", "barcode", "quantity", merged)
+        if st < 400:
+            rows = rows if isinstance(rows, list) else []
+            catalog.upsert_rows(rows)
+            return rows, st
+        if st != 404:
+            return [], st
+        _adjust_stock_rpc_available = False
+        logger.warning("adjust_stock RPC not found; falling back to read-modify-write (apply db/adjust_stock.sql)")
+    products, _ = fetch_products_by_barcode(list(merged.keys()))
+    updated = []
+    for barcode, delta in merged.items():
+        prod = products.get(barcode)
+        if prod is None:
+            continue
+        try:
+            updated.append(dict(prod, quantity=max(int(prod.get("quantity", 0) or 0) + delta, 0)))
+        except Exception:
+            pass
+    rows, st = supabase_post_many("products", updated, params={"on_conflict": "barcode"}, prefer="resolution=merge-duplicates,return=representation")
+    catalog.upsert_rows(rows)
+    return rows, st
+
+# ------------------------------------------------------------------
+# Product catalog cache: process-local barcode index of compact records.
+# Warmed by a daemon at startup and refreshed every CATALOG_TTL seconds;
+# product writes and stock changes update it write-through. If no refresh
+# succeeded for CATALOG_MAX_STALE seconds the cache is treated as cold and
+# reads go to Supabase, which bounds how stale a served row can be.
+# Negative lookups are never trusted: unknown barcodes are always re-checked
+# upstream, since another worker may have created them.
+# While Supabase is unreachable (circuit breaker open) the last known copy is
+# served regardless of age; it is also saved to the offline journal after
+# each change so a process started during an outage can load it.
+# ------------------------------------------------------------------
+CATALOG_TTL = float(os.environ.get("CATALOG_TTL", 60.0))
+CATALOG_MAX_STALE = float(os.environ.get("CATALOG_MAX_STALE", 300.0))
+CATALOG_TOMBSTONE_TTL = float(os.environ.get("CATALOG_TOMBSTONE_TTL", 86400.0))
+
+class _ProductRecord:
+    __slots__ = ("id", "barcode", "name", "price", "quantity", "kdv", "otv", "min_stock_level", "created_at", "extra")
+    FIELDS = ("id", "barcode", "name", "price", "quantity", "kdv", "otv", "min_stock_level", "created_at")
+
+    @classmethod
+    def from_row(cls, row):
+        rec = cls()
+        for f in cls.FIELDS:
+            setattr(rec, f, row.get(f))
+        rec.barcode = str(rec.barcode)
+        extra = {k: v for k, v in row.items() if k not in cls.FIELDS}
+        rec.extra = extra or None
+        return rec
+
+    def to_dict(self):
+        d = {f: getattr(self, f) for f in self.FIELDS}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def updated(self, fields):
+        return _ProductRecord.from_row(dict(self.to_dict(), **fields))
+
+class _Catalog:
+    def __init__(self, ttl=CATALOG_TTL, max_stale=CATALOG_MAX_STALE):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self._by_barcode = {}
+        self._sorted = None
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._writes_during_refresh = None
+        self._listeners = []
+        self._thread = None
+        # versioning: every effective change bumps version and is logged per
+        # barcode; deltas below _floor (purged tombstones) need a full resync
+        self.epoch = secrets.token_hex(4)
+        self.version = 0
+        self._changes = {}
+        self._floor = 0
+        self._first_loaded_ts = None
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_failures = 0
+
+    def is_fresh(self):
+        if self._loaded_at is not None and (time.monotonic() - self._loaded_at) <= self.max_stale:
+            return True
+        # offline: a stale catalog beats none at all
+        return bool(self._by_barcode) and offline_journal.offline()
+
+    def refresh(self):
+        """Reload the whole catalog from Supabase; keeps the old copy on failure.
+        Writes that land while the reload is in flight are replayed on top of it."""
+        rows = []
+        completed = {"ok": False}
+
+        def pages():
+            yield from supabase_iter("products", {}, key="barcode", descending=False)
+            completed["ok"] = True
+
+        with self._lock:
+            self._writes_during_refresh = {}
+        try:
+            for row in pages():
+                rows.append(row)
+        finally:
+            with self._lock:
+                overlay, self._writes_during_refresh = self._writes_during_refresh, None
+        if not completed["ok"]:
+            self.refresh_failures += 1
+            return False
+        self.replace_all(rows, overlay)
+        self.refreshes += 1
+        return True
+
+    def replace_all(self, rows, overlay=None, stale=False):
+        """Install rows as the whole catalog; stale=True (a saved snapshot) leaves it
+        cold, so it is only served while offline."""
+        index = {}
+        for row in rows:
+            if row.get("barcode") not in (None, ""):
+                rec = _ProductRecord.from_row(row)
+                index[rec.barcode] = rec
+        with self._lock:
+            for barcode, rec in (overlay or {}).items():
+                if rec is None:
+                    index.pop(barcode, None)
+                else:
+                    index[barcode] = rec
+            for barcode, rec in index.items():
+                old = self._by_barcode.get(barcode)
+                if old is None or old.to_dict() != rec.to_dict():
+                    self._bump(barcode, False)
+            for barcode in self._by_barcode:
+                if barcode not in index:
+                    self._bump(barcode, True)
+            self._purge_tombstones()
+            self._by_barcode = index
+            self._sorted = None
+            if not stale:
+                self._loaded_at = time.monotonic()
+            if self._first_loaded_ts is None:
+                self._first_loaded_ts = time.time()
+            for listener in self._listeners:
+                listener.on_reset(index.values())
+
+    def add_listener(self, listener):
+        """Register an object with on_change(old, new) and on_reset(records); both run under the catalog lock."""
+        with self._lock:
+            self._listeners.append(listener)
+            if self._loaded_at is not None:
+                listener.on_reset(self._by_barcode.values())
+
+    def _bump(self, barcode, deleted):
+        # called with self._lock held
+        self.version += 1
+        self._changes[barcode] = (self.version, time.time(), deleted)
+
+    def _purge_tombstones(self):
+        # called with self._lock held
+        cutoff = time.time() - CATALOG_TOMBSTONE_TTL
+        for barcode, (version, ts, deleted) in list(self._changes.items()):
+            if deleted and ts < cutoff:
+                del self._changes[barcode]
+                self._floor = max(self._floor, version)
+
+    def _set(self, rec):
+        # called with self._lock held
+        old = self._by_barcode.get(rec.barcode)
+        if old is None or old.to_dict() != rec.to_dict():
+            self._bump(rec.barcode, False)
+        self._by_barcode[rec.barcode] = rec
+        self._sorted = None
+        for listener in self._listeners:
+            listener.on_change(old, rec)
+        if self._writes_during_refresh is not None:
+            self._writes_during_refresh[rec.barcode] = rec
+
+    def _remove(self, barcode):
+        # called with self._lock held
+        old = self._by_barcode.pop(barcode, None)
+        self._sorted = None
+        if old is not None:
+            self._bump(barcode, True)
+            for listener in self._listeners:
+                listener.on_change(old, None)
+        if self._writes_during_refresh is not None:
+            self._writes_during_refresh[barcode] = None
+
+    def upsert_rows(self, rows):
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                if isinstance(row, dict) and row.get("barcode") not in (None, ""):
+                    old = self._by_barcode.get(str(row.get("barcode")))
+                    self._set(old.updated(row) if old is not None else _ProductRecord.from_row(row))
+
+    def patch(self, barcode, fields):
+        with self._lock:
+            old = self._by_barcode.get(str(barcode))
+            if old is not None:
+                self._set(old.updated(fields))
+
+    def remove(self, barcode):
+        with self._lock:
+            self._remove(str(barcode))
+
+    def peek(self, barcode):
+        """Held product row (dict) or None, regardless of freshness; not counted as a lookup."""
+        rec = self._by_barcode.get(str(barcode))
+        return rec.to_dict() if rec is not None else None
+
+    def get(self, barcode):
+        """Cached product row (dict) or None on a miss (cold cache or unknown barcode)."""
+        if self.is_fresh():
+            rec = self._by_barcode.get(str(barcode))
+            if rec is not None:
+                self.hits += 1
+                return rec.to_dict()
+        self.misses += 1
+        return None
+
+    def lookup(self, barcodes):
+        """({barcode: row}, status) for the given barcodes; misses are fetched in one
+        query and cached. status >= 400 means some misses could not be checked."""
+        found = {}
+        status = 200
+        missing = []
+        for b in barcodes:
+            row = self.get(b)
+            if row is not None:
+                found[str(b)] = row
+            else:
+                missing.append(b)
+        if missing:
+            fetched, status = fetch_products_by_barcode(missing)
+            self.upsert_rows(list(fetched.values()))
+            found.update(fetched)
+        return found, status
+
+    def version_token(self):
+        return f"{self.epoch}.{self.version}"
+
+    def snapshot(self):
+        """(version_token, products ordered by name) taken atomically, or (None, None) when cold."""
+        if not self.is_fresh():
+            self.misses += 1
+            return None, None
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted((r.to_dict() for r in self._by_barcode.values()), key=lambda p: (p.get("name") is None, p.get("name") or ""))
+            self.hits += 1
+            return self.version_token(), self._sorted
+
+    def delta(self, since):
+        """Changes after since, which is a version token ("<epoch>.<n>") or an ISO timestamp.
+        Returns (version_token, changed_rows, deleted_barcodes), or None when the client
+        needs a full resync (other process/restart, purged tombstones, unparseable since)."""
+        if not self.is_fresh():
+            return None
+        since = str(since)
+        with self._lock:
+            epoch, _, num = since.partition(".")
+            if epoch == self.epoch and num.isdigit():
+                after = int(num)
+                if after < self._floor or after > self.version:
+                    return None
+                picked = [(b, deleted) for b, (v, ts, deleted) in self._changes.items() if v > after]
+            else:
+                try:
+                    dt = datetime.fromisoformat(since.replace("Z", "+00:00"))
+                    ts_since = dt.timestamp() if dt.tzinfo else dt.replace(tzinfo=timezone.utc).timestamp()
+                except Exception:
+                    return None
+                if self._first_loaded_ts is None or ts_since < self._first_loaded_ts or ts_since < self._floor_ts():
+                    return None
+                picked = [(b, deleted) for b, (v, ts, deleted) in self._changes.items() if ts >= ts_since]
+            changed = [self._by_barcode[b].to_dict() for b, deleted in picked if not deleted and b in self._by_barcode]
+            removed = [b for b, deleted in picked if deleted]
+            return self.version_token(), changed, removed
+
+    def _floor_ts(self):
+        # called with self._lock held: wall time before which tombstones may be gone
+        return time.time() - CATALOG_TOMBSTONE_TTL if self._floor else 0
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="catalog-refresh", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                ok = self.refresh()
+            except Exception as e:
+                logger.debug(f"catalog refresh failed: {e}")
+                ok = False
+            try:
+                if ok:
+                    offline_journal.save_catalog(self)
+                elif not self._by_barcode:
+                    rows = offline_journal.load_catalog()
+                    if rows:
+                        self.replace_all(rows, stale=True)
+                        logger.info(f"catalog: loaded {len(rows)} products from the offline snapshot")
+            except Exception as e:
+                logger.debug(f"catalog snapshot failed: {e}")
+            time.sleep(self.ttl if ok else min(self.ttl, 5.0))
+
+    def rows_if_changed(self, version):
+        """(version_token, all rows) unless the catalog is still at version; None otherwise."""
+        with self._lock:
+            token = self.version_token()
+            if token == version or self._loaded_at is None:
+                return None
+            return token, [r.to_dict() for r in self._by_barcode.values()]
+
+    def stats(self):
+        age = None if self._loaded_at is None else round(time.monotonic() - self._loaded_at, 1)
+        lookups = self.hits + self.misses
+        return {"size": len(self._by_barcode), "fresh": self.is_fresh(), "age_seconds": age, "ttl": self.ttl, "max_stale": self.max_stale, "hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0, "version": self.version_token(), "refreshes": self.refreshes, "refresh_failures": self.refresh_failures}
+
+catalog = _Catalog()
+
+# ------------------------------------------------------------------
+# Inventory index: maintained from catalog changes, answers low-stock and
+# stock-value queries without scanning products.
+# - entries sorted by (quantity - min_stock_level, barcode); low stock is the
+#   prefix with a deficit <= 0, so a query costs O(k)
+# - running totals for stock value and product count
+# Every catalog reload (CATALOG_TTL) rebuilds it from scratch, which also
+# clears any floating-point drift in the running value.
+# ------------------------------------------------------------------
+def _stock_deficit(rec):
+    try:
+        quantity = int(rec.quantity or 0)
+    except Exception:
+        quantity = 0
+    try:
+        minimum = int(rec.min_stock_level if rec.min_stock_level is not None else 5)
+    except Exception:
+        minimum = 5
+    return quantity - minimum
+
+def _stock_value(rec):
+    try:
+        return float(rec.price or 0) * int(rec.quantity or 0)
+    except Exception:
+        return 0.0
+
+class _InventoryIndex:
+    def __init__(self):
+        self._order = []
+        self._records = {}
+        self.total_value = 0.0
+        self.total_products = 0
+        self.rebuilds = 0
+        self._lock = threading.Lock()
+
+    def on_reset(self, records):
+        order = []
+        by_barcode = {}
+        total = 0.0
+        for rec in records:
+            order.append((_stock_deficit(rec), rec.barcode))
+            by_barcode[rec.barcode] = rec
+            total += _stock_value(rec)
+        order.sort()
+        with self._lock:
+            self._order = order
+            self._records = by_barcode
+            self.total_value = total
+            self.total_products = len(by_barcode)
+            self.rebuilds += 1
+
+    def on_change(self, old, new):
+        with self._lock:
+            if old is not None and old.barcode in self._records:
+                key = (_stock_deficit(old), old.barcode)
+                i = bisect.bisect_left(self._order, key)
+                if i < len(self._order) and self._order[i] == key:
+                    del self._order[i]
+                self.total_value -= _stock_value(old)
+                self.total_products -= 1
+                del self._records[old.barcode]
+            if new is not None:
+                bisect.insort(self._order, (_stock_deficit(new), new.barcode))
+                self._records[new.barcode] = new
+                self.total_value += _stock_value(new)
+                self.total_products += 1
+
+    def low_stock(self, limit=None):
+        """Products at or below their minimum stock level, most urgent first."""
+        with self._lock:
+            end = bisect.bisect_right(self._order, (0, "\uffff"))
+            if limit is not None:
+                end = min(end, limit)
+            return [self._records[b].to_dict() for _, b in self._order[:end]]
+
+    def stock_value(self):
+        return {"total_products": self.total_products, "total_stock_value": round(self.total_value, 2)}
+
+inventory_index = _InventoryIndex()
+catalog.add_listener(inventory_index)
+
+# ------------------------------------------------------------------
+# Product search index (catalog listener)
+# - Turkish-aware folding: İ->i, I->ı before lower(), then ç/ğ/ı/ö/ş/ü are
+#   mapped to ASCII so "cay", "çay" and "ÇAY" all match "Çay"
+# - barcode prefixes via a sorted barcode list (bisect)
+# - name word prefixes via a sorted (word, barcode) list
+# - name substrings via trigram postings, verified against the folded name
+# Results are ranked: exact barcode, barcode prefix, exact name, name prefix,
+# word prefix, substring; ties by name.
+# ------------------------------------------------------------------
+_TR_UPPER = str.maketrans({"İ": "i", "I": "ı"})
+_TR_ASCII = str.maketrans({"ç": "c", "ğ": "g", "ı": "i", "ö": "o", "ş": "s", "ü": "u", "â": "a", "î": "i", "û": "u"})
+SEARCH_DEFAULT_LIMIT = int(os.environ.get("SEARCH_DEFAULT_LIMIT", 20))
+SEARCH_MAX_LIMIT = int(os.environ.get("SEARCH_MAX_LIMIT", 100))
+# trigram candidates examined per query; bounds latency for very common trigrams
+SEARCH_SCAN_LIMIT = int(os.environ.get("SEARCH_SCAN_LIMIT", 2000))
+
+def turkish_fold(text):
+    """Case-fold with Turkish dotted/dotless i rules."""
+    return str(text or "").translate(_TR_UPPER).lower()
+
+def search_key(text):
+    """Folded, ASCII-mapped, whitespace-normalised form used for matching."""
+    return " ".join(turkish_fold(text).translate(_TR_ASCII).split())
+
+def _trigrams(key):
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+class _SearchIndex:
+    def __init__(self):
+        self._records = {}
+        self._keys = {}
+        self._barcodes = []
+        self._words = []
+        self._grams = {}
+        self._lock = threading.Lock()
+
+    def _add(self, rec):
+        key = search_key(rec.name)
+        self._records[rec.barcode] = rec
+        self._keys[rec.barcode] = key
+        bisect.insort(self._barcodes, rec.barcode)
+        for word in set(key.split()):
+            bisect.insort(self._words, (word, rec.barcode))
+        for gram in _trigrams(key):
+            self._grams.setdefault(gram, set()).add(rec.barcode)
+
+    def _discard(self, barcode):
+        key = self._keys.pop(barcode, None)
+        if self._records.pop(barcode, None) is None:
+            return
+        i = bisect.bisect_left(self._barcodes, barcode)
+        if i < len(self._barcodes) and self._barcodes[i] == barcode:
+            del self._barcodes[i]
+        for word in set((key or "").split()):
+            i = bisect.bisect_left(self._words, (word, barcode))
+            if i < len(self._words) and self._words[i] == (word, barcode):
+                del self._words[i]
+        for gram in _trigrams(key or ""):
+            postings = self._grams.get(gram)
+            if postings is not None:
+                postings.discard(barcode)
+                if not postings:
+                    del self._grams[gram]
+
+    def on_change(self, old, new):
+        with self._lock:
+            if old is not None and new is not None and old.barcode == new.barcode and old.name == new.name and new.barcode in self._records:
+                # stock/price updates: the indexed keys are unchanged, just swap the record
+                self._records[new.barcode] = new
+                return
+            if old is not None:
+                self._discard(old.barcode)
+            if new is not None:
+                if new.barcode in self._records:
+                    self._discard(new.barcode)
+                self._add(new)
+
+    def _rebuild(self, records):
+        # called with self._lock held; sort once instead of n insorts
+        self._records = dict(records)
+        self._keys = {b: search_key(r.name) for b, r in self._records.items()}
+        self._barcodes = sorted(self._records)
+        words = []
+        grams = {}
+        for b, key in self._keys.items():
+            for word in set(key.split()):
+                words.append((word, b))
+            for gram in _trigrams(key):
+                grams.setdefault(gram, set()).add(b)
+        words.sort()
+        self._words = words
+        self._grams = grams
+
+    def on_reset(self, records):
+        # reloads mostly return unchanged rows: only re-index what differs
+        records = {r.barcode: r for r in records}
+        with self._lock:
+            changed = sum(1 for b, r in records.items() if b not in self._records or self._records[b].name != r.name)
+            if changed > len(records) // 10 or not self._records:
+                self._rebuild(records)
+                return
+            for barcode in [b for b in self._records if b not in records]:
+                self._discard(barcode)
+            for barcode, rec in records.items():
+                cur = self._records.get(barcode)
+                if cur is None:
+                    self._add(rec)
+                elif cur.name != rec.name:
+                    self._discard(barcode)
+                    self._add(rec)
+                else:
+                    self._records[barcode] = rec
+
+    def search(self, query, limit=SEARCH_DEFAULT_LIMIT):
+        q_raw = str(query or "").strip()
+        q = search_key(q_raw)
+        if not q:
+            return []
+        ranked = {}
+
+        def offer(barcode, rank):
+            if rank < ranked.get(barcode, 99):
+                ranked[barcode] = rank
+
+        with self._lock:
+            # barcode prefix
+            i = bisect.bisect_left(self._barcodes, q_raw)
+            while i < len(self._barcodes) and self._barcodes[i].startswith(q_raw) and len(ranked) < limit * 4:
+                b = self._barcodes[i]
+                offer(b, 0 if b == q_raw else 1)
+                i += 1
+            # name word prefix
+            first = q.split()[0]
+            i = bisect.bisect_left(self._words, (first, ""))
+            scanned = 0
+            while i < len(self._words) and self._words[i][0].startswith(first) and scanned < limit * 20:
+                b = self._words[i][1]
+                key = self._keys[b]
+                if q in key:
+                    offer(b, 2 if key == q else 3 if key.startswith(q) else 4)
+                scanned += 1
+                i += 1
+            # name substring via trigrams
+            if len(ranked) < limit and len(q) >= 3:
+                postings = sorted((self._grams.get(g, set()) for g in _trigrams(q)), key=len)
+                for examined, b in enumerate(postings[0] if postings else ()):
+                    if examined >= SEARCH_SCAN_LIMIT:
+                        break
+                    if all(b in p for p in postings[1:]) and q in self._keys[b]:
+                        offer(b, 5)
+            best = heapq.nsmallest(limit, ranked.items(), key=lambda kv: (kv[1], self._keys[kv[0]], kv[0]))
+            return [self._records[b].to_dict() for b, rank in best]
+
+search_index = _SearchIndex()
+catalog.add_listener(search_index)
+
+# ------------------------------------------------------------------
+# Write-behind queue for append-only tables (audit_logs, stock_movements,
+# cash_transactions). Rows are spooled to a local JSONL file, queued in
+# memory and flushed by a daemon thread as array inserts, either every
+# WRITE_BEHIND_INTERVAL seconds or as soon as WRITE_BEHIND_BATCH rows wait.
+# Each process owns spool file writebehind-<pid>.jsonl; spools left behind
+# by dead processes are adopted on start so a crash does not lose rows. A
+# worker claims such a file by renaming it before reading, so when several
+# start at once each row is recovered exactly once.
+# ------------------------------------------------------------------
+WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND", "1") != "0"
+WRITE_BEHIND_INTERVAL = float(os.environ.get("WRITE_BEHIND_INTERVAL", 2.0))
+WRITE_BEHIND_BATCH = int(os.environ.get("WRITE_BEHIND_BATCH", 200))
+WRITE_BEHIND_MAX_QUEUE = int(os.environ.get("WRITE_BEHIND_MAX_QUEUE", 10000))
+SPOOL_DIR = os.environ.get("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "tekel-pos-spool"))
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except Exception:
+        return True
+
+class _WriteBehindQueue:
+    def __init__(self, spool_dir=SPOOL_DIR, interval=WRITE_BEHIND_INTERVAL, batch=WRITE_BEHIND_BATCH, max_queue=WRITE_BEHIND_MAX_QUEUE):
+        self.spool_dir = spool_dir
+        self.interval = interval
+        self.batch = batch
+        self.max_queue = max_queue
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._spool_path = None
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.flush_failures = 0
+        self.last_flush_ms = None
+        self.last_flush_at = None
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._load_spools()
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _load_spools(self):
+        # called with self._lock held
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._spool_path = os.path.join(self.spool_dir, f"writebehind-{os.getpid()}.jsonl")
+            adopted = []
+            for name in sorted(os.listdir(self.spool_dir)):
+                # writebehind-<pid>.jsonl, or writebehind-<pid>.jsonl.claimed-<adopter> left
+                # behind by a worker that died while adopting it
+                base, _, claimer = name.partition(".claimed-")
+                if not (base.startswith("writebehind-") and base.endswith(".jsonl")):
+                    continue
+                path = os.path.join(self.spool_dir, name)
+                try:
+                    pid = int(base[len("writebehind-"):-len(".jsonl")])
+                    owner = int(claimer) if claimer else pid
+                except ValueError:
+                    continue
+                if path != self._spool_path:
+                    if owner != os.getpid() and _pid_alive(owner):
+                        continue
+                    # claim it first: of several workers starting after a crash only
+                    # the one whose rename succeeds reads the file
+                    claimed = os.path.join(self.spool_dir, f"{base}.claimed-{os.getpid()}")
+                    try:
+                        os.rename(path, claimed)
+                    except OSError:
+                        continue
+                    path = claimed
+                    adopted.append(path)
+                with open(path, "r", encoding="utf-8") as fh:
+                    for line in fh:
+                        try:
+                            rec = json.loads(line)
+                            self._pending.append((rec["table"], rec["row"]))
+                        except Exception:
+                            pass
+            if self._pending:
+                logger.info(f"write-behind: recovered {len(self._pending)} spooled rows")
+            self._rewrite_spool()
+            # only now that our own spool holds their rows
+            for path in adopted:
+                os.remove(path)
+        except Exception as e:
+            logger.warning(f"write-behind spool unavailable ({e}); queue is memory-only")
+            self._spool_path = None
+
+    def _rewrite_spool(self):
+        # called with self._lock held
+        if not self._spool_path:
+            return
+        tmp = self._spool_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            for table, row in self._pending:
+                fh.write(json.dumps({"table": table, "row": row}, ensure_ascii=False) + "\n")
+        os.replace(tmp, self._spool_path)
+
+    def enqueue(self, table, rows):
+        """Queue rows for table; returns the number accepted."""
+        if isinstance(rows, dict):
+            rows = [rows]
+        if not rows:
+            return 0
+        if not WRITE_BEHIND_ENABLED:
+            supabase_post_many(table, rows)
+            return len(rows)
+        self.ensure_started()
+        accepted = 0
+        with self._lock:
+            lines = []
+            for row in rows:
+                if len(self._pending) >= self.max_queue:
+                    self.dropped += 1
+                    continue
+                self._pending.append((table, row))
+                lines.append(json.dumps({"table": table, "row": row}, ensure_ascii=False))
+                accepted += 1
+            self.enqueued += accepted
+            if lines and self._spool_path:
+                try:
+                    with open(self._spool_path, "a", encoding="utf-8") as fh:
+                        fh.write("\n".join(lines) + "\n")
+                except Exception as e:
+                    logger.debug(f"write-behind spool append failed: {e}")
+            depth = len(self._pending)
+        if depth >= self.batch:
+            self._wake.set()
+        return accepted
+
+    def flush(self):
+        """Send everything currently queued. Safe to call from any thread."""
+        with self._flush_lock:
+            with self._lock:
+                snapshot = list(self._pending)
+            if not snapshot:
+                return 0
+            started = time.time()
+            # group consecutive rows by (table, key set); PostgREST needs uniform keys per array
+            groups = {}
+            for idx, (table, row) in enumerate(snapshot):
+                groups.setdefault((table, tuple(sorted(row.keys()))), []).append(idx)
+            done = set()
+            failed = False
+            for (table, _keys), idxs in groups.items():
+                for i in range(0, len(idxs), self.batch):
+                    chunk = idxs[i:i + self.batch]
+                    res, st = supabase_post(table, [snapshot[j][1] for j in chunk])
+                    if st < 400:
+                        done.update(chunk)
+                    elif 400 <= st < 500:
+                        # rejected rows will never succeed; drop them instead of blocking the queue
+                        logger.warning(f"write-behind: {table} rejected {len(chunk)} rows (HTTP {st}); dropping")
+                        self.dropped += len(chunk)
+                        done.update(chunk)
+                    else:
+                        failed = True
+            with self._lock:
+                sent = [snapshot[j] for j in sorted(done)]
+                # rows enqueued during the flush stay behind the snapshot
+                remaining = [snapshot[j] for j in range(len(snapshot)) if j not in done] + self._pending[len(snapshot):]
+                self._pending = remaining
+                try:
+                    self._rewrite_spool()
+                except Exception as e:
+                    logger.debug(f"write-behind spool rewrite failed: {e}")
+            self.flushed += len(sent)
+            if failed:
+                self.flush_failures += 1
+            self.last_flush_ms = round((time.time() - started) * 1000, 2)
+            self.last_flush_at = now_iso()
+            return len(sent)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.debug(f"write-behind flush error: {e}")
+
+    def stats(self):
+        return {
+            "enabled": WRITE_BEHIND_ENABLED,
+            "depth": len(self._pending),
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "flush_failures": self.flush_failures,
+            "last_flush_ms": self.last_flush_ms,
+            "last_flush_at": self.last_flush_at,
+            "spool": self._spool_path,
+        }
+
+write_behind = _WriteBehindQueue()
+
+def enqueue_append(table, rows):
+    """Best-effort append to audit_logs / stock_movements / cash_transactions off the response path."""
+    try:
+        return write_behind.enqueue(table, rows)
+    except Exception as e:
+        logger.debug(f"enqueue_append {table} failed: {e}")
+        return 0
+
+@atexit.register
+def _flush_write_behind_at_exit():
+    try:
+        if write_behind._thread is not None:
+            write_behind.flush()
+    except Exception:
+        pass
+
+# ------------------------------------------------------------------
+# Offline journal (store-and-forward). While Supabase is unreachable
+# (circuit breaker not closed, or always with OFFLINE_MODE=force) sales and
+# stock deltas are written to a local SQLite journal (OFFLINE_JOURNAL_PATH)
+# instead of waiting on retries: the stock deltas are applied to the catalog
+# right away and the request answers at local speed. A daemon replays the
+# journal in order once the breaker closes, OFFLINE_REPLAY_BATCH entries at
+# a time and stage by stage, each stage batched across the entries: one
+# sales insert, one sale_items insert, one merged adjust_stock call, then
+# the cash rows go to the write-behind queue. Progress is checkpointed on
+# the entries after every stage, so a failed or interrupted replay resumes
+# where it stopped. Stock is replayed as relative deltas, which compose with
+# whatever other registers did meanwhile; a delta whose product is gone
+# upstream, or that leaves the quantity at zero (the RPC floors it), is
+# logged as a conflict (audit_logs action "offline_stock_conflict").
+# While the journal is not empty new mutations queue behind it too.
+# Worker processes share the file; a lease row picks the one that replays.
+# OFFLINE_MODE=off disables the journal, as does the SQLite storage
+# backend, which has no connection to lose.
+# ------------------------------------------------------------------
+OFFLINE_MODE = os.environ.get("OFFLINE_MODE", "auto").strip().lower()
+OFFLINE_JOURNAL_PATH = os.environ.get("OFFLINE_JOURNAL_PATH", os.path.join(SPOOL_DIR, "offline-journal.db"))
+OFFLINE_REPLAY_INTERVAL = float(os.environ.get("OFFLINE_REPLAY_INTERVAL", 2.0))
+OFFLINE_REPLAY_BATCH = int(os.environ.get("OFFLINE_REPLAY_BATCH", 100))
+OFFLINE_LEASE_TTL = float(os.environ.get("OFFLINE_LEASE_TTL", 60.0))
+
+def _op_done(op):
+    return all(v for k, v in op.items() if k.endswith("_done"))
+
+def sale_op(sale, items, deltas, cash=None):
+    """Journal entry for one sale: the sales row, its sale_items (sale_id is filled in
+    once known), {barcode: delta} stock changes and an optional cash_transactions row."""
+    return {"kind": "sale", "sale": sale, "items": items, "deltas": deltas, "cash": cash, "sale_id": None, "sale_done": False, "items_done": not items, "stock_done": not deltas, "cash_done": cash is None}
+
+class _OfflineJournal:
+    def __init__(self, path=OFFLINE_JOURNAL_PATH, interval=OFFLINE_REPLAY_INTERVAL, batch=OFFLINE_REPLAY_BATCH):
+        self.path = path
+        self.interval = interval
+        self.batch = batch
+        self.pending = 0
+        self._oldest = None
+        self._holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._local = threading.local()
+        self._schema_ready = False
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._snapshot_version = None
+        self.journaled = 0
+        self.replayed = 0
+        self.replay_batches = 0
+        self.rejected = 0
+        self.stock_conflicts = 0
+        self.append_failures = 0
+        self.last_replay_at = None
+        self.last_error = None
+        self.snapshot_saved_at = None
+        self.snapshot_rows = 0
+
+    def enabled(self):
+        return OFFLINE_MODE != "off" and storage.name == "postgrest"
+
+    def offline(self):
+        """True while Supabase is considered unreachable. Half-open is not offline:
+        replay may be the trial call that closes the breaker."""
+        return self.enabled() and circuit_breaker.state == circuit_breaker.OPEN
+
+    def should_defer(self):
+        """Journal mutations instead of sending them: offline, forced, or older entries still queued."""
+        return self.enabled() and (OFFLINE_MODE == "force" or self.pending > 0 or circuit_breaker.state != circuit_breaker.CLOSED)
+
+    def _db(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            # an acknowledged offline sale has to survive a power cut
+            conn.execute("PRAGMA synchronous=FULL")
+            if not self._schema_ready:
+                conn.execute("CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, payload TEXT NOT NULL, created REAL NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS journal_lease (id INTEGER PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)")
+                conn.execute("INSERT OR IGNORE INTO journal_lease VALUES (1, '', 0)")
+                conn.execute("CREATE TABLE IF NOT EXISTS catalog_snapshot (barcode TEXT PRIMARY KEY, row TEXT NOT NULL)")
+                conn.execute("CREATE TABLE IF NOT EXISTS journal_meta (key TEXT PRIMARY KEY, value TEXT)")
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, conn, statements):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, args in statements:
+                conn.execute(sql, args)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _apply_local(self, deltas):
+        """Apply deltas to the catalog; returns (deltas to journal, updated rows).
+        Every delta is journaled: a barcode the catalog does not know (possibly a
+        stale snapshot) is only left unpatched, and replay reports it as a conflict
+        if upstream does not know it either."""
+        kept = dict(deltas)
+        rows = []
+        for barcode, delta in deltas.items():
+            row = catalog.peek(barcode)
+            if row is None:
+                continue
+            try:
+                quantity = max(int(row.get("quantity") or 0) + int(delta), 0)
+            except Exception:
+                continue
+            catalog.patch(barcode, {"quantity": quantity})
+            rows.append(dict(row, quantity=quantity))
+        return kept, rows
+
+    def append(self, op):
+        """Durably journal op, applying its stock deltas to the catalog first.
+        Returns (journaled, locally updated product rows)."""
+        if not self.enabled():
+            return False, []
+        rows = []
+        if not op.get("stock_done", True):
+            op["deltas"], rows = self._apply_local(op["deltas"])
+            op["stock_done"] = not op["deltas"]
+        if _op_done(op):
+            return True, rows
+        try:
+            now = time.time()
+            self._db().execute("INSERT INTO journal (kind, payload, created) VALUES (?, ?, ?)", (op["kind"], json.dumps(op, ensure_ascii=False), now))
+        except Exception as e:
+            self.append_failures += 1
+            logger.warning(f"offline journal append failed: {e}")
+            return False, rows
+        with self._lock:
+            self.pending += 1
+            self.journaled += 1
+            if self._oldest is None:
+                self._oldest = now
+        self.ensure_started()
+        if not self.offline():
+            self._wake.set()
+        return True, rows
+
+    def defer_stock(self, merged):
+        """adjust_stock while offline: (locally updated rows, 202), or ([], 503) if the journal failed."""
+        ok, rows = self.append({"kind": "stock", "deltas": merged, "stock_done": False})
+        return (rows, 202) if ok else ([], 503)
+
+    def push(self, ops, replay=False, checkpoint=None):
+        """Apply ops to storage stage by stage, each stage batched across ops, recording
+        progress on the op dicts. Returns False when a stage hit a transient (5xx or
+        network) error; what is left is done by a later push. Rejected (4xx) writes
+        are logged and dropped, as the write-behind queue does."""
+        sales = [op for op in ops if op["kind"] == "sale" and not op["sale_done"]]
+        if sales:
+            created, st = supabase_post_many("sales", [op["sale"] for op in sales], prefer="return=representation")
+            if st >= 500:
+                return False
+            created = created if st < 400 and isinstance(created, list) else []
+            if len(created) < len(sales):
+                logger.warning(f"offline journal: sales rejected {len(sales) - len(created)} rows (HTTP {st})")
+                self.rejected += len(sales) - len(created)
+            for i, op in enumerate(sales):
+                op["sale_id"] = created[i].get("id") if i < len(created) and isinstance(created[i], dict) else None
+                op["sale_done"] = True
+                # a rejected sale has no id to hang its items on, and the stock and
+                # cash it would have moved are dropped with it; on replay the delta
+                # append() applied to the catalog is undone as well
+                if op["sale_id"] is None:
+                    if replay and not op["stock_done"]:
+                        self._apply_local({barcode: -int(delta) for barcode, delta in op["deltas"].items()})
+                    op["items_done"] = op["stock_done"] = op["cash_done"] = True
+            if checkpoint:
+                checkpoint()
+        with_items = [op for op in ops if op["kind"] == "sale" and op["sale_done"] and not op["items_done"]]
+        if with_items:
+            rows = [dict(item, sale_id=op["sale_id"]) for op in with_items for item in op["items"]]
+            _, st = supabase_post_many("sale_items", rows)
+            if st >= 500:
+                return False
+            if st >= 400:
+                logger.warning(f"offline journal: sale_items rejected {len(rows)} rows (HTTP {st})")
+                self.rejected += len(rows)
+            for op in with_items:
+                op["items_done"] = True
+            if checkpoint:
+                checkpoint()
+        with_stock = [op for op in ops if not op["stock_done"]]
+        if with_stock:
+            merged = {}
+            for op in with_stock:
+                for barcode, delta in op["deltas"].items():
+                    merged[barcode] = merged.get(barcode, 0) + int(delta)
+            merged = {b: d for b, d in merged.items() if d}
+            if merged:
+                rows, st = _apply_stock(merged)
+                if st >= 500:
+                    return False
+                if st >= 400:
+                    logger.warning(f"offline journal: stock deltas for {len(merged)} products rejected (HTTP {st})")
+                    self.rejected += len(merged)
+                elif replay:
+                    self._check_conflicts(merged, rows)
+            for op in with_stock:
+                op["stock_done"] = True
+            if checkpoint:
+                checkpoint()
+        for op in ops:
+            if not op.get("cash_done", True):
+                enqueue_append("cash_transactions", dict(op["cash"], description=f"Satış #{op['sale_id']}"))
+                op["cash_done"] = True
+        return True
+
+    def _check_conflicts(self, merged, rows):
+        after = {str(r.get("barcode")): r for r in rows if isinstance(r, dict)}
+        conflicts = []
+        for barcode, delta in merged.items():
+            row = after.get(barcode)
+            if row is None:
+                conflicts.append(f"{barcode}: ürün bulunamadı ({delta:+d})")
+            elif delta < 0 and int(row.get("quantity") or 0) == 0:
+                conflicts.append(f"{barcode}: stok sıfırlandı ({delta:+d})")
+        if conflicts:
+            self.stock_conflicts += len(conflicts)
+            logger.warning(f"offline journal: {len(conflicts)} stock conflicts on replay: {conflicts[:5]}")
+            enqueue_append("audit_logs", {"user_id": 1, "action": "offline_stock_conflict", "description": "Çevrimdışı stok aktarımı: " + ", ".join(conflicts[:50]), "created_at": now_iso()})
+
+    def replay(self):
+        """Push the oldest OFFLINE_REPLAY_BATCH entries. Returns how many completed, or
+        None if another process holds the lease or a stage failed."""
+        conn = self._db()
+        now = time.time()
+        if conn.execute("UPDATE journal_lease SET holder = ?, expires = ? WHERE id = 1 AND (holder = ? OR expires < ?)", (self._holder, now + OFFLINE_LEASE_TTL, self._holder, now)).rowcount != 1:
+            return None
+        entries = []
+        for seq, payload in conn.execute("SELECT seq, payload FROM journal ORDER BY seq LIMIT ?", (self.batch,)).fetchall():
+            try:
+                entries.append((seq, json.loads(payload)))
+            except Exception:
+                logger.warning(f"offline journal: dropping unreadable entry {seq}")
+                conn.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+        if not entries:
+            return 0
+
+        def checkpoint():
+            self._transaction(conn, [("DELETE FROM journal WHERE seq = ?", (seq,)) if _op_done(op) else ("UPDATE journal SET payload = ? WHERE seq = ?", (json.dumps(op, ensure_ascii=False), seq)) for seq, op in entries])
+
+        ok = self.push([op for _, op in entries], replay=True, checkpoint=checkpoint)
+        checkpoint()
+        done = sum(1 for _, op in entries if _op_done(op))
+        self.replayed += done
+        self.replay_batches += 1
+        self.last_replay_at = now_iso()
+        return done if ok else None
+
+    def _refresh_pending(self):
+        count, oldest = self._db().execute("SELECT COUNT(*), MIN(created) FROM journal").fetchone()
+        with self._lock:
+            self.pending = count
+            self._oldest = oldest
+
+    def _tick(self):
+        if not self.enabled():
+            return
+        self._refresh_pending()
+        while self.pending and not self.offline():
+            done = self.replay()
+            self._refresh_pending()
+            if not done:
+                break
+        if self.pending == 0:
+            # give up the lease so another worker can take over without waiting it out
+            self._db().execute("UPDATE journal_lease SET expires = 0 WHERE id = 1 AND holder = ?", (self._holder,))
+
+    def save_catalog(self, cat):
+        """Persist the catalog for processes started during an outage; skipped if unchanged."""
+        if not self.enabled():
+            return
+        picked = cat.rows_if_changed(self._snapshot_version)
+        if picked is None:
+            return
+        token, rows = picked
+        saved_at = now_iso()
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM catalog_snapshot")
+            conn.executemany("INSERT OR REPLACE INTO catalog_snapshot VALUES (?, ?)", ((str(r.get("barcode")), json.dumps(r, ensure_ascii=False)) for r in rows))
+            conn.execute("INSERT OR REPLACE INTO journal_meta VALUES ('catalog_saved_at', ?)", (saved_at,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self._snapshot_version = token
+        self.snapshot_saved_at = saved_at
+        self.snapshot_rows = len(rows)
+
+    def load_catalog(self):
+        """Rows of the last saved catalog snapshot (possibly written by another process)."""
+        if not self.enabled():
+            return []
+        conn = self._db()
+        rows = [json.loads(r[0]) for r in conn.execute("SELECT row FROM catalog_snapshot").fetchall()]
+        meta = conn.execute("SELECT value FROM journal_meta WHERE key = 'catalog_saved_at'").fetchone()
+        self.snapshot_saved_at = meta[0] if meta else None
+        self.snapshot_rows = len(rows)
+        return rows
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="offline-journal", daemon=True)
+            self._thread.start()
+        try:
+            if self.enabled():
+                self._refresh_pending()
+        except Exception as e:
+            logger.warning(f"offline journal unavailable: {e}")
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self._tick()
+            except Exception as e:
+                self.last_error = str(e)
+                logger.debug(f"offline journal replay failed: {e}")
+
+    def stats(self):
+        lag = round(time.time() - self._oldest, 1) if self.pending and self._oldest else 0.0
+        return {
+            "mode": OFFLINE_MODE,
+            "enabled": self.enabled(),
+            "offline": self.offline(),
+            "pending": self.pending,
+            "lag_seconds": lag,
+            "journaled": self.journaled,
+            "replayed": self.replayed,
+            "replay_batches": self.replay_batches,
+            "rejected": self.rejected,
+            "stock_conflicts": self.stock_conflicts,
+            "append_failures": self.append_failures,
+            "last_replay_at": self.last_replay_at,
+            "last_error": self.last_error,
+            "catalog_snapshot_at": self.snapshot_saved_at,
+            "catalog_snapshot_rows": self.snapshot_rows,
+            "path": self.path,
+        }
+
+offline_journal = _OfflineJournal()
+
 # ------------------------------------------------------------------
 # DB init check: non-fatal, attempts to seed default user if possible.
 # This function never raises; returns True if DB reachable (best-effort), else False.
@@ -327,7 +2830,7 @@ def ensure_db_initialized():
         return True
     try:
         users, status = supabase_get("users", params={"select": "id", "limit": 1})
-        if users is None:
+        if users is None or status >= 400:
             _db_initialized = False
             return False
         # if no users seed defaults (best-effort)
@@ -349,28 +2852,386 @@ def ensure_db_initialized():
         return False
 
 # ------------------------------------------------------------------
-# Auth decorator - non-fatal and tolerant
-# Accepts header Authorization: Bearer <user_id> (the frontend uses user id)
+# Daily sales totals per (register, day): cash, card, sale count, refunds.
+# Updated incrementally by make_sale / update_sale / delete_sale, rebuilt
+# from Supabase on a cache miss, and reconciled against the source rows every
+# DAILY_TOTALS_RECONCILE_INTERVAL seconds (this also corrects drift from
+# other worker processes). Sales are not tagged with a register yet, so
+# every sale belongs to register 1.
+# ------------------------------------------------------------------
+DAILY_TOTALS_RECONCILE_INTERVAL = float(os.environ.get("DAILY_TOTALS_RECONCILE_INTERVAL", 300.0))
+
+def _today():
+    return datetime.now().strftime("%Y-%m-%d")
+
+class _DailyTotals:
+    def __init__(self, reconcile_interval=DAILY_TOTALS_RECONCILE_INTERVAL):
+        self.reconcile_interval = reconcile_interval
+        self._totals = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.rebuilds = 0
+        self.corrections = 0
+        self.last_reconciled_at = None
+
+    @staticmethod
+    def empty():
+        return {"cash": 0.0, "card": 0.0, "count": 0, "refunds": 0, "refund_amount": 0.0}
+
+    def _load(self, register_id, day):
+        """Compute totals from the source rows; returns None if Supabase could not answer."""
+        (sales, s1), (refunds, s2) = fan_out(
+            lambda: supabase_get("sales", params={"select": "payment_method,total_amount", "sale_date": f"gte.{day}"}),
+            lambda: supabase_get("cash_transactions", params={"select": "amount", "transaction_type": "eq.refund", "transaction_date": f"gte.{day}"}),
+            default=([], 500),
+        )
+        if s1 >= 400 or not isinstance(sales, list):
+            return None
+        totals = self.empty()
+        for sale in sales:
+            self._apply(totals, sale, 1)
+        if s2 < 400 and isinstance(refunds, list):
+            for r in refunds:
+                try:
+                    totals["refund_amount"] += abs(float(r.get("amount", 0) or 0))
+                    totals["refunds"] += 1
+                except Exception:
+                    pass
+        return totals
+
+    @staticmethod
+    def _apply(totals, sale, sign):
+        try:
+            amount = float(sale.get("total_amount", 0) or 0)
+        except Exception:
+            amount = 0.0
+        method = sale.get("payment_method")
+        if method == "nakit":
+            totals["cash"] += sign * amount
+        elif method == "kredi":
+            totals["card"] += sign * amount
+        totals["count"] += sign
+
+    def get(self, register_id=1, day=None):
+        day = day or _today()
+        key = (register_id, day)
+        with self._lock:
+            cached = self._totals.get(key)
+            if cached is not None:
+                return dict(cached)
+        totals = self._load(register_id, day)
+        if totals is None:
+            return self.empty()
+        with self._lock:
+            self.rebuilds += 1
+            # another thread may have rebuilt meanwhile; keep the first copy
+            cached = self._totals.setdefault(key, totals)
+            return dict(cached)
+
+    def _update(self, sale, sign, register_id=1, refund=False):
+        day = _today()
+        if str(sale.get("sale_date") or day) < day:
+            # older sales are outside today's window
+            return
+        with self._lock:
+            totals = self._totals.get((register_id, day))
+            if totals is None:
+                # not loaded yet: the next get() rebuilds from source rows
+                return
+            self._apply(totals, sale, sign)
+            if refund and sale.get("payment_method") == "nakit":
+                totals["refunds"] += 1
+                try:
+                    totals["refund_amount"] += float(sale.get("total_amount", 0) or 0)
+                except Exception:
+                    pass
+
+    def record_sale(self, sale, register_id=1):
+        self._update(sale, 1, register_id)
+
+    def record_update(self, old_sale, new_sale, register_id=1):
+        self._update(old_sale, -1, register_id)
+        self._update(new_sale, 1, register_id)
+
+    def record_delete(self, sale, register_id=1):
+        self._update(sale, -1, register_id, refund=True)
+
+    def reconcile(self):
+        day = _today()
+        with self._lock:
+            # forget previous days
+            for key in [k for k in self._totals if k[1] != day]:
+                del self._totals[key]
+            keys = list(self._totals.keys())
+        for register_id, d in keys:
+            fresh = self._load(register_id, d)
+            if fresh is None:
+                continue
+            with self._lock:
+                current = self._totals.get((register_id, d))
+                if current is not None and any(abs(current[k] - fresh[k]) > 0.005 for k in fresh):
+                    self.corrections += 1
+                    logger.info(f"daily totals drift corrected for register {register_id} {d}: {current} -> {fresh}")
+                self._totals[(register_id, d)] = fresh
+        self.last_reconciled_at = now_iso()
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="daily-totals", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.debug(f"daily totals reconcile failed: {e}")
+
+    def stats(self):
+        return {"keys": len(self._totals), "rebuilds": self.rebuilds, "corrections": self.corrections, "last_reconciled_at": self.last_reconciled_at}
+
+daily_totals = _DailyTotals()
+
+# ------------------------------------------------------------------
+# Health monitor: bootstrap (ensure_db_initialized) runs once on a daemon
+# thread, which then keeps probing Supabase every HEALTH_PROBE_INTERVAL
+# seconds. /health and the request path only read the cached state.
+# ------------------------------------------------------------------
+HEALTH_PROBE_INTERVAL = float(os.environ.get("HEALTH_PROBE_INTERVAL", 30.0))
+
+class _HealthMonitor:
+    def __init__(self, interval=HEALTH_PROBE_INTERVAL):
+        self.interval = interval
+        self.reachable = False
+        self.checked_at = None
+        self.latency_ms = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="health-monitor", daemon=True)
+            self._thread.start()
+
+    def check(self):
+        started = time.time()
+        if not _db_initialized:
+            ok = ensure_db_initialized()
+        else:
+            ok = storage.ping()
+        self.latency_ms = round((time.time() - started) * 1000, 2)
+        self.reachable = bool(ok)
+        self.checked_at = now_iso()
+        return self.reachable
+
+    def _run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                logger.debug(f"health monitor check failed: {e}")
+                self.reachable = False
+            # retry the bootstrap sooner than the steady-state interval
+            time.sleep(self.interval if _db_initialized else min(self.interval, 5.0))
+
+    def stats(self):
+        return {"reachable": self.reachable, "initialized": _db_initialized, "checked_at": self.checked_at, "latency_ms": self.latency_ms, "interval": self.interval}
+
+health_monitor = _HealthMonitor()
+
+def start_background_services():
+    """Start per-process daemons once; cheap to call on every request."""
+    health_monitor.ensure_started()
+    write_behind.ensure_started()
+    daily_totals.ensure_started()
+    catalog.ensure_started()
+    offline_journal.ensure_started()
+
+# ------------------------------------------------------------------
+# Session tokens and auth decorators.
+# login issues "v1.<payload>.<signature>" tokens: base64url JSON claims
+# {uid, role, exp} signed with HMAC-SHA256 under AUTH_TOKEN_SECRET (falls back
+# to SECRET_KEY; set one of them so tokens survive restarts and are valid
+# across workers). require_auth verifies them locally, so the request path
+# never queries users. It stays tolerant: no header, a bad or expired token
+# and (with AUTH_LEGACY_TOKENS, the default) the old "Bearer <user_id>" all
+# still pass, but carry no role; a signed token that fails verification (bad
+# signature, expired, or issued under another secret) is answered with
+# "X-Auth-Status: token_invalid" so the client knows to log in again.
+# require_role(...) guards privileged routes: /api/admin/* always, product
+# import and table export unless AUTH_ADMIN_BULK=0 (they were open to any
+# caller, legacy and anonymous ones included, before). A denied call gets the
+# usual 200 JSON with note "forbidden", or "token_invalid" when logging in
+# again would help. The token role is re-checked against the user cache, so a
+# role changed in Supabase takes effect within USER_CACHE_TTL instead of at
+# token expiry.
+# login always reads the users row (one query, password hash compared
+# locally), so a changed password or deleted user cannot log in again; the
+# row it reads refreshes the role cache. last_login is written off the
+# response path.
 # ------------------------------------------------------------------
+AUTH_TOKEN_SECRET = os.environ.get("AUTH_TOKEN_SECRET") or app.config["SECRET_KEY"]
+AUTH_TOKEN_TTL = float(os.environ.get("AUTH_TOKEN_TTL", 43200.0))
+AUTH_LEGACY_TOKENS = os.environ.get("AUTH_LEGACY_TOKENS", "1") != "0"
+AUTH_ADMIN_BULK = os.environ.get("AUTH_ADMIN_BULK", "1") != "0"
+USER_CACHE_TTL = float(os.environ.get("USER_CACHE_TTL", 300.0))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 1000))
+_AUTH_KEY = AUTH_TOKEN_SECRET.encode("utf-8")
+if not os.environ.get("AUTH_TOKEN_SECRET") and not os.environ.get("SECRET_KEY"):
+    logger.warning("AUTH_TOKEN_SECRET/SECRET_KEY not set: session tokens are only valid in this process until it restarts")
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _sign(body):
+    return _b64(hmac.new(_AUTH_KEY, body.encode("ascii"), hashlib.sha256).digest())
+
+def issue_token(user, ttl=None):
+    claims = {"uid": user.get("id"), "role": user.get("role"), "exp": int(time.time() + (AUTH_TOKEN_TTL if ttl is None else ttl))}
+    body = "v1." + _b64(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+    return f"{body}.{_sign(body)}"
+
+def verify_token(token):
+    """Claims of a correctly signed, unexpired token, else None."""
+    try:
+        version, payload, sig = token.split(".")
+        if version != "v1" or not hmac.compare_digest(sig, _sign(f"{version}.{payload}")):
+            return None
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        if not isinstance(claims, dict) or float(claims.get("exp", 0)) < time.time():
+            return None
+        return claims
+    except Exception:
+        return None
+
+class _UserCache:
+    def __init__(self, ttl=USER_CACHE_TTL, maxsize=USER_CACHE_SIZE):
+        self._by_id = _TTLCache(maxsize=maxsize, ttl=ttl)
+        self.fetches = 0
+
+    def _fetch(self, filters):
+        self.fetches += 1
+        users, st = supabase_get("users", params=dict(filters, select="id,username,password,full_name,role", limit=1))
+        row = users[0] if st < 400 and isinstance(users, list) and users else None
+        if row is not None:
+            # only the role is served from the cache; keep the hash out of it
+            self._by_id.set(row.get("id"), {k: v for k, v in row.items() if k != "password"})
+        return row, st
+
+    def authenticate(self, username, hashed):
+        """(user row, status) when username/hashed match, else (None, status);
+        status >= 500 means Supabase could not answer. Never served from the
+        cache, so credentials are checked against the current row."""
+        row, st = self._fetch({"username": f"eq.{username}"})
+        if row is not None and hmac.compare_digest(str(row.get("password") or ""), hashed):
+            return row, st
+        return None, st
+
+    def role(self, user_id):
+        """Current role of user_id (cached): "" for a user that no longer exists,
+        None if Supabase could not tell."""
+        row = self._by_id.get(user_id)
+        if row is None:
+            row, st = self._fetch({"id": f"eq.{user_id}"})
+            if row is None:
+                return "" if st < 400 else None
+        return row.get("role") or ""
+
+    def invalidate(self, user_id=None):
+        """Forget one user, or everyone when called without arguments."""
+        if user_id is None:
+            self._by_id.clear()
+            return
+        self._by_id.pop(user_id)
+
+    def stats(self):
+        return {"by_id": self._by_id.stats(), "fetches": self.fetches}
+
+user_cache = _UserCache()
+
+def record_last_login(user_id):
+    """PATCH users.last_login on the fan-out pool instead of the response path."""
+    if user_id is None:
+        return
+
+    def run():
+        try:
+            supabase_patch("users", {"id": f"eq.{user_id}"}, {"last_login": now_iso()})
+        except Exception as e:
+            logger.debug(f"last_login update failed: {e}")
+
+    try:
+        _fanout_pool.submit(run)
+    except Exception as e:
+        logger.debug(f"last_login submit failed: {e}")
+
 def require_auth(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
+        request.user_id = 1
+        request.user_role = None
+        request.token_invalid = False
         try:
             auth = request.headers.get("Authorization")
             if not auth:
                 # For maximum tolerance, allow anonymous calls but set user_id=1 (system)
-                request.user_id = 1
                 return f(*args, **kwargs)
             token = auth.replace("Bearer ", "").strip()
-            if token.isdigit():
+            if token.startswith("v1."):
+                claims = verify_token(token)
+                if claims is not None:
+                    request.user_id = claims.get("uid", 1)
+                    request.user_role = claims.get("role")
+                else:
+                    request.token_invalid = True
+            elif token.isdigit() and AUTH_LEGACY_TOKENS:
                 request.user_id = int(token)
-            else:
-                request.user_id = 1
         except Exception:
             request.user_id = 1
-        return f(*args, **kwargs)
+            request.user_role = None
+        if not request.token_invalid:
+            return f(*args, **kwargs)
+        # still served as before (tolerant), but tell the client its session is gone
+        resp = make_response(f(*args, **kwargs))
+        resp.headers["X-Auth-Status"] = "token_invalid"
+        return resp
     return wrapper
 
+def require_role(*roles, enforce=True):
+    """Allow the route only for signed tokens whose role is in roles; use below @require_auth.
+    With enforce=False the route is left open."""
+    def decorator(f):
+        if not enforce:
+            return f
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            role = getattr(request, "user_role", None)
+            if role in roles:
+                # the user's role may have been changed since the token was issued
+                current = user_cache.role(request.user_id)
+                if current is not None:
+                    role = current
+            if role not in roles:
+                metrics.inc("auth_denied_total", (("route", request.url_rule.rule if request.url_rule is not None else request.path),))
+                if getattr(request, "token_invalid", False):
+                    return jsonify({"status": "success", "message": "Oturumunuzun süresi doldu, lütfen tekrar giriş yapın", "note": "token_invalid"})
+                return jsonify({"status": "success", "message": "Bu işlem için yetkiniz yok", "note": "forbidden"})
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+metrics.describe("auth_denied_total", "counter", "Requests rejected by a role check.")
+
 # ------------------------------------------------------------------
 # Transaction decorator - catches exceptions and returns safe JSON
 # ------------------------------------------------------------------
@@ -381,9 +3242,200 @@ def transaction_handler(f):
             return f(*args, **kwargs)
         except Exception as e:
             logger.debug(f"transaction_handler caught: {e}")
+            metrics.inc("swallowed_exceptions_total", (("handler", "transaction_handler"), ("exception", type(e).__name__)))
+            skip_idempotent_store()
             return jsonify({"status": "success", "message": "İşlem tamamlandı", "note": "handled_exception"}), 200
     return wrapper
 
+# ------------------------------------------------------------------
+# Idempotency keys for mutating endpoints.
+# A client may send "Idempotency-Key: <unique id>" with a mutation; the first
+# response for (user, method, path, key) is stored for IDEMPOTENCY_TTL seconds
+# and replayed to retries (marked "Idempotent-Replayed: true"). A duplicate
+# that arrives while the original is still running waits for it (up to
+# IDEMPOTENCY_WAIT seconds) instead of executing twice; if it is still running
+# after that the duplicate gets 409 with "status": "pending" and Retry-After.
+# Reusing a key with a different body gets 422 with "status": "conflict".
+# Neither is "success": the mutation may not have happened. Responses of
+# calls that hit a handled exception are not stored, so a retry runs again.
+# With IDEMPOTENCY_DB set to a file path the store is also persisted in
+# SQLite, which lets worker processes on the same host share keys and keeps
+# them across restarts; a claim left by a worker that died mid-request is
+# taken over after IDEMPOTENCY_CLAIM_TIMEOUT.
+# ------------------------------------------------------------------
+IDEMPOTENCY_TTL = float(os.environ.get("IDEMPOTENCY_TTL", 86400.0))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("IDEMPOTENCY_MAX_KEYS", 10000))
+IDEMPOTENCY_WAIT = float(os.environ.get("IDEMPOTENCY_WAIT", 30.0))
+IDEMPOTENCY_DB = os.environ.get("IDEMPOTENCY_DB", "")
+IDEMPOTENCY_CLAIM_TIMEOUT = float(os.environ.get("IDEMPOTENCY_CLAIM_TIMEOUT", 120.0))
+
+class _IdempotencyStore:
+    def __init__(self, ttl=IDEMPOTENCY_TTL, maxsize=IDEMPOTENCY_MAX_KEYS, path=IDEMPOTENCY_DB):
+        self.ttl = ttl
+        self.path = path
+        self._cache = _TTLCache(maxsize=maxsize, ttl=ttl)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._schema_ready = False
+        self.replayed = 0
+        self.coalesced = 0
+        self.mismatches = 0
+        self.stored = 0
+        self.db_errors = 0
+
+    def _db(self):
+        if not self.path:
+            return None
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.execute("CREATE TABLE IF NOT EXISTS idempotency_keys (key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, status INTEGER NOT NULL, mimetype TEXT, body BLOB, created REAL NOT NULL)")
+                self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _db_claim(self, key, fingerprint):
+        """Claim key in SQLite. Returns ("owner", None), ("done", entry) or ("pending", None)."""
+        try:
+            conn = self._db()
+            now = time.time()
+            conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND ((status = 0 AND created < ?) OR created < ?)", (key, now - IDEMPOTENCY_CLAIM_TIMEOUT, now - self.ttl))
+            if conn.execute("INSERT OR IGNORE INTO idempotency_keys VALUES (?, ?, 0, NULL, NULL, ?)", (key, fingerprint, now)).rowcount == 1:
+                return "owner", None
+            row = conn.execute("SELECT fingerprint, status, mimetype, body FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return "pending", None
+            if row[1] == 0:
+                return "pending", None
+            return "done", {"fingerprint": row[0], "status": row[1], "mimetype": row[2], "body": bytes(row[3] or b"")}
+        except Exception as e:
+            self.db_errors += 1
+            logger.debug(f"idempotency db claim failed: {e}")
+            return "owner", None
+
+    def _db_finish(self, key, entry):
+        try:
+            conn = self._db()
+            if entry is None:
+                conn.execute("DELETE FROM idempotency_keys WHERE key = ? AND status = 0", (key,))
+            else:
+                conn.execute("UPDATE idempotency_keys SET status = ?, mimetype = ?, body = ? WHERE key = ?", (entry["status"], entry["mimetype"], entry["body"], key))
+                if self.stored % 500 == 0:
+                    conn.execute("DELETE FROM idempotency_keys WHERE created < ?", (time.time() - self.ttl,))
+        except Exception as e:
+            self.db_errors += 1
+            logger.debug(f"idempotency db finish failed: {e}")
+
+    def begin(self, key, fingerprint):
+        """("owner", None) when the caller must execute the request, ("replay", entry) for a
+        stored response, ("mismatch", entry) for a key reused with another body, or
+        ("busy", None) when the original is still running after IDEMPOTENCY_WAIT."""
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        waited = False
+        while True:
+            with self._lock:
+                entry = self._cache.get(key)
+                event = None if entry is not None else self._inflight.get(key)
+                if entry is None and event is None:
+                    event = self._inflight[key] = threading.Event()
+                    owner = True
+                else:
+                    owner = False
+            if entry is not None:
+                return self._resolved(entry, fingerprint, waited)
+            remaining = deadline - time.monotonic()
+            if not owner:
+                waited = True
+                if remaining <= 0 or not event.wait(remaining):
+                    return "busy", None
+                continue
+            if not self.path:
+                return "owner", None
+            state, entry = self._db_claim(key, fingerprint)
+            if state == "owner":
+                return "owner", None
+            if state == "done":
+                self._cache.set(key, entry)
+                self._release(key)
+                return self._resolved(entry, fingerprint, waited)
+            # another process is executing it: hold the local claim and poll
+            self._release(key)
+            waited = True
+            if remaining <= 0:
+                return "busy", None
+            time.sleep(min(0.05, remaining))
+
+    def _resolved(self, entry, fingerprint, waited):
+        if entry["fingerprint"] != fingerprint:
+            self.mismatches += 1
+            return "mismatch", entry
+        if waited:
+            self.coalesced += 1
+        self.replayed += 1
+        return "replay", entry
+
+    def _release(self, key):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def finish(self, key, entry):
+        """Store the owner's response (or drop the claim when entry is None) and wake waiters."""
+        if entry is not None:
+            self._cache.set(key, entry)
+            self.stored += 1
+        if self.path:
+            self._db_finish(key, entry)
+        self._release(key)
+
+    def stats(self):
+        return {"keys": self._cache.stats()["size"], "inflight": len(self._inflight), "persisted": bool(self.path), "stored": self.stored, "replayed": self.replayed, "coalesced": self.coalesced, "mismatches": self.mismatches, "db_errors": self.db_errors}
+
+idempotency_store = _IdempotencyStore()
+
+def skip_idempotent_store():
+    """Do not keep this request's response for Idempotency-Key replays (e.g. it only partly ran)."""
+    if has_request_context():
+        g.idempotency_skip = True
+
+def idempotent(f):
+    """Replay/coalesce requests that carry an Idempotency-Key header; see the section comment."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        raw_key = (request.headers.get("Idempotency-Key") or "").strip()
+        if not raw_key:
+            return f(*args, **kwargs)
+        if len(raw_key) > 255:
+            return jsonify({"status": "error", "message": "Idempotency-Key çok uzun", "note": "idempotency_key_invalid", "errors": ["Idempotency-Key en fazla 255 karakter olabilir"]}), 400
+        key = f"{getattr(request, 'user_id', 1)}:{request.method}:{request.path}:{raw_key}"
+        fingerprint = hashlib.sha256(request.get_data(cache=True)).hexdigest()
+        state, entry = idempotency_store.begin(key, fingerprint)
+        if state == "mismatch":
+            return jsonify({"status": "conflict", "message": "Bu Idempotency-Key farklı bir istek için kullanılmış", "note": "idempotency_key_reused", "errors": ["Idempotency-Key farklı bir istek gövdesiyle tekrar kullanılamaz"]}), 422
+        if state == "busy":
+            resp = jsonify({"status": "pending", "message": "Aynı istek hâlâ işleniyor, lütfen tekrar deneyin", "note": "idempotency_in_progress"})
+            resp.status_code = 409
+            resp.headers["Retry-After"] = "1"
+            return resp
+        if state == "replay":
+            resp = app.response_class(entry["body"], status=entry["status"], mimetype=entry["mimetype"])
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+        stored = None
+        try:
+            resp = app.make_response(f(*args, **kwargs))
+            if resp.status_code < 500 and not resp.is_streamed and not g.get("idempotency_skip"):
+                stored = {"fingerprint": fingerprint, "status": resp.status_code, "mimetype": resp.mimetype, "body": resp.get_data()}
+            return resp
+        finally:
+            idempotency_store.finish(key, stored)
+    return wrapper
+
 # ------------------------------------------------------------------
 # Validation helpers (defensive)
 # ------------------------------------------------------------------
@@ -431,48 +3483,91 @@ def static_files(path):
     except Exception:
         return "", 204
 
-@app.route("/")
-def index():
-    try:
-        ensure_db_initialized()
-        hostname = socket.gethostname()
+# ------------------------------------------------------------------
+# Index page cache: resolved local IP, QR data URI and (optionally) the
+# rendered page are cached per request.host, so repeat loads skip DNS,
+# QR rasterisation and template rendering. INDEX_PRERENDER=0 disables the
+# page cache but keeps the IP/QR caches.
+# ------------------------------------------------------------------
+INDEX_CACHE_TTL = float(os.environ.get("INDEX_CACHE_TTL", 600))
+INDEX_CACHE_SIZE = int(os.environ.get("INDEX_CACHE_SIZE", 32))
+INDEX_PRERENDER = os.environ.get("INDEX_PRERENDER", "1") != "0"
+
+_local_ip_cache = _TTLCache(maxsize=4, ttl=INDEX_CACHE_TTL)
+_qr_cache = _TTLCache(maxsize=INDEX_CACHE_SIZE, ttl=INDEX_CACHE_TTL)
+_index_page_cache = _TTLCache(maxsize=INDEX_CACHE_SIZE, ttl=INDEX_CACHE_TTL)
+
+def _local_ip():
+    hostname = socket.gethostname()
+    local_ip = _local_ip_cache.get(hostname)
+    if local_ip is None:
         try:
             local_ip = socket.gethostbyname(hostname)
         except Exception:
             local_ip = "localhost"
-        # generate QR for convenience
+        _local_ip_cache.set(hostname, local_ip)
+    return local_ip
+
+def _qr_data_uri(host):
+    qr_src = _qr_cache.get(host)
+    if qr_src is None:
         try:
             qr = qrcode.QRCode(version=1, box_size=6, border=2)
-            qr.add_data(f"https://{request.host}")
+            qr.add_data(f"https://{host}")
             qr.make(fit=True)
             img = qr.make_image(fill_color="black", back_color="white")
             buffer = io.BytesIO()
             img.save(buffer, format="PNG")
             qr_src = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
         except Exception:
-            qr_src = ""
+            # do not cache failures
+            return ""
+        _qr_cache.set(host, qr_src)
+    return qr_src
+
+def _html_response(body, etag):
+    if etag_matches(etag):
+        resp = Response(status=304)
+    else:
+        resp = Response(body, mimetype="text/html")
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+@app.route("/")
+def index():
+    try:
+        host = request.host
+        if INDEX_PRERENDER:
+            cached = _index_page_cache.get(host)
+            if cached is not None:
+                return _html_response(*cached)
+        local_ip = _local_ip()
+        # generate QR for convenience
+        qr_src = _qr_data_uri(host)
         # Try render template if exists
         try:
-            return render_template("index.html", local_ip=local_ip, qr_code=qr_src)
+            body = render_template("index.html", local_ip=local_ip, qr_code=qr_src)
         except Exception:
             return jsonify({"status": "success", "local_ip": local_ip, "qr_code": qr_src})
+        etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+        if INDEX_PRERENDER:
+            _index_page_cache.set(host, (body, etag))
+        return _html_response(body, etag)
     except Exception:
         return jsonify({"status": "success", "local_ip": "localhost", "qr_code": ""})
 
 @app.route("/health")
 def health():
-    ok = ensure_db_initialized()
-    return jsonify({"status": "success", "db_reachable": bool(ok), "timestamp": now_iso()})
+    return jsonify({"status": "success", "db_reachable": health_monitor.reachable, "health": health_monitor.stats(), "http_pool": http_pool.stats(), "write_behind": write_behind.stats(), "circuit_breaker": circuit_breaker.stats(), "daily_totals": daily_totals.stats(), "catalog": catalog.stats(), "idempotency": idempotency_store.stats(), "tracer": request_tracer.stats(), "storage": storage.stats(), "offline": offline_journal.stats(), "auth": user_cache.stats(), "timestamp": now_iso()})
 
 # ------------------------------------------------------------------
 # AUTH
 # ------------------------------------------------------------------
+_GUEST_USER = {"id": 1, "username": "guest", "full_name": "Guest", "role": "user"}
+
 @app.route("/api/auth/login", methods=["POST"])
 def login():
-    try:
-        ensure_db_initialized()
-    except Exception:
-        pass
     data = request.get_json() or {}
     username = data.get("username")
     password = data.get("password")
@@ -480,29 +3575,23 @@ def login():
         # Provide offline login for default admin to keep frontend usable
         if username == "admin" and password == "admin123321":
             user = {"id": 1, "username": "admin", "full_name": "Sistem Yöneticisi", "role": "admin"}
-            return jsonify({"status": "success", "user": user, "token": str(user["id"])})
-        return jsonify({"status": "success", "message": "Eksik kullanıcı veya şifre (allowed guest)", "user": {"id": 1, "username": "guest", "full_name": "Guest", "role": "user"}, "token": "1"})
+            return jsonify({"status": "success", "user": user, "token": issue_token(user)})
+        return jsonify({"status": "success", "message": "Eksik kullanıcı veya şifre (allowed guest)", "user": _GUEST_USER, "token": issue_token(_GUEST_USER)})
     try:
-        hashed = hash_password(password)
-        params = build_filters({"username": f"eq.{username}", "password": f"eq.{hashed}"})
-        users, st = supabase_get("users", params=params)
-        if isinstance(users, list) and len(users) > 0:
-            user = users[0]
-            # best-effort update last_login
-            try:
-                supabase_patch("users", {"id": f"eq.{user.get('id')}"}, {"last_login": now_iso()})
-            except Exception:
-                pass
-            return jsonify({"status": "success", "user": {"id": user.get("id"), "username": user.get("username"), "full_name": user.get("full_name"), "role": user.get("role")}, "token": str(user.get("id"))})
-        # fallback: if DB has issue, allow default admin credentials
-        if username == "admin" and password == "admin123321":
+        user, st = user_cache.authenticate(username, hash_password(password))
+        if user is not None:
+            record_last_login(user.get("id"))
+            user = {"id": user.get("id"), "username": user.get("username"), "full_name": user.get("full_name"), "role": user.get("role")}
+            return jsonify({"status": "success", "user": user, "token": issue_token(user)})
+        # fallback: if the DB cannot answer, allow default admin credentials
+        if st >= 500 and username == "admin" and password == "admin123321":
             user = {"id": 1, "username": "admin", "full_name": "Sistem Yöneticisi", "role": "admin"}
-            return jsonify({"status": "success", "user": user, "token": str(user["id"])})
+            return jsonify({"status": "success", "user": user, "token": issue_token(user)})
         # otherwise return success with guest to avoid errors in frontend
-        return jsonify({"status": "success", "message": "Giriş sağlanamadı", "user": {"id": 1, "username": "guest", "full_name": "Guest", "role": "user"}, "token": "1"})
+        return jsonify({"status": "success", "message": "Giriş sağlanamadı", "user": _GUEST_USER, "token": issue_token(_GUEST_USER)})
     except Exception as e:
         logger.debug(f"login exception: {e}")
-        return jsonify({"status": "success", "message": "Giriş sırasında hata, guest user verildi", "user": {"id": 1, "username": "guest", "full_name": "Guest", "role": "user"}, "token": "1"})
+        return jsonify({"status": "success", "message": "Giriş sırasında hata, guest user verildi", "user": _GUEST_USER, "token": issue_token(_GUEST_USER)})
 
 # ------------------------------------------------------------------
 # PRODUCTS
@@ -510,17 +3599,39 @@ def login():
 @app.route("/api/products", methods=["GET"])
 @require_auth
 def get_products():
+    """Full catalog, or only what changed with ?since=<version or ISO timestamp>.
+    While the catalog cache is warm the response carries a strong ETag (the
+    catalog version) and If-None-Match is answered with 304."""
     try:
+        since = request.args.get("since")
+        if since:
+            delta = catalog.delta(since)
+            if delta is not None:
+                version, changed, deleted = delta
+                resp = jsonify({"status": "success", "full": False, "version": version, "products": changed, "deleted": deleted})
+                resp.headers["Cache-Control"] = "no-cache"
+                return resp
+        version, products = catalog.snapshot()
+        if version is not None:
+            etag = f"catalog-{version}"
+            if etag_matches(etag):
+                resp = Response(status=304)
+            else:
+                resp = jsonify({"status": "success", "full": True, "version": version, "products": products})
+            resp.set_etag(etag)
+            resp.headers["Cache-Control"] = "no-cache"
+            return resp
         products, st = supabase_get("products", params={"order": "name.asc"})
         if products is None:
             products = []
-        return jsonify({"status": "success", "products": products})
+        return jsonify({"status": "success", "full": True, "version": None, "products": products})
     except Exception as e:
         logger.debug(f"get_products exception: {e}")
         return jsonify({"status": "success", "products": []})
 
 @app.route("/api/products", methods=["POST"])
 @require_auth
+@idempotent
 def add_product():
     try:
         data = request.get_json() or {}
@@ -537,15 +3648,53 @@ def add_product():
             "min_stock_level": int(data.get("min_stock_level", 5)),
             "created_at": now_iso()
         }
-        created, st = supabase_post("products", payload)
+        created, st = supabase_post("products", payload, prefer="return=representation")
+        if st < 400:
+            catalog.upsert_rows(created if isinstance(created, list) and created else [payload])
         # always return success for frontend stability
         return jsonify({"status": "success", "message": "Ürün eklendi (veya işaretlendi)", "product": payload})
     except Exception as e:
         logger.debug(f"add_product exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Ürün eklendi (fallback)", "product": data})
 
+@app.route("/api/products/search", methods=["GET"])
+@require_auth
+def search_products():
+    try:
+        q = (request.args.get("q") or "").strip()
+        limit = parse_limit(request.args.get("limit"), default=SEARCH_DEFAULT_LIMIT, maximum=SEARCH_MAX_LIMIT)
+        if not q:
+            return jsonify({"status": "success", "products": []})
+        if catalog.is_fresh():
+            products = search_index.search(q, limit)
+        else:
+            # cold cache: plain PostgREST match (no Turkish folding)
+            needle = q.replace(",", " ").replace("(", " ").replace(")", " ")
+            products, st = supabase_get("products", params={"or": f"(barcode.like.{needle}*,name.ilike.*{needle}*)", "order": "name.asc", "limit": limit})
+            if not isinstance(products, list):
+                products = []
+        return jsonify({"status": "success", "products": products})
+    except Exception as e:
+        logger.debug(f"search_products exception: {e}")
+        return jsonify({"status": "success", "products": []})
+
+@app.route("/api/products/<barcode>", methods=["GET"])
+@require_auth
+def get_product(barcode):
+    try:
+        found, _ = catalog.lookup([barcode])
+        product = found.get(str(barcode))
+        if product is None:
+            return jsonify({"status": "success", "message": "Ürün bulunamadı", "product": None})
+        return jsonify({"status": "success", "product": product})
+    except Exception as e:
+        logger.debug(f"get_product exception: {e}")
+        return jsonify({"status": "success", "product": None})
+
 @app.route("/api/products/<barcode>", methods=["PUT"])
 @require_auth
+@idempotent
 def put_product(barcode):
     try:
         data = request.get_json() or {}
@@ -555,28 +3704,246 @@ def put_product(barcode):
             if k in data:
                 update_payload[k] = data[k]
         if update_payload:
-            supabase_patch("products", build_filters({"barcode": f"eq.{barcode}"}), update_payload)
+            updated, st = supabase_patch("products", build_filters({"barcode": f"eq.{barcode}"}), update_payload, prefer="return=representation")
+            if st < 400:
+                if isinstance(updated, list) and updated:
+                    catalog.upsert_rows(updated)
+                else:
+                    catalog.patch(barcode, update_payload)
+            elif st >= 500:
+                # not applied: let a retry with the same key run again
+                skip_idempotent_store()
         return jsonify({"status": "success", "message": "Ürün güncellendi"})
     except Exception as e:
         logger.debug(f"put_product exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Ürün güncellendi (fallback)"})
 
 @app.route("/api/products/<barcode>", methods=["DELETE"])
 @require_auth
+@idempotent
 def del_product(barcode):
     try:
-        supabase_delete("products", build_filters({"barcode": f"eq.{barcode}"}))
+        deleted, st = supabase_delete("products", build_filters({"barcode": f"eq.{barcode}"}))
+        if st < 400:
+            catalog.remove(barcode)
+        elif st >= 500:
+            skip_idempotent_store()
         return jsonify({"status": "success", "message": "Ürün silindi (veya işaretlendi)"})
     except Exception as e:
         logger.debug(f"del_product exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Ürün silindi (fallback)"})
 
+# ------------------------------------------------------------------
+# BULK IMPORT
+# POST /api/products/import takes a CSV (header row) or NDJSON upload, either
+# as the raw request body or as a multipart "file" field, and parses it as a
+# stream. Rows are validated with validate_product_data and upserted on
+# barcode in chunks of IMPORT_CHUNK_SIZE (?chunk=). New products get the same
+# defaults as POST /api/products; existing ones only receive the columns the
+# file provides; a chunk whose barcodes could not be looked up is not written.
+# Progress is resumable: the response carries committed_rows,
+# and re-posting the same file with ?skip=<committed_rows> continues after the
+# last chunk that was written. ?dry_run=1 validates without writing.
+# ------------------------------------------------------------------
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 500))
+IMPORT_MAX_CHUNK = int(os.environ.get("IMPORT_MAX_CHUNK", 2000))
+IMPORT_MAX_ERRORS = int(os.environ.get("IMPORT_MAX_ERRORS", 200))
+
+_IMPORT_FIELDS = ("barcode", "name", "price", "quantity", "kdv", "otv", "min_stock_level")
+_IMPORT_ALIASES = {"barkod": "barcode", "ad": "name", "isim": "name", "urun": "name", "urun_adi": "name", "fiyat": "price", "miktar": "quantity", "stok": "quantity", "min_stok": "min_stock_level"}
+_IMPORT_CASTS = {"price": float, "quantity": int, "kdv": float, "otv": float, "min_stock_level": int}
+
+def _import_source():
+    """(format, binary stream) for the uploaded file or the raw request body; the
+    stream is None for a form body without a "file" field (parsing the form has
+    already consumed the raw body)."""
+    upload = request.files.get("file") if request.files else None
+    if upload is not None:
+        stream, name, ctype = upload.stream, upload.filename or "", upload.mimetype or ""
+    elif request.mimetype in ("multipart/form-data", "application/x-www-form-urlencoded"):
+        stream, name, ctype = None, "", ""
+    else:
+        stream, name, ctype = request.stream, "", request.mimetype or ""
+    fmt = (request.args.get("format") or "").lower()
+    if fmt not in ("csv", "ndjson"):
+        lowered = name.lower()
+        fmt = "ndjson" if ("ndjson" in ctype or "jsonl" in ctype or "json" in ctype or lowered.endswith((".ndjson", ".jsonl", ".json"))) else "csv"
+    return fmt, stream
+
+def _import_records(fmt, stream):
+    """Yield (row_number, record or None, parse error) for each data row, 1-based."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    if fmt == "ndjson":
+        n = 0
+        for line in text:
+            if not line.strip():
+                continue
+            n += 1
+            try:
+                rec = json.loads(line)
+                yield (n, rec, None) if isinstance(rec, dict) else (n, None, "Satır bir JSON nesnesi değil")
+            except ValueError:
+                yield n, None, "Geçersiz JSON"
+        return
+    reader = csv.reader(text)
+    header = None
+    n = 0
+    for values in reader:
+        if not any(v.strip() for v in values):
+            continue
+        if header is None:
+            header = []
+            for h in values:
+                key = search_key(h).replace(" ", "_")
+                header.append(_IMPORT_ALIASES.get(key, key))
+            continue
+        n += 1
+        if len(values) > len(header):
+            yield n, None, "Fazla sütun"
+            continue
+        yield n, {k: v.strip() for k, v in zip(header, values) if k in _IMPORT_FIELDS and v.strip() != ""}, None
+
+def _import_row(rec):
+    """(payload, errors) for one parsed record; payload holds only the provided columns."""
+    rec = {k: rec[k] for k in _IMPORT_FIELDS if rec.get(k) not in (None, "")}
+    errors = validate_product_data(rec)
+    if errors:
+        return None, errors
+    payload = {"barcode": str(rec["barcode"]).strip()}
+    for k in _IMPORT_FIELDS[1:]:
+        if k in rec:
+            try:
+                payload[k] = _IMPORT_CASTS[k](rec[k]) if k in _IMPORT_CASTS else str(rec[k]).strip()
+            except (TypeError, ValueError):
+                try:
+                    payload[k] = int(float(rec[k]))
+                except (TypeError, ValueError):
+                    errors.append(f"{k} numeric olmalıdır")
+    return (None, errors) if errors else (payload, [])
+
+def _import_chunk(rows):
+    """Write one chunk of validated rows; returns (written_rows, status).
+    New barcodes are inserted with the POST /api/products defaults; existing
+    products (and ones created meanwhile) only get the columns the file gave."""
+    # last occurrence wins: one upsert may not touch the same barcode twice
+    by_barcode = {}
+    for r in rows:
+        by_barcode.pop(r["barcode"], None)
+        by_barcode[r["barcode"]] = r
+    existing, st = catalog.lookup(list(by_barcode))
+    if st >= 400:
+        # a barcode we could not check may exist: never give it placeholder values
+        return [], st
+    start_request_deadline()
+    written = []
+    updates = [r for barcode, r in by_barcode.items() if barcode in existing]
+    new_rows = [{"barcode": barcode, "name": r.get("name") or f"Ürün-{barcode}", "price": r.get("price", 0.0), "quantity": r.get("quantity", 0), "kdv": r.get("kdv", 18.0), "otv": r.get("otv", 0.0), "min_stock_level": r.get("min_stock_level", 5), "created_at": now_iso()} for barcode, r in by_barcode.items() if barcode not in existing]
+    if new_rows:
+        inserted, st = supabase_post_many("products", new_rows, params={"on_conflict": "barcode"}, prefer="resolution=ignore-duplicates,return=representation")
+        if st >= 400:
+            return [], st
+        inserted = [r for r in inserted if isinstance(r, dict)] if isinstance(inserted, list) else []
+        catalog.upsert_rows(inserted)
+        written.extend(inserted)
+        # created by someone else since the lookup: update it like an existing one
+        done = {str(r.get("barcode")) for r in inserted}
+        updates.extend(by_barcode[r["barcode"]] for r in new_rows if r["barcode"] not in done)
+    if updates:
+        merged, st = supabase_post_many("products", updates, params={"on_conflict": "barcode"}, prefer="resolution=merge-duplicates,return=representation")
+        if st >= 400:
+            return written, st
+        merged = [r for r in merged if isinstance(r, dict)] if isinstance(merged, list) else []
+        catalog.upsert_rows(merged)
+        written.extend(merged)
+    return written, 200
+
+@app.route("/api/products/import", methods=["POST"])
+@require_auth
+@require_role("admin", enforce=AUTH_ADMIN_BULK)
+def import_products():
+    started = time.monotonic()
+    result = {"status": "success", "format": None, "processed": 0, "imported": 0, "failed": 0, "skipped": 0, "committed_rows": 0, "chunks": 0, "complete": False, "errors": []}
+    try:
+        skip = max(int(request.args.get("skip", 0) or 0), 0)
+        chunk_size = parse_limit(request.args.get("chunk"), default=IMPORT_CHUNK_SIZE, maximum=IMPORT_MAX_CHUNK)
+        dry_run = request.args.get("dry_run") in ("1", "true")
+        fmt, stream = _import_source()
+        result["format"] = fmt
+        if stream is None:
+            result["message"] = "Yüklenecek dosya bulunamadı; dosyayı \"file\" alanında ya da istek gövdesi olarak gönderin"
+            result["note"] = "no_upload"
+            return jsonify(result)
+        result["committed_rows"] = skip
+        pending = []
+        # failures among the rows of the chunk being collected: if that chunk is
+        # not written they are read again after ?skip=, so they are not counted
+        pending_failures = []
+        last_row = skip
+
+        def fail(row_no, barcode, errors):
+            result["failed"] += 1
+            entry = {"row": row_no, "barcode": barcode, "errors": errors}
+            if len(result["errors"]) < IMPORT_MAX_ERRORS:
+                result["errors"].append(entry)
+            if pending:
+                pending_failures.append(entry)
+            else:
+                # nothing unwritten before it: a resume can start after this row
+                result["committed_rows"] = row_no
+
+        def flush():
+            if pending and not dry_run:
+                written, st = _import_chunk(pending)
+                if st >= 400:
+                    result["failed"] -= len(pending_failures)
+                    result["errors"] = [e for e in result["errors"] if e not in pending_failures]
+                    return False
+                result["chunks"] += 1
+            result["imported"] += len(pending)
+            result["committed_rows"] = last_row
+            pending.clear()
+            pending_failures.clear()
+            return True
+
+        for row_no, rec, parse_error in _import_records(fmt, stream):
+            if row_no <= skip:
+                result["skipped"] += 1
+                continue
+            result["processed"] += 1
+            last_row = row_no
+            if parse_error:
+                fail(row_no, None, [parse_error])
+                continue
+            payload, errors = _import_row(rec)
+            if errors:
+                fail(row_no, rec.get("barcode"), errors)
+                continue
+            pending.append(payload)
+            if len(pending) >= chunk_size and not flush():
+                result["message"] = f"İçe aktarma {result['committed_rows']}. satırdan sonra durdu; skip={result['committed_rows']} ile devam edin"
+                return jsonify(result)
+        if not flush():
+            result["message"] = f"İçe aktarma {result['committed_rows']}. satırdan sonra durdu; skip={result['committed_rows']} ile devam edin"
+            return jsonify(result)
+        result["complete"] = True
+        result["message"] = f"{result['imported']} ürün {'doğrulandı' if dry_run else 'içe aktarıldı'}, {result['failed']} satır hatalı"
+        return jsonify(result)
+    except Exception as e:
+        logger.debug(f"import_products exception: {e}")
+        result["message"] = "İçe aktarma yarıda kaldı (fallback)"
+        return jsonify(result)
+    finally:
+        logger.info(f"import_products: {result['imported']} rows in {result['chunks']} chunks, {result['failed']} failed, {(time.monotonic() - started) * 1000:.0f} ms")
+
 # ------------------------------------------------------------------
 # STOCK
 # frontend uses /api/stock/add and quickAddStock sends quantity as difference
 # ------------------------------------------------------------------
 @app.route("/api/stock/add", methods=["POST"])
 @require_auth
+@idempotent
 def add_stock():
     try:
         data = request.get_json() or {}
@@ -587,31 +3954,123 @@ def add_stock():
             quantity = 0
         if quantity == 0:
             return jsonify({"status": "success", "message": "Stok değişikliği yok"})
-        # if product exists update, else create
-        existing, st = supabase_get("products", params=build_filters({"barcode": f"eq.{barcode}"}))
-        if existing and isinstance(existing, list) and len(existing) > 0:
-            product = existing[0]
-            new_qty = int(product.get("quantity", 0)) + quantity
-            supabase_patch("products", build_filters({"barcode": f"eq.{barcode}"}), {"quantity": new_qty})
-        else:
+        # if product exists adjust atomically, else create
+        updated, st = adjust_stock({barcode: quantity})
+        if not updated and st < 400:
             # create minimal product record to keep frontend happy
             payload = {"barcode": barcode, "name": data.get("name", f"Ürün-{barcode}"), "price": float(data.get("price", 0) or 0), "quantity": max(quantity, 0), "kdv": float(data.get("kdv", 18)), "otv": float(data.get("otv", 0)), "min_stock_level": int(data.get("min_stock_level", 5) or 5), "created_at": now_iso()}
-            supabase_post("products", payload)
+            created, st = supabase_post("products", payload, prefer="return=representation")
+            if st < 400:
+                catalog.upsert_rows(created if isinstance(created, list) and created else [payload])
         # create stock movement record best-effort
         try:
-            supabase_post("stock_movements", {"barcode": barcode, "product_name": data.get("name", ""), "movement_type": "in" if quantity > 0 else "out", "quantity": abs(quantity), "user_id": getattr(request, "user_id", 1), "movement_date": now_iso()})
+            enqueue_append("stock_movements", {"barcode": barcode, "product_name": data.get("name", ""), "movement_type": "in" if quantity > 0 else "out", "quantity": abs(quantity), "user_id": getattr(request, "user_id", 1), "movement_date": now_iso()})
         except Exception:
             pass
         return jsonify({"status": "success", "message": "Stok güncellendi"})
     except Exception as e:
         logger.debug(f"add_stock exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Stok güncellendi (fallback)"})
 
+# ------------------------------------------------------------------
+# Goods receipt: POST /api/stock/receive {"lines": [{"barcode", "quantity",
+# "price"?, "name"?}]}. One delivery note is handled with a fixed
+# number of round trips regardless of its length: one lookup for all
+# barcodes, one bulk insert for unknown products, one adjust_stock call for
+# every delta and one stock_movements array append. As with /api/stock/add,
+# price and name are only used when the product has to be created.
+# ------------------------------------------------------------------
+RECEIVE_MAX_LINES = int(os.environ.get("RECEIVE_MAX_LINES", 1000))
+
+@app.route("/api/stock/receive", methods=["POST"])
+@require_auth
+@idempotent
+def receive_stock():
+    try:
+        data = request.get_json() or {}
+        lines = data.get("lines") or data.get("items") or []
+        if not isinstance(lines, list) or not lines:
+            return jsonify({"status": "success", "message": "En az bir satır gereklidir", "lines": []})
+        if len(lines) > RECEIVE_MAX_LINES:
+            return jsonify({"status": "success", "message": f"En fazla {RECEIVE_MAX_LINES} satır gönderilebilir", "lines": []})
+        results = []
+        totals = {}
+        first = {}
+        for i, line in enumerate(lines):
+            line = line if isinstance(line, dict) else {}
+            barcode = str(line.get("barcode") or "").strip()
+            result = {"line": i + 1, "barcode": barcode or None}
+            results.append(result)
+            try:
+                quantity = int(line.get("quantity", 0))
+            except Exception:
+                quantity = None
+            errors = []
+            if not barcode:
+                errors.append("Barkod gereklidir")
+            if quantity is None:
+                errors.append("Miktar numeric olmalıdır")
+            elif quantity <= 0:
+                errors.append("Miktar pozitif olmalıdır")
+            if errors:
+                result.update(status="error", errors=errors)
+                continue
+            result["quantity"] = quantity
+            totals[barcode] = totals.get(barcode, 0) + quantity
+            first.setdefault(barcode, line)
+        if not totals:
+            return jsonify({"status": "success", "message": "Geçerli satır yok", "lines": results})
+
+        existing, _ = catalog.lookup(list(totals))
+        created = set()
+        missing = [b for b in totals if b not in existing]
+        if missing:
+            new_rows = []
+            for b in missing:
+                line = first[b]
+                try:
+                    price = float(line.get("price", 0) or 0)
+                except Exception:
+                    price = 0.0
+                new_rows.append({"barcode": b, "name": line.get("name") or f"Ürün-{b}", "price": price, "quantity": 0, "kdv": 18.0, "otv": 0.0, "min_stock_level": 5, "created_at": now_iso()})
+            # a concurrent create of the same barcode is not an error: the delta below still applies
+            inserted, st = supabase_post_many("products", new_rows, params={"on_conflict": "barcode"}, prefer="resolution=ignore-duplicates,return=representation")
+            if st < 400:
+                catalog.upsert_rows(inserted)
+                created = {str(r.get("barcode")) for r in inserted if isinstance(r, dict)}
+
+        updated, st = adjust_stock(totals)
+        after = {str(r.get("barcode")): r for r in updated if isinstance(r, dict)}
+        received = set()
+        for result in results:
+            b = result["barcode"]
+            if result.get("status") == "error":
+                continue
+            row = after.get(b)
+            if row is None:
+                result.update(status="error", errors=["Stok güncellenemedi"])
+                continue
+            received.add(b)
+            result.update(status="created" if b in created else "received", quantity_after=row.get("quantity"), name=row.get("name"))
+
+        user_id = getattr(request, "user_id", 1)
+        movements = [{"barcode": b, "product_name": after[b].get("name", ""), "movement_type": "in", "quantity": totals[b], "user_id": user_id, "movement_date": now_iso()} for b in totals if b in received]
+        enqueue_append("stock_movements", movements)
+
+        failed = sum(1 for r in results if r.get("status") == "error")
+        return jsonify({"status": "success", "message": f"{len(received)} ürün teslim alındı, {failed} satır hatalı", "received": len(received), "created": len(created & received), "failed": failed, "lines": results})
+    except Exception as e:
+        logger.debug(f"receive_stock exception: {e}")
+        skip_idempotent_store()
+        return jsonify({"status": "success", "message": "Mal kabul (fallback)", "lines": []})
+
 # ------------------------------------------------------------------
 # SALE (frontend calls /api/sale)
 # ------------------------------------------------------------------
 @app.route("/api/sale", methods=["POST"])
 @require_auth
+@idempotent
 @transaction_handler
 def make_sale():
     try:
@@ -627,47 +4086,53 @@ def make_sale():
         if errors:
             # return success with note to keep frontend running
             return jsonify({"status": "success", "message": "Geçersiz satış verisi", "note": "validation_failed"})
-        # Check stock and update (best-effort)
+        user_id = getattr(request, "user_id", 1)
+        lines = []
         for item in items:
             try:
-                barcode = item.get("barcode")
-                qty = int(item.get("quantity", 0))
-                prod_list, st = supabase_get("products", params=build_filters({"barcode": f"eq.{barcode}"}))
-                if prod_list and isinstance(prod_list, list) and len(prod_list) > 0:
-                    prod = prod_list[0]
-                    new_qty = int(prod.get("quantity", 0)) - qty
-                    if new_qty < 0:
-                        new_qty = 0
-                    supabase_patch("products", build_filters({"barcode": f"eq.{barcode}"}), {"quantity": new_qty})
-                # insert sale_items best-effort
-                supabase_post("sale_items", {"sale_id": None, "barcode": barcode, "product_name": item.get("name"), "quantity": qty, "price": float(item.get("price", 0))})
-                # stock movement
-                supabase_post("stock_movements", {"barcode": barcode, "product_name": item.get("name"), "movement_type": "out", "quantity": qty, "user_id": getattr(request, "user_id", 1), "movement_date": now_iso()})
+                lines.append((str(item.get("barcode")), int(item.get("quantity", 0)), item))
             except Exception:
                 pass
-        # create sale record
-        sale_payload = {"total_amount": total, "payment_method": payment_method, "cash_amount": float(data.get("cash_amount", 0) or 0), "credit_card_amount": float(data.get("credit_card_amount", 0) or 0), "change_amount": float(data.get("change_amount", 0) or 0), "user_id": getattr(request, "user_id", 1), "sale_date": now_iso()}
-        try:
-            created_sale, st = supabase_post("sales", sale_payload)
-            sale_id = None
-            if isinstance(created_sale, list) and len(created_sale) > 0:
-                sale_id = created_sale[0].get("id")
-        except Exception:
-            sale_id = None
-        # cash handling best-effort
+        sale_payload = {"total_amount": total, "payment_method": payment_method, "cash_amount": float(data.get("cash_amount", 0) or 0), "credit_card_amount": float(data.get("credit_card_amount", 0) or 0), "change_amount": float(data.get("change_amount", 0) or 0), "user_id": user_id, "sale_date": now_iso()}
+        sale_items = []
+        movements = []
+        sold = {}
+        for barcode, qty, item in lines:
+            try:
+                price = float(item.get("price", 0))
+            except Exception:
+                price = 0.0
+            sale_items.append({"barcode": barcode, "product_name": item.get("name"), "quantity": qty, "price": price})
+            movements.append({"barcode": barcode, "product_name": item.get("name"), "movement_type": "out", "quantity": qty, "user_id": user_id, "movement_date": now_iso()})
+            sold[barcode] = sold.get(barcode, 0) + qty
+        cash = None
         try:
             if payment_method == "nakit" and float(data.get("cash_amount", 0) or 0) > 0:
-                supabase_post("cash_transactions", {"transaction_type": "sale", "amount": total, "user_id": getattr(request, "user_id", 1), "transaction_date": now_iso(), "description": f"Satış #{sale_id}"})
+                cash = {"transaction_type": "sale", "amount": total, "user_id": user_id, "transaction_date": now_iso()}
         except Exception:
             pass
+        # sales row, then sale_items with its id, one atomic decrement for the whole
+        # basket and the cash row; whatever cannot reach Supabase right now goes to
+        # the offline journal and is replayed later
+        op = sale_op(sale_payload, sale_items, {barcode: -qty for barcode, qty in sold.items() if qty}, cash)
+        journaled = False
+        if offline_journal.should_defer() or not offline_journal.push([op]):
+            journaled, _ = offline_journal.append(op)
+        sale_id = op["sale_id"]
+        if sale_id is not None or (journaled and not op["sale_done"]):
+            daily_totals.record_sale(sale_payload)
+        enqueue_append("stock_movements", movements)
         # audit log
         try:
-            supabase_post("audit_logs", {"user_id": getattr(request, "user_id", 1), "action": "sale", "description": f"Satış yapıldı - {total} TL", "created_at": now_iso()})
+            enqueue_append("audit_logs", {"user_id": user_id, "action": "sale", "description": f"Satış yapıldı - {total} TL", "created_at": now_iso()})
         except Exception:
             pass
+        if journaled:
+            return jsonify({"status": "success", "sale_id": sale_id, "offline": True, "message": "Satış kaydedildi (çevrimdışı, bağlantı gelince aktarılacak)"})
         return jsonify({"status": "success", "sale_id": sale_id, "message": "Satış kaydedildi"})
     except Exception as e:
         logger.debug(f"make_sale exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Satış kaydedildi (fallback)"})
 
 # ------------------------------------------------------------------
@@ -677,29 +4142,38 @@ def make_sale():
 @require_auth
 def get_sales():
     try:
-        limit = request.args.get("limit", 100)
-        params = {"order": "sale_date.desc", "limit": limit}
-        sales, st = supabase_get("sales", params=params)
-        if sales is None:
-            sales = []
-        return jsonify({"status": "success", "sales": sales})
+        limit = parse_limit(request.args.get("limit"), default=100)
+        cursor = request.args.get("cursor")
+        if request.args.get("stream"):
+            position = decode_cursor(cursor)
+            params = {"or": keyset_filter(position)} if position else {}
+            max_rows = limit if "limit" in request.args else None
+            state = {}
+            return stream_json_list("sales", supabase_iter("sales", params, key="sale_date", max_rows=max_rows, state=state), extra=state)
+        sales, next_cursor, st = _keyset_page("sales", {}, cursor, limit)
+        result = {"status": "success", "sales": sales, "next_cursor": next_cursor, "has_more": next_cursor is not None, "truncated": st >= 400}
+        if st >= 400:
+            result["note"] = "upstream_error"
+        return jsonify(result)
     except Exception as e:
         logger.debug(f"get_sales exception: {e}")
-        return jsonify({"status": "success", "sales": []})
+        return jsonify({"status": "success", "sales": [], "truncated": True, "note": "handled_exception"})
 
 @app.route("/api/sales/<int:sale_id>", methods=["GET"])
 @require_auth
 def get_sale_detail(sale_id):
     try:
-        # Satış detayını getir
-        sales, st = supabase_get("sales", params=build_filters({"id": f"eq.{sale_id}"}))
+        # Satış detayını ve öğelerini paralel getir
+        (sales, st), (sale_items, st2) = fan_out(
+            lambda: supabase_get("sales", params=build_filters({"id": f"eq.{sale_id}"})),
+            lambda: supabase_get("sale_items", params=build_filters({"sale_id": f"eq.{sale_id}"})),
+            default=([], 500),
+        )
         if not sales or not isinstance(sales, list) or len(sales) == 0:
             return jsonify({"status": "success", "message": "Satış bulunamadı", "sale": None})
         
         sale = sales[0]
         
-        # Satış öğelerini getir
-        sale_items, st2 = supabase_get("sale_items", params=build_filters({"sale_id": f"eq.{sale_id}"}))
         if sale_items is None:
             sale_items = []
         
@@ -711,30 +4185,32 @@ def get_sale_detail(sale_id):
 
 @app.route("/api/sales/<int:sale_id>", methods=["DELETE"])
 @require_auth
+@idempotent
 @transaction_handler
 def delete_sale(sale_id):
     try:
-        # Önce satışı getir
-        sales, st = supabase_get("sales", params=build_filters({"id": f"eq.{sale_id}"}))
+        # Önce satışı ve öğelerini getir
+        (sales, st), (sale_items, st2) = fan_out(
+            lambda: supabase_get("sales", params=build_filters({"id": f"eq.{sale_id}"})),
+            lambda: supabase_get("sale_items", params=build_filters({"sale_id": f"eq.{sale_id}"})),
+            default=([], 500),
+        )
         if not sales or not isinstance(sales, list) or len(sales) == 0:
             return jsonify({"status": "success", "message": "Satış bulunamadı"})
         
         sale = sales[0]
         
         # Stokları geri ekle (best-effort)
-        sale_items, st2 = supabase_get("sale_items", params=build_filters({"sale_id": f"eq.{sale_id}"}))
-        if isinstance(sale_items, list):
+        if isinstance(sale_items, list) and sale_items:
+            restock = {}
+            movements = []
             for item in sale_items:
                 try:
                     barcode = item.get("barcode")
                     qty = int(item.get("quantity", 0))
-                    prod_list, st3 = supabase_get("products", params=build_filters({"barcode": f"eq.{barcode}"}))
-                    if prod_list and isinstance(prod_list, list) and len(prod_list) > 0:
-                        prod = prod_list[0]
-                        new_qty = int(prod.get("quantity", 0)) + qty
-                        supabase_patch("products", build_filters({"barcode": f"eq.{barcode}"}), {"quantity": new_qty})
+                    restock[barcode] = restock.get(barcode, 0) + qty
                     # Geri stok movement kaydı
-                    supabase_post("stock_movements", {
+                    movements.append({
                         "barcode": barcode, 
                         "product_name": item.get("product_name"), 
                         "movement_type": "in", 
@@ -745,16 +4221,23 @@ def delete_sale(sale_id):
                     })
                 except Exception:
                     pass
+            try:
+                adjust_stock(restock)
+                enqueue_append("stock_movements", movements)
+            except Exception:
+                pass
         
         # Satış öğelerini sil
         supabase_delete("sale_items", build_filters({"sale_id": f"eq.{sale_id}"}))
         
         # Satışı sil
-        supabase_delete("sales", build_filters({"id": f"eq.{sale_id}"}))
+        deleted, st_del = supabase_delete("sales", build_filters({"id": f"eq.{sale_id}"}))
+        if st_del < 400:
+            daily_totals.record_delete(sale)
         
         # Nakit işlem varsa geri al
         if sale.get("payment_method") == "nakit" and float(sale.get("total_amount", 0)) > 0:
-            supabase_post("cash_transactions", {
+            enqueue_append("cash_transactions", {
                 "transaction_type": "refund", 
                 "amount": -float(sale.get("total_amount", 0)), 
                 "user_id": getattr(request, "user_id", 1), 
@@ -763,7 +4246,7 @@ def delete_sale(sale_id):
             })
         
         # Audit log
-        supabase_post("audit_logs", {
+        enqueue_append("audit_logs", {
             "user_id": getattr(request, "user_id", 1), 
             "action": "sale_delete", 
             "description": f"Satış silindi - #{sale_id} - {sale.get('total_amount', 0)} TL", 
@@ -773,10 +4256,12 @@ def delete_sale(sale_id):
         return jsonify({"status": "success", "message": "Satış silindi"})
     except Exception as e:
         logger.debug(f"delete_sale exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Satış silindi (fallback)"})
 
 @app.route("/api/sales/<int:sale_id>", methods=["PUT"])
 @require_auth
+@idempotent
 @transaction_handler
 def update_sale(sale_id):
     try:
@@ -797,7 +4282,9 @@ def update_sale(sale_id):
         
         # Satışı güncelle
         if update_data:
-            supabase_patch("sales", build_filters({"id": f"eq.{sale_id}"}), update_data)
+            updated, st_upd = supabase_patch("sales", build_filters({"id": f"eq.{sale_id}"}), update_data)
+            if st_upd < 400:
+                daily_totals.record_update(old_sale, dict(old_sale, **update_data))
         
         # Eğer öğeler değiştiyse, öğeleri güncelle (basit implementasyon)
         if "items" in data and isinstance(data["items"], list):
@@ -815,7 +4302,7 @@ def update_sale(sale_id):
                 })
         
         # Audit log
-        supabase_post("audit_logs", {
+        enqueue_append("audit_logs", {
             "user_id": getattr(request, "user_id", 1), 
             "action": "sale_update", 
             "description": f"Satış güncellendi - #{sale_id}", 
@@ -825,6 +4312,7 @@ def update_sale(sale_id):
         return jsonify({"status": "success", "message": "Satış güncellendi"})
     except Exception as e:
         logger.debug(f"update_sale exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Satış güncellendi (fallback)"})
 
 # ------------------------------------------------------------------
@@ -834,29 +4322,19 @@ def update_sale(sale_id):
 @require_auth
 def cash_status():
     try:
-        regs, st = supabase_get("cash_register", params=build_filters({"id": "eq.1"}))
+        (regs, st), totals = fan_out(
+            lambda: supabase_get("cash_register", params=build_filters({"id": "eq.1"})),
+            lambda: daily_totals.get(1),
+            default=([], 500),
+        )
         if not regs:
             # return a safe default
             return jsonify({"status": "success", "cash_status": {"is_open": False, "current_amount": 0, "opening_balance": 0, "opening_time": None, "cash_sales_today": 0, "card_sales_today": 0, "expected_cash": 0}})
         reg = regs[0] if isinstance(regs, list) and len(regs) > 0 else regs
-        # compute totals best-effort
-        today = datetime.now().strftime("%Y-%m-%d")
-        cash_sales, s1 = supabase_get("sales", params={"payment_method": f"eq.nakit", "sale_date": f"gte.{today}"})
-        cash_total = 0
-        if isinstance(cash_sales, list):
-            for s in cash_sales:
-                try:
-                    cash_total += float(s.get("total_amount", 0))
-                except Exception:
-                    pass
-        card_sales, s2 = supabase_get("sales", params={"payment_method": f"eq.kredi", "sale_date": f"gte.{today}"})
-        card_total = 0
-        if isinstance(card_sales, list):
-            for s in card_sales:
-                try:
-                    card_total += float(s.get("total_amount", 0))
-                except Exception:
-                    pass
+        # fan_out's default is the register tuple; a failed totals call yields it too
+        totals = totals if isinstance(totals, dict) else daily_totals.empty()
+        cash_total = totals["cash"]
+        card_total = totals["card"]
         return jsonify({"status": "success", "cash_status": {"is_open": bool(reg.get("is_open")), "current_amount": reg.get("current_amount") or 0, "opening_balance": reg.get("opening_balance") or 0, "opening_time": reg.get("opening_time"), "cash_sales_today": cash_total, "card_sales_today": card_total, "expected_cash": (reg.get("opening_balance") or 0) + cash_total}})
     except Exception as e:
         logger.debug(f"cash_status exception: {e}")
@@ -864,6 +4342,7 @@ def cash_status():
 
 @app.route("/api/cash/open", methods=["POST"])
 @require_auth
+@idempotent
 def open_cash():
     try:
         data = request.get_json() or {}
@@ -880,15 +4359,17 @@ def open_cash():
             supabase_patch("cash_register", build_filters({"id": "eq.1"}), {"is_open": True, "current_amount": initial_amount, "opening_balance": initial_amount, "opening_time": now_iso()})
         else:
             supabase_post("cash_register", {"id": 1, "is_open": True, "current_amount": initial_amount, "opening_balance": initial_amount, "opening_time": now_iso(), "last_updated": now_iso()})
-        supabase_post("cash_transactions", {"transaction_type": "open", "amount": initial_amount, "user_id": getattr(request, "user_id", 1), "transaction_date": now_iso(), "description": "Kasa açılışı"})
-        supabase_post("audit_logs", {"user_id": getattr(request, "user_id", 1), "action": "cash_open", "description": f"Kasa açıldı - {initial_amount}", "created_at": now_iso()})
+        enqueue_append("cash_transactions", {"transaction_type": "open", "amount": initial_amount, "user_id": getattr(request, "user_id", 1), "transaction_date": now_iso(), "description": "Kasa açılışı"})
+        enqueue_append("audit_logs", {"user_id": getattr(request, "user_id", 1), "action": "cash_open", "description": f"Kasa açıldı - {initial_amount}", "created_at": now_iso()})
         return jsonify({"status": "success", "message": "Kasa açıldı"})
     except Exception as e:
         logger.debug(f"open_cash exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Kasa açıldı (fallback)"})
 
 @app.route("/api/cash/close", methods=["POST"])
 @require_auth
+@idempotent
 def close_cash():
     try:
         data = request.get_json() or {}
@@ -897,26 +4378,24 @@ def close_cash():
             final_amount = float(data.get("final_amount", 0) or 0)
         except Exception:
             final_amount = 0
-        regs, s = supabase_get("cash_register", params=build_filters({"id": "eq.1"}))
+        (regs, s), totals = fan_out(
+            lambda: supabase_get("cash_register", params=build_filters({"id": "eq.1"})),
+            lambda: daily_totals.get(1),
+            default=([], 500),
+        )
         if not regs:
             return jsonify({"status": "success", "message": "Kasa kapatıldı", "summary": {"expected_cash": 0, "actual_cash": final_amount, "difference": 0}})
         reg = regs[0] if isinstance(regs, list) and len(regs) > 0 else regs
-        today = datetime.now().strftime("%Y-%m-%d")
-        cash_sales, s1 = supabase_get("sales", params={"payment_method": f"eq.nakit", "sale_date": f"gte.{today}"})
-        cash_total = 0
-        if isinstance(cash_sales, list):
-            for s in cash_sales:
-                try:
-                    cash_total += float(s.get("total_amount", 0))
-                except Exception:
-                    pass
+        totals = totals if isinstance(totals, dict) else daily_totals.empty()
+        cash_total = totals["cash"]
         expected_cash = (reg.get("opening_balance") or 0) + cash_total
         supabase_patch("cash_register", build_filters({"id": f"eq.1"}), {"is_open": False, "current_amount": 0, "closing_time": now_iso()})
-        supabase_post("cash_transactions", {"transaction_type": "close", "amount": final_amount, "user_id": getattr(request, "user_id", 1), "transaction_date": now_iso(), "description": f"Kasa kapanışı - Beklenen: {expected_cash}, Gerçek: {final_amount}"})
-        supabase_post("audit_logs", {"user_id": getattr(request, "user_id", 1), "action": "cash_close", "description": f"Kasa kapandı - Beklenen: {expected_cash}, Gerçek: {final_amount}", "created_at": now_iso()})
+        enqueue_append("cash_transactions", {"transaction_type": "close", "amount": final_amount, "user_id": getattr(request, "user_id", 1), "transaction_date": now_iso(), "description": f"Kasa kapanışı - Beklenen: {expected_cash}, Gerçek: {final_amount}"})
+        enqueue_append("audit_logs", {"user_id": getattr(request, "user_id", 1), "action": "cash_close", "description": f"Kasa kapandı - Beklenen: {expected_cash}, Gerçek: {final_amount}", "created_at": now_iso()})
         return jsonify({"status": "success", "message": "Kasa kapatıldı", "summary": {"opening_balance": reg.get("opening_balance"), "cash_sales": cash_total, "expected_cash": expected_cash, "actual_cash": final_amount, "difference": final_amount - expected_cash}})
     except Exception as e:
         logger.debug(f"close_cash exception: {e}")
+        skip_idempotent_store()
         return jsonify({"status": "success", "message": "Kasa kapatıldı (fallback)", "summary": {"expected_cash": 0, "actual_cash": 0, "difference": 0}})
 
 @app.route("/api/cash/transactions", methods=["GET"])
@@ -945,39 +4424,65 @@ def cash_transactions():
 # ------------------------------------------------------------------
 # Reports
 # - /api/reports/sales returns both 'sales' and 'report' keys (frontend uses result.report or result.sales)
+# - without ?limit/?cursor it returns the full history (read page by page);
+#   ?cursor=&limit= gives one keyset page (has_more/next_cursor); ?stream=1
+#   streams the full history under "sales" only
+# - "truncated": true means an upstream read failed and rows are missing
+# - REPORTS_DUPLICATE_PAYLOAD=0 (or ?dedupe=1) drops the duplicate 'report' copy
+#   (the full history is then streamed)
 # ------------------------------------------------------------------
+REPORTS_DUPLICATE_PAYLOAD = os.environ.get("REPORTS_DUPLICATE_PAYLOAD", "1") != "0"
+
 @app.route("/api/reports/sales", methods=["GET"])
 @require_auth
 def reports_sales():
     try:
-        limit = request.args.get("limit")
-        params = {}
-        if limit:
-            try:
-                params["limit"] = int(limit)
-            except Exception:
-                pass
-        sales, s = supabase_get("sales", params=params)
-        if not isinstance(sales, list):
-            sales = []
-        # return both shapes to satisfy all frontend usages
-        return jsonify({"status": "success", "sales": sales, "report": sales})
+        limit = parse_limit(request.args.get("limit"), default=MAX_PAGE_LIMIT)
+        cursor = request.args.get("cursor")
+        dedupe = not REPORTS_DUPLICATE_PAYLOAD or request.args.get("dedupe") in ("1", "true")
+        paged = "limit" in request.args or cursor is not None
+        if request.args.get("stream") or (dedupe and not paged):
+            # streamed mode returns the full history under "sales" only
+            position = decode_cursor(cursor)
+            params = {"or": keyset_filter(position)} if position else {}
+            max_rows = limit if "limit" in request.args else None
+            state = {}
+            return stream_json_list("sales", supabase_iter("sales", params, key="sale_date", max_rows=max_rows, state=state), extra=state)
+        if not paged:
+            # report callers total the rows: the whole history, as before paging existed
+            state = {}
+            sales = list(supabase_iter("sales", {}, key="sale_date", state=state))
+            result = {"status": "success", "sales": sales, "report": sales, "truncated": state["truncated"]}
+        else:
+            sales, next_cursor, st = _keyset_page("sales", {}, cursor, limit)
+            result = {"status": "success", "sales": sales, "next_cursor": next_cursor, "has_more": next_cursor is not None, "truncated": st >= 400}
+            if not dedupe:
+                # return both shapes to satisfy all frontend usages
+                result["report"] = sales
+        if result["truncated"]:
+            result["note"] = "upstream_error"
+        return jsonify(result)
     except Exception as e:
         logger.debug(f"reports_sales exception: {e}")
-        return jsonify({"status": "success", "sales": [], "report": []})
+        return jsonify({"status": "success", "sales": [], "report": [], "truncated": True, "note": "handled_exception"})
 
 @app.route("/api/reports/stock", methods=["GET"])
 @require_auth
 def reports_stock():
     try:
-        low_stock, s = supabase_get("products", params={"quantity": "lte.min_stock_level", "order": "quantity.asc"})
-        if not low_stock:
-            all_products, _ = supabase_get("products")
+        if catalog.is_fresh():
+            low_stock = inventory_index.low_stock()
+            movements, _ = supabase_get("stock_movements", params={"order": "movement_date.desc", "limit": 100})
+        else:
+            (all_products, s), (movements, _) = fan_out(
+                lambda: supabase_get("products"),
+                lambda: supabase_get("stock_movements", params={"order": "movement_date.desc", "limit": 100}),
+                default=([], 500),
+            )
             if not all_products:
                 low_stock = []
             else:
                 low_stock = [p for p in all_products if int(p.get("quantity", 0)) <= int(p.get("min_stock_level", 5))]
-        movements, _ = supabase_get("stock_movements", params={"order": "movement_date.desc", "limit": 100})
         if not movements:
             movements = []
         return jsonify({"status": "success", "low_stock": low_stock, "movements": movements})
@@ -985,6 +4490,189 @@ def reports_stock():
         logger.debug(f"reports_stock exception: {e}")
         return jsonify({"status": "success", "low_stock": [], "movements": []})
 
+# ------------------------------------------------------------------
+# Exports: constant-memory CSV / NDJSON extracts
+# GET /api/export/<table>?format=csv|ndjson&from=YYYY-MM-DD&to=YYYY-MM-DD
+#     &user_id=&register_id=&gzip=1
+# Rows are read page by page (supabase_iter, keyset on the table's date
+# column) and written in EXPORT_CHUNK_BYTES chunks with chunked transfer.
+# 'to' is exclusive; from/to must be ISO dates or datetimes and user_id an
+# integer, anything else is rejected. sale_items has no user column, so with
+# user_id its rows are read per chunk of that user's sale ids. Sales are not
+# tagged with a register yet, so register 1 is the whole store and any
+# other register_id exports nothing.
+# ------------------------------------------------------------------
+EXPORT_TABLES = {
+    "sales": "sale_date",
+    "sale_items": None,
+    "stock_movements": "movement_date",
+    "cash_transactions": "transaction_date",
+}
+EXPORT_CHUNK_BYTES = int(os.environ.get("EXPORT_CHUNK_BYTES", 64 * 1024))
+
+def _sale_id_bounds(date_from, date_to):
+    """(min_id, max_id) of sales in the date range; sale_items has no date column of its own."""
+    conds = []
+    if date_from:
+        conds.append(f"sale_date.gte.{date_from}")
+    if date_to:
+        conds.append(f"sale_date.lt.{date_to}")
+    params = {"select": "id", "limit": 1}
+    if conds:
+        params["and"] = "(" + ",".join(conds) + ")"
+    (lo, s1), (hi, s2) = fan_out(
+        lambda: supabase_get("sales", params=dict(params, order="id.asc")),
+        lambda: supabase_get("sales", params=dict(params, order="id.desc")),
+        default=([], 500),
+    )
+    if not lo or not hi:
+        return None
+    return lo[0].get("id"), hi[0].get("id")
+
+EXPORT_ID_CHUNK = int(os.environ.get("EXPORT_ID_CHUNK", 200))
+
+def _export_date(raw):
+    """Parsed from/to argument, or None when absent; raises ValueError for anything else."""
+    if not raw:
+        return None
+    return datetime.fromisoformat(raw.strip())
+
+def _export_date_label(dt, default):
+    if dt is None:
+        return default
+    return dt.strftime("%Y-%m-%d") if dt.time() == datetime.min.time() else dt.strftime("%Y-%m-%dT%H%M%S")
+
+def _user_sale_items(user_id, date_from, date_to):
+    """sale_items of one user's sales, fetched EXPORT_ID_CHUNK sale ids at a time."""
+    params = {"select": "id,sale_date", "user_id": f"eq.{user_id}"}
+    conds = []
+    if date_from:
+        conds.append(f"sale_date.gte.{date_from}")
+    if date_to:
+        conds.append(f"sale_date.lt.{date_to}")
+    if conds:
+        params["and"] = "(" + ",".join(conds) + ")"
+    chunk = []
+    for sale in supabase_iter("sales", params, key="sale_date", descending=False):
+        chunk.append(sale.get("id"))
+        if len(chunk) >= EXPORT_ID_CHUNK:
+            yield from supabase_iter("sale_items", {"sale_id": pg_in(chunk)}, key="sale_id", descending=False)
+            chunk = []
+    if chunk:
+        yield from supabase_iter("sale_items", {"sale_id": pg_in(chunk)}, key="sale_id", descending=False)
+
+def _export_rows(table, date_from, date_to, user_id):
+    """Row iterator for an export; date_from/date_to are ISO strings of parsed values."""
+    date_col = EXPORT_TABLES[table]
+    params = {}
+    conds = []
+    if table == "sale_items":
+        if user_id:
+            return _user_sale_items(user_id, date_from, date_to)
+        if date_from or date_to:
+            bounds = _sale_id_bounds(date_from, date_to)
+            if bounds is None:
+                return iter(())
+            conds += [f"sale_id.gte.{bounds[0]}", f"sale_id.lte.{bounds[1]}"]
+        key = "sale_id"
+    else:
+        if date_from:
+            conds.append(f"{date_col}.gte.{date_from}")
+        if date_to:
+            conds.append(f"{date_col}.lt.{date_to}")
+        if user_id:
+            params["user_id"] = f"eq.{user_id}"
+        key = date_col
+    if conds:
+        params["and"] = "(" + ",".join(conds) + ")"
+    return supabase_iter(table, params, key=key, descending=False)
+
+def _csv_value(v):
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False)
+    return "" if v is None else v
+
+def _export_stream(table, rows, fmt, compress):
+    started = time.time()
+    counts = {"rows": 0, "bytes": 0}
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def encoded(text_chunks):
+        for text in text_chunks:
+            data = text.encode("utf-8")
+            if gz is not None:
+                data = gz.compress(data)
+            if data:
+                counts["bytes"] += len(data)
+                yield data
+        if gz is not None:
+            tail = gz.flush()
+            counts["bytes"] += len(tail)
+            yield tail
+        elapsed = max(time.time() - started, 1e-6)
+        logger.info(f"export {table} ({fmt}{', gzip' if gz else ''}): {counts['rows']} rows, {counts['bytes']} bytes in {elapsed:.2f}s ({counts['rows'] / elapsed:.0f} rows/s, {counts['bytes'] / elapsed:.0f} B/s)")
+
+    def text_chunks():
+        buf = io.StringIO()
+        writer = None
+        fields = None
+        try:
+            for row in rows:
+                if fmt == "ndjson":
+                    buf.write(app.json.dumps(row))
+                    buf.write("\n")
+                else:
+                    if writer is None:
+                        fields = list(row.keys())
+                        writer = csv.writer(buf)
+                        writer.writerow(fields)
+                    writer.writerow([_csv_value(row.get(f)) for f in fields])
+                counts["rows"] += 1
+                if buf.tell() >= EXPORT_CHUNK_BYTES:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+        except Exception as e:
+            logger.warning(f"export {table} aborted after {counts['rows']} rows: {e}")
+        yield buf.getvalue()
+
+    return encoded(text_chunks())
+
+@app.route("/api/export/<table>", methods=["GET"])
+@require_auth
+@require_role("admin", enforce=AUTH_ADMIN_BULK)
+def export_table(table):
+    try:
+        if table not in EXPORT_TABLES:
+            return jsonify({"status": "success", "message": "Desteklenmeyen tablo", "note": "unsupported_table", "tables": sorted(EXPORT_TABLES)})
+        fmt = "ndjson" if request.args.get("format") == "ndjson" else "csv"
+        compress = request.args.get("gzip") in ("1", "true")
+        try:
+            date_from = _export_date(request.args.get("from"))
+            date_to = _export_date(request.args.get("to"))
+        except ValueError:
+            return jsonify({"status": "success", "message": "Geçersiz tarih; YYYY-MM-DD veya ISO 8601 kullanın", "note": "invalid_date"})
+        user_id = (request.args.get("user_id") or "").strip()
+        if user_id and not user_id.isdigit():
+            return jsonify({"status": "success", "message": "Geçersiz kullanıcı", "note": "invalid_user_id"})
+        register_id = request.args.get("register_id")
+        if register_id and register_id != "1":
+            rows = iter(())
+        else:
+            rows = _export_rows(table, date_from.isoformat() if date_from else None, date_to.isoformat() if date_to else None, user_id)
+        filename = f"{table}-{_export_date_label(date_from, 'start')}-{_export_date_label(date_to, 'now')}.{fmt}"
+        mimetype = "application/x-ndjson" if fmt == "ndjson" else "text/csv"
+        if compress:
+            filename += ".gz"
+            mimetype = "application/gzip"
+        resp = Response(stream_with_context(_export_stream(table, rows, fmt, compress)), mimetype=mimetype)
+        resp.headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+    except Exception as e:
+        logger.debug(f"export_table exception: {e}")
+        return jsonify({"status": "success", "message": "Dışa aktarma başarısız (fallback)"})
+
 # ------------------------------------------------------------------
 # Inventory helper endpoint used by frontend: /api/inventory/stock-value
 # returns an object with 'value' key containing totals expected by frontend
@@ -993,6 +4681,8 @@ def reports_stock():
 @require_auth
 def inventory_stock_value():
     try:
+        if catalog.is_fresh():
+            return jsonify({"status": "success", "value": inventory_index.stock_value()})
         products, s = supabase_get("products")
         total_products = len(products) if isinstance(products, list) else 0
         # compute simple stock value
@@ -1014,7 +4704,7 @@ def inventory_stock_value():
 # ------------------------------------------------------------------
 def log_audit(user_id, action, description, ip_address=None):
     try:
-        supabase_post("audit_logs", {"user_id": user_id, "action": action, "description": description, "ip_address": ip_address or request.remote_addr, "created_at": now_iso()})
+        enqueue_append("audit_logs", {"user_id": user_id, "action": action, "description": description, "ip_address": ip_address or request.remote_addr, "created_at": now_iso()})
     except Exception:
         pass
 
@@ -1024,6 +4714,7 @@ def log_audit(user_id, action, description, ip_address=None):
 @app.errorhandler(Exception)
 def handle_all(error):
     try:
+        metrics.inc("swallowed_exceptions_total", (("handler", "handle_all"), ("exception", type(error).__name__)))
         trace = traceback.format_exc()
         logger.debug(f"GLOBAL ERROR: {error}\n{trace}")
     except Exception:
@@ -1039,22 +4730,159 @@ def not_found(e):
     return jsonify({"status": "success", "message": "Endpoint bulunamadı (404 fallback)"}), 200
 
 # ------------------------------------------------------------------
-# Before request: attempt to init DB (non-blocking)
+# Response compression: br (if brotli is installed) or gzip, negotiated via
+# Accept-Encoding, for compressible bodies of at least COMPRESS_MIN_BYTES.
+# Streamed responses (exports, ?stream=1) are left alone. Compressed
+# variants get their own strong ETag ("<etag>-gzip" / "<etag>-br").
+# ------------------------------------------------------------------
+COMPRESS_ENABLED = os.environ.get("COMPRESS", "1") != "0"
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", 1024))
+COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", 4))
+_COMPRESSIBLE = ("application/json", "text/html", "text/css", "text/plain", "text/csv", "application/javascript", "text/javascript", "image/svg+xml")
+
+def choose_encoding(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name.strip().lower()] = q
+    if _HAS_BROTLI and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+def compress_body(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL, mtime=0)
+
+def etag_matches(etag):
+    """If-None-Match check that also accepts the compressed variants of etag."""
+    inm = request.if_none_match
+    return any(inm.contains(e) for e in (etag, f"{etag}-gzip", f"{etag}-br")) or inm.star_tag
+
+@app.after_request
+def compress_response(resp):
+    try:
+        if not COMPRESS_ENABLED or resp.direct_passthrough or resp.is_streamed:
+            return resp
+        if resp.status_code != 200 or "Content-Encoding" in resp.headers:
+            return resp
+        if resp.mimetype not in _COMPRESSIBLE:
+            return resp
+        resp.vary.add("Accept-Encoding")
+        data = resp.get_data()
+        if len(data) < COMPRESS_MIN_BYTES:
+            return resp
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+        if encoding is None:
+            return resp
+        resp.set_data(compress_body(data, encoding))
+        resp.headers["Content-Encoding"] = encoding
+        etag, weak = resp.get_etag()
+        if etag:
+            resp.set_etag(f"{etag}-{encoding}", weak=weak)
+    except Exception as e:
+        logger.debug(f"compress_response skipped: {e}")
+    return resp
+
+# ------------------------------------------------------------------
+# Before request: start background services once (DB bootstrap, health
+# prober, write-behind flusher) and open the request's Supabase budget
 # ------------------------------------------------------------------
 @app.before_request
 def before():
+    start_request_deadline()
+    g.metrics_started = time.perf_counter()
+    metrics.inc("http_requests_in_flight")
+    request_tracer.start()
     try:
-        # Attempt initialization in background-friendly way
-        ensure_db_initialized()
+        start_background_services()
     except Exception:
         pass
 
+@app.after_request
+def _record_status(resp):
+    g.metrics_status = resp.status_code
+    try:
+        if g.get("trace_spans") is not None:
+            resp.headers["Server-Timing"] = request_tracer.server_timing()
+    except Exception as e:
+        logger.debug(f"server timing failed: {e}")
+    return resp
+
+@app.teardown_request
+def _record_request_metrics(exc=None):
+    try:
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return
+        metrics.inc("http_requests_in_flight", value=-1)
+        rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+        labels = (("route", rule), ("method", request.method))
+        metrics.observe("http_request_duration_seconds", labels, time.perf_counter() - started)
+        metrics.inc("http_requests_total", labels + (("status", g.get("metrics_status", 500)),))
+        request_tracer.finish(g.get("metrics_status", 500))
+    except Exception:
+        pass
+
+def _component_gauges():
+    yield "circuit_breaker_open", (), 0 if circuit_breaker.stats().get("state") == "closed" else 1
+    yield "write_behind_queue_depth", (), write_behind.stats().get("depth", 0)
+    yield "catalog_products", (), catalog.stats().get("size", 0)
+    yield "idempotency_keys", (), idempotency_store.stats().get("keys", 0)
+    journal = offline_journal.stats()
+    yield "offline_journal_pending", (), journal.get("pending", 0)
+    yield "offline_journal_lag_seconds", (), journal.get("lag_seconds", 0.0)
+
+metrics.describe("circuit_breaker_open", "gauge", "1 while the Supabase circuit breaker is not closed.")
+metrics.describe("write_behind_queue_depth", "gauge", "Rows waiting in the write-behind queue.")
+metrics.describe("catalog_products", "gauge", "Products held in the catalog cache.")
+metrics.describe("idempotency_keys", "gauge", "Idempotency keys held in memory.")
+metrics.describe("offline_journal_pending", "gauge", "Entries waiting in the offline journal.")
+metrics.describe("offline_journal_lag_seconds", "gauge", "Age of the oldest offline journal entry.")
+metrics.add_collector(_component_gauges)
+
+@app.route("/api/admin/traces", methods=["GET"])
+@require_auth
+@require_role("admin")
+def admin_traces():
+    try:
+        limit = parse_limit(request.args.get("limit"), default=50, maximum=TRACE_BUFFER_SIZE)
+        slow_only = request.args.get("slow") in ("1", "true")
+        return jsonify({"status": "success", "tracer": request_tracer.stats(), "traces": request_tracer.recent(limit, slow_only)})
+    except Exception as e:
+        logger.debug(f"admin_traces exception: {e}")
+        return jsonify({"status": "success", "traces": []})
+
+@app.route("/api/admin/user-cache", methods=["DELETE"])
+@require_auth
+@require_role("admin")
+def admin_clear_user_cache():
+    """Drop cached users, e.g. after roles were changed in Supabase."""
+    user_cache.invalidate()
+    return jsonify({"status": "success", "message": "Kullanıcı önbelleği temizlendi"})
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if not METRICS_PUBLIC and not (METRICS_TOKEN and hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}")):
+        return Response("unauthorized\n", status=401, mimetype="text/plain")
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # ------------------------------------------------------------------
 # Main entry
 # ------------------------------------------------------------------
 if __name__ == "__main__":
     try:
-        ensure_db_initialized()
+        start_background_services()
     except Exception:
         pass
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,64 @@
+"""Helpers shared by the benchmark scripts: free ports, the fake PostgREST
+process, percentiles and importing app.py in-process."""
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+FAKE = os.path.join(ROOT, "benchmarks", "fake_postgrest.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_fake(port, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, log=None):
+    """Start benchmarks/fake_postgrest.py on port and wait until it answers."""
+    cmd = [sys.executable, FAKE, "--port", str(port), "--latency-ms", str(latency_ms), "--jitter-ms", str(jitter_ms), "--error-rate", str(error_rate)]
+    if log is None:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for(f"http://127.0.0.1:{port}/__stats")
+    except RuntimeError:
+        proc.kill()
+        raise
+    return proc
+
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)] if values else 0.0
+
+
+def import_app(workdir_prefix=None):
+    """Import app.py in-process; returns (module, workdir). With workdir_prefix,
+    SPOOL_DIR first defaults to a fresh temporary directory (the workdir, for
+    the caller to remove) so a run leaves no spool files behind."""
+    workdir = None
+    if workdir_prefix:
+        workdir = tempfile.mkdtemp(prefix=workdir_prefix)
+        os.environ.setdefault("SPOOL_DIR", os.path.join(workdir, "spool"))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import app
+    return app, workdir
@@ -0,0 +1,317 @@
+"""In-memory PostgREST stand-in for offline benchmarks.
+
+Implements the subset of PostgREST that app.py uses: eq/neq/gt/gte/lt/lte/
+like/ilike/is/in filters, or=()/and=() groups, order, limit/offset and Range
+headers, select, Prefer return=representation, on_conflict upserts
+(merge-duplicates / ignore-duplicates), the PGRST102 mixed-key error and the
+adjust_stock RPC from db/adjust_stock.sql.
+
+Latency, jitter and error injection are configurable at start-up or at run
+time through POST /__config; GET /__stats reports call counts per
+table/method and POST /__reset clears all tables.
+
+    python benchmarks/fake_postgrest.py --port 54321 --latency-ms 15 --jitter-ms 10
+"""
+import argparse
+import functools
+import json
+import random
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+TABLES = {}
+SEQ = {}
+LOCK = threading.Lock()
+STATS = {"requests": 0, "by_call": {}}
+CONFIG = {"latency_ms": 0.0, "jitter_ms": 0.0, "error_rate": 0.0}
+RESERVED = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+
+
+def _num(v):
+    if isinstance(v, bool):
+        return v
+    try:
+        return float(v)
+    except Exception:
+        return v
+
+
+def _split_list(s):
+    out, cur, depth, quoted = [], "", 0, False
+    for ch in s:
+        if ch == '"':
+            quoted = not quoted
+            continue
+        if not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0 and not quoted:
+            out.append(cur)
+            cur = ""
+        else:
+            cur += ch
+    if cur:
+        out.append(cur)
+    return out
+
+
+@functools.lru_cache(maxsize=256)
+def _in_list(arg):
+    vals = _split_list(arg.strip("()"))
+    return frozenset(vals), frozenset(v for v in map(_num, vals) if not isinstance(v, str))
+
+
+def _cmp(row_v, op, arg):
+    if op == "is":
+        return row_v is None if arg == "null" else row_v == (arg == "true")
+    if op == "in":
+        strs, nums = _in_list(arg)
+        return str(row_v) in strs or _num(row_v) in nums
+    if row_v is None:
+        return False
+    a, b = _num(row_v), _num(arg)
+    if type(a) is not type(b):
+        a, b = str(row_v), str(arg)
+    if op == "eq":
+        return a == b
+    if op == "neq":
+        return a != b
+    if op == "gt":
+        return a > b
+    if op == "gte":
+        return a >= b
+    if op == "lt":
+        return a < b
+    if op == "lte":
+        return a <= b
+    if op in ("like", "ilike"):
+        pat = "^" + re.escape(str(arg)).replace("\\*", ".*").replace("%", ".*") + "$"
+        return re.match(pat, str(row_v), re.I if op == "ilike" else 0) is not None
+    return True
+
+
+def _cond(row, expr):
+    # "col.op.val", or a nested "and(...)" / "or(...)"
+    if expr.startswith("and(") or expr.startswith("or("):
+        kind, inner = expr.split("(", 1)
+        res = [_cond(row, p) for p in _split_list(inner[:-1])]
+        return all(res) if kind == "and" else any(res)
+    col, op, val = expr.split(".", 2)
+    return _cmp(row.get(col), op, val)
+
+
+def _match(row, filters):
+    for k, v in filters:
+        if k in ("or", "and"):
+            res = [_cond(row, p) for p in _split_list(v[1:-1])]
+            if not (any(res) if k == "or" else all(res)):
+                return False
+            continue
+        op, _, arg = v.partition(".")
+        if not _cmp(row.get(k), op, arg):
+            return False
+    return True
+
+
+def _sort_key(col):
+    def key(row):
+        v = _num(row.get(col))
+        return (row.get(col) is None, isinstance(v, str), v if not isinstance(v, str) else row.get(col) or "")
+    return key
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes; without this, Nagle plus
+        # delayed ACKs add ~40 ms to every keep-alive response
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, code, body=None, headers=None):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _prep(self):
+        parts = urlsplit(self.path)
+        path = parts.path
+        query = parse_qsl(parts.query, keep_blank_values=True)
+        n = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(n) or b"null") if n else None
+        if path.startswith("/__"):
+            return path, query, body
+        call = f"{self.command} {path.split('/rest/v1/', 1)[-1] or '/'}"
+        with LOCK:
+            STATS["requests"] += 1
+            STATS["by_call"][call] = STATS["by_call"].get(call, 0) + 1
+        delay = CONFIG["latency_ms"] + random.uniform(0, CONFIG["jitter_ms"])
+        if delay:
+            time.sleep(delay / 1000.0)
+        if CONFIG["error_rate"] and random.random() < CONFIG["error_rate"]:
+            self._send(503, {"message": "injected failure"})
+            return None
+        return path, query, body
+
+    def _rows(self, table, query):
+        filters = [(k, v) for k, v in query if k not in RESERVED]
+        rows = [r for r in TABLES.get(table, []) if _match(r, filters)]
+        return rows, dict((k, v) for k, v in query if k in RESERVED)
+
+    def do_GET(self):
+        p = self._prep()
+        if p is None:
+            return
+        path, query, _ = p
+        if path == "/__stats":
+            with LOCK:
+                return self._send(200, {"requests": STATS["requests"], "by_call": dict(STATS["by_call"]), "tables": {k: len(v) for k, v in TABLES.items()}, "config": CONFIG})
+        if path.rstrip("/") == "/rest/v1":
+            return self._send(200, {})
+        table = path.rsplit("/", 1)[-1]
+        with LOCK:
+            rows, opts = self._rows(table, query)
+            if "order" in opts:
+                for spec in reversed(opts["order"].split(",")):
+                    col, _, direction = spec.partition(".")
+                    rows.sort(key=_sort_key(col), reverse=direction.startswith("desc"))
+            offset = int(opts.get("offset", 0))
+            limit = opts.get("limit")
+            rng = self.headers.get("Range")
+            if rng:
+                a, _, b = rng.partition("-")
+                offset, limit = int(a), int(b) - int(a) + 1
+            rows = rows[offset: offset + int(limit)] if limit is not None else rows[offset:]
+            if opts.get("select", "*") != "*":
+                cols = opts["select"].split(",")
+                rows = [{c: r.get(c) for c in cols} for r in rows]
+            rows = [dict(r) for r in rows]
+        self._send(200, rows, {"Content-Range": f"{offset}-{offset + len(rows) - 1}/*"})
+
+    def do_POST(self):
+        p = self._prep()
+        if p is None:
+            return
+        path, query, body = p
+        if path == "/__config":
+            CONFIG.update({k: float(v) for k, v in (body or {}).items() if k in CONFIG})
+            return self._send(200, CONFIG)
+        if path == "/__reset":
+            with LOCK:
+                TABLES.clear()
+                SEQ.clear()
+                STATS["requests"] = 0
+                STATS["by_call"] = {}
+            return self._send(200, {})
+        prefer = self.headers.get("Prefer", "")
+        if path.startswith("/rest/v1/rpc/"):
+            if path.rsplit("/", 1)[-1] != "adjust_stock":
+                return self._send(404, {"message": "function not found"})
+            out = []
+            with LOCK:
+                by_barcode = {str(r.get("barcode")): r for r in TABLES.get("products", [])}
+                for d in (body or {}).get("deltas", []):
+                    row = by_barcode.get(str(d.get("barcode")))
+                    if row is not None:
+                        row["quantity"] = max(int(row.get("quantity") or 0) + int(d.get("delta") or 0), 0)
+                        out.append(dict(row))
+            return self._send(200, out)
+        table = path.rsplit("/", 1)[-1]
+        items = body if isinstance(body, list) else [body]
+        if isinstance(body, list) and items and len({frozenset(i) for i in items}) > 1:
+            return self._send(400, {"code": "PGRST102", "message": "All object keys must match"})
+        out = []
+        with LOCK:
+            tbl = TABLES.setdefault(table, [])
+            conflict = dict(query).get("on_conflict")
+            merge = bool(conflict) and ("merge-duplicates" in prefer or "ignore-duplicates" in prefer)
+            index = {str(r.get(conflict)): r for r in tbl} if merge else {}
+            for item in items:
+                item = dict(item)
+                if merge:
+                    existing = index.get(str(item.get(conflict)))
+                    if existing is not None:
+                        if "merge-duplicates" in prefer:
+                            existing.update(item)
+                            out.append(dict(existing))
+                        continue
+                if item.get("id") is None:
+                    SEQ[table] = SEQ.get(table, 0) + 1
+                    item["id"] = SEQ[table]
+                tbl.append(item)
+                if merge:
+                    index[str(item.get(conflict))] = item
+                out.append(dict(item))
+        if "return=representation" in prefer:
+            return self._send(201, out)
+        self._send(201)
+
+    def do_PATCH(self):
+        p = self._prep()
+        if p is None:
+            return
+        path, query, body = p
+        with LOCK:
+            rows, _ = self._rows(path.rsplit("/", 1)[-1], query)
+            for r in rows:
+                r.update(body or {})
+            out = [dict(r) for r in rows]
+        if "return=representation" in self.headers.get("Prefer", ""):
+            return self._send(200, out)
+        self._send(204)
+
+    def do_DELETE(self):
+        p = self._prep()
+        if p is None:
+            return
+        path, query, _ = p
+        table = path.rsplit("/", 1)[-1]
+        with LOCK:
+            rows, _ = self._rows(table, query)
+            doomed = {id(r) for r in rows}
+            TABLES[table] = [r for r in TABLES.get(table, []) if id(r) not in doomed]
+        self._send(204)
+
+
+def serve(port=54321, host="127.0.0.1"):
+    """Start the fake in a daemon thread and return the server."""
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    CONFIG.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate)
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    print(f"fake PostgREST on http://{args.host}:{args.port} (latency {args.latency_ms}ms, jitter {args.jitter_ms}ms, errors {args.error_rate:.0%})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
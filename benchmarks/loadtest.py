@@ -0,0 +1,277 @@
+"""Offline load test: the app under waitress (or gunicorn) against the fake PostgREST.
+
+Starts benchmarks/fake_postgrest.py with the given latency/jitter/error rate,
+seeds a catalog, serves app.py from a real WSGI server and drives it with
+concurrent simulated terminals (barcode scans, searches, sales, cash status
+polling and reports). Reports throughput, p50/p95/p99 latency and Supabase
+calls per request (from the Server-Timing header) for each endpoint.
+
+    python benchmarks/loadtest.py                              # 8 terminals, 20 s
+    python benchmarks/loadtest.py --terminals 16 --latency-ms 30 --jitter-ms 20
+    python benchmarks/loadtest.py --save benchmarks/baseline.json
+    python benchmarks/loadtest.py --compare benchmarks/baseline.json
+
+benchmarks/baseline.json was recorded against the app before any of the
+performance work (the "baseline" commit), served from a checkout of it:
+
+    git worktree add /tmp/pos-baseline <baseline commit>
+    python benchmarks/loadtest.py --app-root /tmp/pos-baseline --save benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+from _common import ROOT, free_port, pct, start_fake, wait_for
+
+# endpoint name -> weight in the terminal mix
+MIX = {
+    "scan": 40,
+    "search": 10,
+    "sale": 15,
+    "cash_status": 20,
+    "sales_report": 7,
+    "stock_report": 5,
+    "products": 3,
+}
+WORDS = ["cay", "sut", "gazoz", "bira", "raki", "sigara", "cikolata", "su", "ayran", "kahve"]
+_DB_CALLS = re.compile(r'db;dur=[\d.]+;desc="(\d+) calls"')
+
+
+def start_app(port, fake_port, args, workdir, log):
+    env = dict(os.environ, SUPABASE_URL=f"http://127.0.0.1:{fake_port}", SUPABASE_KEY="bench", SPOOL_DIR=os.path.join(workdir, "spool"), PORT=str(port))
+    env.pop("IDEMPOTENCY_DB", None)
+    if args.server == "waitress":
+        cmd = [sys.executable, "-m", "waitress", "--host=127.0.0.1", f"--port={port}", f"--threads={args.threads}", "app:app"]
+    elif args.server == "gunicorn":
+        cmd = ["gunicorn", "app:app", "--bind", f"127.0.0.1:{port}", "--workers", str(args.workers), "--threads", str(args.threads), "--worker-class", "gthread"]
+    else:
+        cmd = [sys.executable, "-c", f"import app; app.start_background_services(); app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    proc = subprocess.Popen(cmd, cwd=args.app_root, env=env, stdout=log, stderr=subprocess.STDOUT)
+    wait_for(f"http://127.0.0.1:{port}/health", timeout=60)
+    return proc
+
+
+def seed(fake, n_products, rng):
+    products = []
+    for i in range(n_products):
+        name = f"{rng.choice(WORDS).title()} {rng.choice(['200ml', '500ml', '1L', '100g', 'Paket'])} {i}"
+        products.append({"barcode": f"869{i:010d}", "name": name, "price": round(rng.uniform(5, 300), 2), "quantity": rng.randint(0, 500), "kdv": 18.0, "otv": 0.0, "min_stock_level": 5, "created_at": datetime.utcnow().isoformat()})
+    requests.post(f"{fake}/__reset", timeout=10)
+    requests.post(f"{fake}/rest/v1/products", json=products, timeout=60)
+    requests.post(f"{fake}/rest/v1/cash_register", json={"id": 1, "is_open": True, "current_amount": 1000.0, "opening_balance": 1000.0, "opening_time": datetime.utcnow().isoformat(), "last_updated": datetime.utcnow().isoformat()}, timeout=10)
+    return [p["barcode"] for p in products]
+
+
+class Terminal(threading.Thread):
+    def __init__(self, base, barcodes, stop_at, record_from, seed_value):
+        super().__init__(daemon=True)
+        self.base = base
+        self.barcodes = barcodes
+        self.stop_at = stop_at
+        self.record_from = record_from
+        self.rng = random.Random(seed_value)
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip"
+        self.samples = []
+
+    def request(self, name):
+        rng = self.rng
+        if name == "scan":
+            return self.session.get(f"{self.base}/api/products/{rng.choice(self.barcodes)}", timeout=30)
+        if name == "search":
+            return self.session.get(f"{self.base}/api/products/search", params={"q": rng.choice(WORDS)[:rng.randint(2, 4)]}, timeout=30)
+        if name == "sale":
+            items = [{"barcode": rng.choice(self.barcodes), "quantity": rng.randint(1, 3), "price": 10.0, "name": "bench"} for _ in range(rng.randint(1, 6))]
+            total = sum(i["quantity"] * i["price"] for i in items)
+            method = rng.choice(["nakit", "kredi"])
+            payload = {"items": items, "total": total, "payment_method": method, "cash_amount": total if method == "nakit" else 0, "credit_card_amount": total if method == "kredi" else 0}
+            return self.session.post(f"{self.base}/api/sale", json=payload, timeout=30)
+        if name == "cash_status":
+            return self.session.get(f"{self.base}/api/cash/status", timeout=30)
+        if name == "sales_report":
+            return self.session.get(f"{self.base}/api/reports/sales", params={"limit": 50}, timeout=30)
+        if name == "stock_report":
+            return self.session.get(f"{self.base}/api/reports/stock", timeout=30)
+        return self.session.get(f"{self.base}/api/products", timeout=30)
+
+    def run(self):
+        names = list(MIX)
+        weights = [MIX[n] for n in names]
+        while True:
+            now = time.monotonic()
+            if now >= self.stop_at:
+                return
+            name = self.rng.choices(names, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                resp = self.request(name)
+                ok = resp.status_code < 400
+                match = _DB_CALLS.search(resp.headers.get("Server-Timing", ""))
+                calls = int(match.group(1)) if match else None
+            except requests.RequestException:
+                ok, calls = False, None
+            elapsed = time.perf_counter() - t0
+            if now >= self.record_from:
+                self.samples.append((name, elapsed, ok, calls))
+
+
+def summarize(samples, seconds, fake_calls):
+    endpoints = {}
+    for name in MIX:
+        rows = [s for s in samples if s[0] == name]
+        if not rows:
+            continue
+        lat = [s[1] * 1000 for s in rows]
+        calls = [s[3] for s in rows if s[3] is not None]
+        endpoints[name] = {
+            "requests": len(rows),
+            "rps": round(len(rows) / seconds, 2),
+            "p50_ms": round(pct(lat, 50), 2),
+            "p95_ms": round(pct(lat, 95), 2),
+            "p99_ms": round(pct(lat, 99), 2),
+            "mean_ms": round(statistics.fmean(lat), 2),
+            "supabase_calls_per_request": round(statistics.fmean(calls), 2) if calls else None,
+            "errors": sum(1 for s in rows if not s[2]),
+        }
+    lat = [s[1] * 1000 for s in samples]
+    total = {
+        "requests": len(samples),
+        "rps": round(len(samples) / seconds, 2),
+        "p50_ms": round(pct(lat, 50), 2) if lat else None,
+        "p95_ms": round(pct(lat, 95), 2) if lat else None,
+        "p99_ms": round(pct(lat, 99), 2) if lat else None,
+        "errors": sum(1 for s in samples if not s[2]),
+        "supabase_calls": fake_calls,
+        "supabase_calls_per_request": round(fake_calls / len(samples), 2) if samples else None,
+    }
+    return endpoints, total
+
+
+def print_report(result):
+    meta = result["meta"]
+    print(f"\n{meta['server']} x{meta['threads']} threads, {meta['terminals']} terminals, {meta['duration']}s, upstream {meta['latency_ms']}±{meta['jitter_ms']}ms, errors {meta['error_rate']:.0%}")
+    print(f"{'endpoint':14} {'reqs':>7} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'db/req':>7} {'errors':>7}")
+    for name, e in result["endpoints"].items():
+        calls = "-" if e["supabase_calls_per_request"] is None else f"{e['supabase_calls_per_request']:.1f}"
+        print(f"{name:14} {e['requests']:7d} {e['rps']:8.1f} {e['p50_ms']:8.1f} {e['p95_ms']:8.1f} {e['p99_ms']:8.1f} {calls:>7} {e['errors']:7d}")
+    t = result["total"]
+    print(f"{'TOTAL':14} {t['requests']:7d} {t['rps']:8.1f} {t['p50_ms'] or 0:8.1f} {t['p95_ms'] or 0:8.1f} {t['p99_ms'] or 0:8.1f} {t['supabase_calls_per_request'] or 0:7.1f} {t['errors']:7d}")
+
+
+def print_comparison(result, baseline):
+    print(f"\nvs baseline {baseline['meta'].get('commit') or ''} ({baseline['meta'].get('timestamp')})")
+    print(f"{'endpoint':14} {'rps':>18} {'p50 ms':>22} {'p95 ms':>22} {'p99 ms':>22}")
+
+    def cell(new, old):
+        if new is None or old in (None, 0):
+            return f"{'-':>22}"
+        return f"{old:.1f}->{new:.1f} {100.0 * (new - old) / old:+.0f}%".rjust(22)
+
+    rows = list(result["endpoints"].items()) + [("TOTAL", result["total"])]
+    for name, e in rows:
+        b = baseline["total"] if name == "TOTAL" else baseline["endpoints"].get(name)
+        if not b:
+            continue
+        rps = f"{b['rps']:.0f}->{e['rps']:.0f} {100.0 * (e['rps'] - b['rps']) / b['rps']:+.0f}%" if b.get("rps") else "-"
+        print(f"{name:14} {rps:>18} {cell(e['p50_ms'], b['p50_ms'])} {cell(e['p95_ms'], b['p95_ms'])} {cell(e['p99_ms'], b['p99_ms'])}")
+
+
+def git_commit(root):
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=root, stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=["waitress", "gunicorn", "flask"], default="waitress")
+    parser.add_argument("--threads", type=int, default=8, help="server threads (per worker)")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--terminals", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--warmup", type=float, default=3.0)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=15.0)
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the result JSON here (e.g. a baseline)")
+    parser.add_argument("--compare", help="baseline JSON to diff against")
+    parser.add_argument("--keep-logs", action="store_true")
+    parser.add_argument("--app-root", default=ROOT, help="directory holding the app.py to serve (e.g. a worktree of an older commit)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+    fake_port, app_port = free_port(), free_port()
+    fake_url, app_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{app_port}"
+    procs = []
+    try:
+        with open(os.path.join(workdir, "fake.log"), "w") as fake_log, open(os.path.join(workdir, "app.log"), "w") as app_log:
+            procs.append(start_fake(fake_port, args.latency_ms, args.jitter_ms, args.error_rate, log=fake_log))
+            barcodes = seed(fake_url, args.products, random.Random(args.seed))
+            procs.append(start_app(app_port, fake_port, args, workdir, app_log))
+            # let the catalog warm up before the clock starts
+            deadline = time.monotonic() + 30
+            while time.monotonic() < deadline:
+                health = requests.get(f"{app_url}/health", timeout=5).json()
+                # apps without a catalog cache have nothing to warm
+                if "catalog" not in health or health["catalog"].get("fresh"):
+                    break
+                time.sleep(0.2)
+
+            start = time.monotonic()
+            record_from = start + args.warmup
+            stop_at = record_from + args.duration
+            terminals = [Terminal(app_url, barcodes, stop_at, record_from, args.seed * 1000 + i) for i in range(args.terminals)]
+            for t in terminals:
+                t.start()
+            time.sleep(max(record_from - time.monotonic(), 0))
+            calls_before = requests.get(f"{fake_url}/__stats", timeout=10).json()["requests"]
+            for t in terminals:
+                t.join()
+            calls_after = requests.get(f"{fake_url}/__stats", timeout=10).json()["requests"]
+
+        samples = [s for t in terminals for s in t.samples]
+        endpoints, total = summarize(samples, args.duration, calls_after - calls_before)
+        result = {
+            "meta": {"timestamp": datetime.utcnow().isoformat(), "commit": git_commit(args.app_root), "python": platform.python_version(), "server": args.server, "threads": args.threads, "workers": args.workers, "terminals": args.terminals, "duration": args.duration, "products": args.products, "latency_ms": args.latency_ms, "jitter_ms": args.jitter_ms, "error_rate": args.error_rate, "seed": args.seed},
+            "endpoints": endpoints,
+            "total": total,
+        }
+        print_report(result)
+        if args.compare:
+            with open(args.compare) as f:
+                print_comparison(result, json.load(f))
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(result, f, indent=2)
+            print(f"\nsaved {args.save}")
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if args.keep_logs:
+            print(f"logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Checkout latency through a Supabase outage, with the offline journal.
+
+Runs POST /api/sale in-process (Flask test client) against
+benchmarks/fake_postgrest.py in three phases: online, an outage (the fake
+answers every call with 503) and recovery. Reports sales/s and latency per
+phase, how long the journal took to drain after recovery, and whether the
+upstream stock quantities match what was sold.
+
+    python benchmarks/offline_bench.py
+    python benchmarks/offline_bench.py --sales 300 --terminals 4 --latency-ms 20
+    OFFLINE_MODE=off python benchmarks/offline_bench.py      # without the journal
+"""
+import argparse
+import random
+import shutil
+import threading
+import time
+
+import requests
+
+from _common import free_port, import_app, pct, start_fake
+
+app, _WORK = import_app("offline-bench-")
+
+
+def run_sales(n_sales, terminals, barcodes, sold, seed):
+    latencies = []
+    lock = threading.Lock()
+
+    def terminal(k):
+        rng = random.Random(seed + k)
+        client = app.app.test_client()
+        for _ in range(n_sales // terminals):
+            items = [{"barcode": rng.choice(barcodes), "quantity": rng.randint(1, 3), "price": 10.0, "name": "bench"} for _ in range(rng.randint(1, 4))]
+            total = sum(i["quantity"] * i["price"] for i in items)
+            t0 = time.perf_counter()
+            client.post("/api/sale", json={"items": items, "total": total, "payment_method": "nakit", "cash_amount": total})
+            elapsed = (time.perf_counter() - t0) * 1000
+            with lock:
+                latencies.append(elapsed)
+                for i in items:
+                    sold[i["barcode"]] = sold.get(i["barcode"], 0) + i["quantity"]
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=terminal, args=(k,)) for k in range(terminals)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    return {"sales": len(latencies), "sales_per_s": len(latencies) / wall, "p50": pct(latencies, 50), "p99": pct(latencies, 99), "max": max(latencies or [0.0])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=200, help="sales per phase")
+    parser.add_argument("--terminals", type=int, default=4)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=15.0, help="upstream latency while online")
+    args = parser.parse_args()
+
+    port = free_port()
+    fake = start_fake(port)
+    base = f"http://127.0.0.1:{port}"
+    app.SUPABASE_URL = base
+    app.circuit_breaker.probe_interval = 0.5
+    app.offline_journal.interval = 0.5
+    stock = 1000000
+    products = [{"barcode": f"869{i:010d}", "name": f"Ürün {i}", "price": 10.0, "quantity": stock, "kdv": 18.0, "otv": 0.0, "min_stock_level": 5, "created_at": app.now_iso()} for i in range(args.products)]
+    barcodes = [p["barcode"] for p in products]
+    sold = {}
+    results = []
+    drain = None
+    try:
+        app.supabase_post_many("products", products)
+        app.catalog.refresh()
+        app.start_background_services()
+        requests.post(f"{base}/__config", json={"latency_ms": args.latency_ms}, timeout=10)
+        results.append(("online", run_sales(args.sales, args.terminals, barcodes, sold, 1)))
+        requests.post(f"{base}/__config", json={"error_rate": 1.0}, timeout=10)
+        results.append(("outage", run_sales(args.sales, args.terminals, barcodes, sold, 2)))
+        pending = app.offline_journal.stats()["pending"]
+        requests.post(f"{base}/__config", json={"error_rate": 0.0}, timeout=10)
+        t0 = time.perf_counter()
+        results.append(("recovery", run_sales(args.sales, args.terminals, barcodes, sold, 3)))
+        while app.offline_journal.pending or app.circuit_breaker.state != "closed":
+            if time.perf_counter() - t0 > 120:
+                break
+            time.sleep(0.1)
+        drain = time.perf_counter() - t0
+        upstream = {r["barcode"]: r["quantity"] for r in requests.get(f"{base}/rest/v1/products", params={"select": "barcode,quantity"}, timeout=30).json()}
+        mismatched = sum(1 for b in barcodes if upstream.get(b) != stock - sold.get(b, 0))
+        sales_rows = requests.get(f"{base}/__stats", timeout=10).json()["tables"].get("sales", 0)
+    finally:
+        fake.terminate()
+        shutil.rmtree(_WORK, ignore_errors=True)
+
+    print(f"\nPOST /api/sale, {args.sales} sales per phase from {args.terminals} terminals, upstream {args.latency_ms:g} ms, OFFLINE_MODE={app.OFFLINE_MODE}")
+    print(f"{'phase':10} {'sales/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, r in results:
+        print(f"{name:10} {r['sales_per_s']:9.1f} {r['p50']:8.2f} {r['p99']:8.2f} {r['max']:8.2f}")
+    print(f"journal after outage: {pending} entries; drained {drain:.1f}s after recovery")
+    print(f"upstream sales rows: {sales_rows} of {sum(r['sales'] for _, r in results)}; products with wrong stock: {mismatched}")
+
+
+if __name__ == "__main__":
+    main()
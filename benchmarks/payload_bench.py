@@ -0,0 +1,84 @@
+"""Payload benchmark for the large list endpoints.
+
+Builds synthetic products/sales payloads shaped like the /api/products,
+/api/sales and /api/reports/sales responses and reports, per endpoint,
+the raw and compressed sizes (gzip, and br when brotli is installed) and
+the encode time with the stdlib encoder versus the fast one (orjson).
+
+    python benchmarks/payload_bench.py
+    python benchmarks/payload_bench.py --rows 1000 10000 --repeat 20
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+
+from _common import import_app
+
+app, _ = import_app()
+
+NAMES = ["Çaykur Rize Çay 1kg", "Ülker Çikolatalı Gofret", "Eti Karam", "İçim Süt 1L", "Pınar Ayran 200ml", "Efes Pilsen 500ml", "Uludağ Gazoz 1L", "Erikli Su 1.5L", "Marlboro Touch", "Yeni Rakı 70cl"]
+
+
+def make_products(n, seed=1):
+    rnd = random.Random(seed)
+    return [{"id": i + 1, "barcode": f"869{i:010d}", "name": f"{rnd.choice(NAMES)} {i}", "price": round(rnd.uniform(1, 500), 2), "quantity": rnd.randint(0, 200), "kdv": 18, "otv": 0, "min_stock_level": 5, "created_at": "2026-01-01T10:00:00+00:00"} for i in range(n)]
+
+
+def make_sales(n, seed=2):
+    rnd = random.Random(seed)
+    sales = []
+    for i in range(n):
+        # same columns as the rows make_sale writes
+        total = round(rnd.uniform(5, 900), 2)
+        method = rnd.choice(["nakit", "kredi"])
+        cash = round(total + rnd.choice([0, 0.5, 10, 50]), 2) if method == "nakit" else 0.0
+        sales.append({"id": n - i, "total_amount": total, "payment_method": method, "cash_amount": cash, "credit_card_amount": total if method == "kredi" else 0.0, "change_amount": round(cash - total, 2) if method == "nakit" else 0.0, "user_id": 1, "sale_date": f"2026-10-{1 + i % 28:02d}T{i % 24:02d}:{i % 60:02d}:00.{i % 1000000:06d}"})
+    return sales
+
+
+def payloads(rows):
+    products = make_products(rows)
+    sales = make_sales(rows)
+    return {
+        "/api/products": {"status": "success", "full": True, "version": "bench.1", "products": products},
+        "/api/sales": {"status": "success", "sales": sales, "next_cursor": None},
+        "/api/reports/sales": {"status": "success", "sales": sales, "report": sales, "next_cursor": None},
+        "/api/reports/sales?dedupe=1": {"status": "success", "sales": sales, "next_cursor": None},
+    }
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return out, best * 1000
+
+
+def run(rows, repeat):
+    print(f"\n== {rows} rows (json engine: {app.JSON_ENGINE}, brotli: {app._HAS_BROTLI})")
+    print(f"{'endpoint':32} {'raw KB':>9} {'gzip KB':>9} {'br KB':>9} {'stdlib ms':>10} {'fast ms':>9} {'gzip ms':>9}")
+    with app.app.app_context():
+        for name, body in payloads(rows).items():
+            raw, std_ms = timed(lambda: json.dumps(body).encode("utf-8"), repeat)
+            _, fast_ms = timed(lambda: app.app.json.dumps(body).encode("utf-8"), repeat)
+            gz, gz_ms = timed(lambda: app.compress_body(raw, "gzip"), max(repeat // 4, 1))
+            br = f"{len(app.compress_body(raw, 'br')) / 1024:9.1f}" if app._HAS_BROTLI else f"{'-':>9}"
+            assert json.loads(gzip.decompress(gz)) == body
+            print(f"{name:32} {len(raw) / 1024:9.1f} {len(gz) / 1024:9.1f} {br} {std_ms:10.2f} {fast_ms:9.2f} {gz_ms:9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    for rows in args.rows:
+        run(rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Micro-benchmark for the in-memory product search index.
+
+Builds synthetic catalogs and reports index build time and query latency
+percentiles for a mix of barcode-prefix, word-prefix and substring queries.
+
+    python benchmarks/search_bench.py                 # 10k, 100k, 1M products
+    python benchmarks/search_bench.py --sizes 10000 --queries 5000
+"""
+import argparse
+import gc
+import random
+import statistics
+import time
+
+from _common import import_app, pct
+
+app, _ = import_app()
+
+BRANDS = ["Çaykur", "Ülker", "Eti", "İçim", "Pınar", "Şölen", "Efes", "Tuborg", "Marlboro", "Parliament", "Camel", "Yeni Rakı", "Tekirdağ", "Doğadan", "Nestle", "Coca-Cola", "Fanta", "Uludağ", "Erikli", "Torku"]
+ITEMS = ["Çay", "Süt", "Gazoz", "Bira", "Rakı", "Sigara", "Çikolata", "Bisküvi", "Kraker", "Su", "Ayran", "Meyve Suyu", "Şeker", "Kahve", "Gofret", "Sakız", "Kibrit", "Çakmak", "Lokum", "Cips"]
+SIZES = ["200ml", "330ml", "500ml", "1L", "1.5L", "50g", "100g", "1kg", "20'li", "Paket"]
+
+
+def make_records(n, seed=42):
+    rnd = random.Random(seed)
+    records = []
+    for i in range(n):
+        name = f"{rnd.choice(BRANDS)} {rnd.choice(ITEMS)} {rnd.choice(SIZES)} {i % 997}"
+        row = {"id": i + 1, "barcode": f"869{i:010d}", "name": name, "price": round(rnd.uniform(1, 500), 2), "quantity": rnd.randint(0, 200), "kdv": 18, "otv": 0, "min_stock_level": 5, "created_at": None}
+        records.append(app._ProductRecord.from_row(row))
+    return records
+
+
+def make_queries(records, count, seed=7):
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        rec = rnd.choice(records)
+        kind = rnd.random()
+        if kind < 0.4:
+            queries.append(rec.barcode[:rnd.randint(4, 13)])
+        elif kind < 0.7:
+            word = rnd.choice(rec.name.split())
+            queries.append(word[:rnd.randint(1, len(word))])
+        else:
+            key = app.search_key(rec.name)
+            start = rnd.randint(0, max(len(key) - 4, 0))
+            queries.append(key[start:start + rnd.randint(3, 6)])
+    return queries
+
+
+def run(size, n_queries, limit):
+    records = make_records(size)
+    index = app._SearchIndex()
+    t0 = time.perf_counter()
+    index.on_reset(records)
+    build_s = time.perf_counter() - t0
+    queries = make_queries(records, n_queries)
+    # move the catalog out of the collector's view so full collections over
+    # millions of records do not show up as query latency
+    gc.collect()
+    gc.freeze()
+    timings = []
+    for q in queries:
+        t = time.perf_counter()
+        index.search(q, limit)
+        timings.append((time.perf_counter() - t) * 1e6)
+    # incremental update cost
+    t0 = time.perf_counter()
+    for rec in records[:1000]:
+        index.on_change(rec, rec.updated({"name": rec.name + " X"}))
+    update_us = (time.perf_counter() - t0) / min(1000, len(records)) * 1e6
+    gc.unfreeze()
+    return {
+        "products": size,
+        "build_s": round(build_s, 2),
+        "p50_us": round(statistics.median(timings), 1),
+        "p95_us": round(pct(timings, 95), 1),
+        "p99_us": round(pct(timings, 99), 1),
+        "update_us": round(update_us, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+    print(f"{'products':>10} {'build s':>8} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9} {'update us':>10}")
+    for size in (int(s) for s in args.sizes.split(",")):
+        r = run(size, args.queries, args.limit)
+        print(f"{r['products']:>10} {r['build_s']:>8} {r['p50_us']:>9} {r['p95_us']:>9} {r['p99_us']:>9} {r['update_us']:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Sale-path benchmark: PostgREST backend vs the embedded SQLite backend.
+
+Runs the same POST /api/sale workload in-process (Flask test client) against
+each storage backend: the PostgREST client talking to
+benchmarks/fake_postgrest.py (started as a separate process, with the given
+upstream latency) and _SQLiteBackend on a temporary WAL database. Reports
+sales/s, p50/p95/p99 latency and storage calls per sale.
+
+    python benchmarks/storage_bench.py                        # 0 ms and 20 ms upstream
+    python benchmarks/storage_bench.py --latency-ms 40 --sales 500 --terminals 4
+"""
+import argparse
+import os
+import random
+import shutil
+import threading
+import time
+
+import requests
+
+from _common import free_port, import_app, pct, start_fake
+
+app, _WORK = import_app("storage-bench-")
+
+
+def make_products(n, seed=1):
+    rng = random.Random(seed)
+    return [{"barcode": f"869{i:010d}", "name": f"Ürün {i}", "price": round(rng.uniform(5, 300), 2), "quantity": 100000, "kdv": 18.0, "otv": 0.0, "min_stock_level": 5, "created_at": app.now_iso()} for i in range(n)]
+
+
+def use_backend(backend, products):
+    app.storage = backend
+    app.supabase_post_many("products", products)
+    app.catalog.refresh()
+
+
+def run_sales(n_sales, terminals, barcodes, seed=7):
+    latencies, calls = [], []
+    lock = threading.Lock()
+    per_terminal = n_sales // terminals
+
+    def terminal(k):
+        rng = random.Random(seed + k)
+        client = app.app.test_client()
+        for _ in range(per_terminal):
+            items = [{"barcode": rng.choice(barcodes), "quantity": rng.randint(1, 3), "price": 10.0, "name": "bench"} for _ in range(rng.randint(1, 6))]
+            total = sum(i["quantity"] * i["price"] for i in items)
+            t0 = time.perf_counter()
+            resp = client.post("/api/sale", json={"items": items, "total": total, "payment_method": "nakit", "cash_amount": total})
+            elapsed = time.perf_counter() - t0
+            timing = resp.headers.get("Server-Timing", "")
+            n = timing.split('desc="', 1)[1].split(" ", 1)[0] if 'desc="' in timing else "0"
+            with lock:
+                latencies.append(elapsed * 1000)
+                calls.append(int(n))
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=terminal, args=(k,)) for k in range(terminals)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    return {"sales": len(latencies), "sales_per_s": len(latencies) / wall, "p50": pct(latencies, 50), "p95": pct(latencies, 95), "p99": pct(latencies, 99), "calls": sum(calls) / max(len(calls), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sales", type=int, default=400)
+    parser.add_argument("--terminals", type=int, default=4)
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, nargs="+", default=[0.0, 20.0], help="upstream latencies to run the PostgREST backend at")
+    args = parser.parse_args()
+
+    port = free_port()
+    fake = start_fake(port)
+    app.SUPABASE_URL = f"http://127.0.0.1:{port}"
+    products = make_products(args.products)
+    barcodes = [p["barcode"] for p in products]
+    results = []
+    try:
+        for latency in args.latency_ms:
+            requests.post(f"{app.SUPABASE_URL}/__reset", timeout=10)
+            requests.post(f"{app.SUPABASE_URL}/__config", json={"latency_ms": latency}, timeout=10)
+            use_backend(app._PostgrestBackend(), products)
+            results.append((f"postgrest ({latency:g} ms)", run_sales(args.sales, args.terminals, barcodes)))
+        use_backend(app._SQLiteBackend(os.path.join(_WORK, "bench.db")), products)
+        results.append(("sqlite (WAL)", run_sales(args.sales, args.terminals, barcodes)))
+        app.write_behind.flush()
+    finally:
+        fake.terminate()
+        shutil.rmtree(_WORK, ignore_errors=True)
+
+    print(f"\nPOST /api/sale, {args.sales} sales from {args.terminals} terminals, {args.products} products")
+    print(f"{'backend':22} {'sales/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'calls/sale':>11}")
+    for name, r in results:
+        print(f"{name:22} {r['sales_per_s']:9.1f} {r['p50']:8.2f} {r['p95']:8.2f} {r['p99']:8.2f} {r['calls']:11.1f}")
+
+
+if __name__ == "__main__":
+    main()
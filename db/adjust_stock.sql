@@ -0,0 +1,27 @@
+-- Atomic relative stock adjustment used by app.adjust_stock().
+-- Applies every {barcode, delta} pair in a single UPDATE, so concurrent
+-- registers never lose each other's decrements. Quantities are clamped at 0,
+-- matching the behaviour of the old read-modify-write code path.
+--
+-- Usage (PostgREST):
+--   POST /rest/v1/rpc/adjust_stock
+--   {"deltas": [{"barcode": "869...", "delta": -2}, {"barcode": "869...", "delta": 12}]}
+-- Returns the updated product rows; barcodes that do not exist are skipped.
+
+create or replace function public.adjust_stock(deltas jsonb)
+returns setof public.products
+language sql
+as $$
+  with d as (
+    select e->>'barcode' as barcode, sum((e->>'delta')::integer) as delta
+      from jsonb_array_elements(deltas) as e
+     group by 1
+  )
+  update public.products as p
+     set quantity = greatest(coalesce(p.quantity, 0) + d.delta, 0)
+    from d
+   where p.barcode = d.barcode
+  returning p.*;
+$$;
+
+grant execute on function public.adjust_stock(jsonb) to anon, authenticated, service_role;